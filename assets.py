@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import argparse
+
+import pygame
+
+from cache import writeAtomic
+
+#Shared images. Each one is loaded the first time something draws it and
+#converted once to the display's pixel format (blitting an unconverted
+#surface converts it all over again on every blit). Decoding the PNGs is
+#most of what loading them costs, so they can also be packed into an atlas:
+#one file of raw pixels that loads with a plain read. Build it with
+#
+#   python assets.py
+#
+#Images that changed since the atlas was built are read from their PNGs.
+
+DIRECTORY = os.path.normpath("Pictures")
+ATLAS = os.path.normpath("Cache/images.atlas")
+#Bump when the atlas layout changes.
+ATLAS_VERSION = 1
+#Byte order of the pixels in the atlas.
+ATLAS_FORMAT = "RGBA"
+
+#(path, alpha) -> converted pygame.Surface.
+images = dict()
+
+#path is relative to the game folder. alpha keeps per-pixel transparency,
+#leave it off for opaque backgrounds, which blit faster without it.
+def getImage(path, alpha=True):
+    path = os.path.normpath(path)
+    key = (path, alpha)
+    image = images.get(key)
+    if image == None:
+        image = atlas.load(path)
+        if image == None:
+            image = pygame.image.load(path)
+        image = image.convert_alpha() if alpha else image.convert()
+        images[key] = image
+    return image
+
+def clear():
+    images.clear()
+
+#Stat of a source image, so stale atlas entries can be told apart.
+def getStamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+#The atlas file is a JSON header (its length first, as a line of its own)
+#followed by every image's pixels back to back. Only the header is read up
+#front, each image's pixels are read when it's first needed.
+class Atlas(object):
+    def __init__(self, path=ATLAS):
+        self.path = os.path.normpath(path)
+        #None until the header has been read, then path -> entry.
+        self.entries = None
+        self.dataStart = 0
+
+    def readHeader(self):
+        self.entries = dict()
+        try:
+            with open(self.path, "rb") as f:
+                length = int(f.readline())
+                header = json.loads(f.read(length).decode("utf-8"))
+                self.dataStart = f.tell()
+        except (OSError, ValueError):
+            return
+        if ((header.get("version") != ATLAS_VERSION) or
+                (header.get("format") != ATLAS_FORMAT)):
+            return
+        self.entries = header["images"]
+
+    #Unconverted surface for path, or None if it isn't in the atlas or has
+    #changed since.
+    def load(self, path):
+        if self.entries == None:
+            self.readHeader()
+        entry = self.entries.get(path)
+        if entry == None:
+            return None
+        try:
+            if getStamp(path) != entry["stamp"]:
+                return None
+            with open(self.path, "rb") as f:
+                f.seek(self.dataStart + entry["offset"])
+                data = f.read(entry["length"])
+        except OSError:
+            return None
+        if len(data) != entry["length"]:
+            return None
+        return pygame.image.frombuffer(data, tuple(entry["size"]),
+                                        ATLAS_FORMAT)
+
+    #Packs every image in paths, replacing whatever was there.
+    def build(self, paths):
+        entries = dict()
+        chunks = []
+        offset = 0
+        for path in paths:
+            path = os.path.normpath(path)
+            image = pygame.image.load(path)
+            data = pygame.image.tobytes(image, ATLAS_FORMAT)
+            entries[path] = {"size": list(image.get_size()),
+                             "offset": offset, "length": len(data),
+                             "stamp": getStamp(path)}
+            chunks.append(data)
+            offset += len(data)
+        header = json.dumps({"version": ATLAS_VERSION, "format": ATLAS_FORMAT,
+                             "images": entries}).encode("utf-8")
+
+        writeAtomic(self.path, b"%d\n" % len(header), header, *chunks)
+        self.entries = None
+        return offset
+
+atlas = Atlas()
+
+def findImages(directory=DIRECTORY):
+    paths = []
+    for (root, dirs, files) in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(".png"):
+                paths.append(os.path.normpath(os.path.join(root, name)))
+    return sorted(paths)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Pack the game's images into an atlas for fast startup.")
+    parser.add_argument("directory", nargs="?", default=DIRECTORY)
+    parser.add_argument("--output", default=ATLAS)
+    args = parser.parse_args(argv)
+
+    paths = findImages(args.directory)
+    size = Atlas(args.output).build(paths)
+    print("%d images, %.1f MB -> %s" % (len(paths), size / (1024 * 1024),
+                                         args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,693 @@
-import librosa
+import numpy
+import soundfile
 import pygame
 import os
+import time
+import statistics
+import threading
+import importlib.metadata
+
+from concurrent.futures import Future
+
+from cache import AnalysisCache, Analysis
+from profiler import StartupTimer
+from trackers import TRACKERS, DEFAULT_TRACKER, getTracker, toTempo
+
+#librosa (and numba and scipy behind it) is only imported by the functions
+#that use it, so the game gets to the menu without it. numba compiles
+#librosa's kernels the first time they run, which takes seconds, and only
+#keeps them between runs if it can write next to librosa's own files. The
+#Cache folder is always writable. This has to be set before numba is
+#imported, and worker processes inherit it.
+os.environ.setdefault("NUMBA_CACHE_DIR",
+                        os.path.abspath(os.path.normpath("Cache/numba")))
+
+#Shared by every Song unless one is given explicitly.
+analysisCache = AnalysisCache()
+
+#Analysis profiles, trading accuracy for speed. Beat placement doesn't need
+#anything close to the native sample rate: at 22.05kHz and a 512 hop a frame
+#is still only 23ms, well inside the 60ms timing windows. Run
+#"python benchmark.py profiles" to see what each one costs and how far its
+#beats drift from "accurate".
+PROFILES = {
+    #Native sample rate, librosa's defaults.
+    "accurate": {"sr": None, "hop": 512, "res_type": None},
+    "fast": {"sr": 22050, "hop": 512, "res_type": "soxr_mq"},
+    #Halving the hop along with the rate keeps frames at the same length.
+    "fastest": {"sr": 11025, "hop": 256, "res_type": "soxr_lq"},
+}
+DEFAULT_PROFILE = "accurate"
+
+#Long songs can be analyzed in overlapping segments instead (mode
+#"segments"), each one tracked on its own and then stitched back together
+#(see analyzeSegment() and joinSegments()). The segments can all run at once
+#on a process pool, and since every segment finds its own tempo, the beats
+#follow tempo changes that one pass over the whole song (which settles on a
+#single tempo) can't. Seconds per segment, and how far neighbouring segments
+#overlap.
+SEGMENT_LENGTH = 60.0
+SEGMENT_OVERLAP = 12.0
+
+#Read from the package's metadata rather than librosa.__version__, looking
+#up a cached analysis shouldn't have to import librosa. Only asked for when
+#librosa has a hand in the analysis (see getAnalysisParams()), the other
+#trackers work without it installed.
+librosaVersion = None
+
+def getLibrosaVersion():
+    global librosaVersion
+    if librosaVersion == None:
+        librosaVersion = importlib.metadata.version("librosa")
+    return librosaVersion
+
+#Everything that changes the result of analyzeFile() has to be in here, or
+#the cache would hand back beats computed with different settings.
+#mode is "full" (decode the whole file at once), "stream" (see BeatStream) or
+#"segments" (see SEGMENT_LENGTH), tracker one of trackers.TRACKERS.
+def getAnalysisParams(mode="full", profile=DEFAULT_PROFILE,
+                        tracker=DEFAULT_TRACKER):
+    if mode == "stream":
+        #BeatStream is built on librosa's beat tracker.
+        tracker = "librosa"
+    params = {"mode": mode, "profile": profile, "tracker": tracker,
+              "trackerVersion": TRACKERS[tracker].VERSION}
+    params.update(PROFILES[profile])
+    #librosa tracks the beats, or resamples the song for the tracker.
+    if (tracker == "librosa") or (params["sr"] != None):
+        params["librosa"] = getLibrosaVersion()
+    if mode == "stream":
+        #librosa.stream can't resample, streaming always runs at the native
+        #rate and only takes the hop length from the profile.
+        (params["sr"], params["res_type"]) = (None, None)
+        params["streamVersion"] = BeatStream.VERSION
+    if mode == "segments":
+        (params["segment"], params["overlap"]) = (SEGMENT_LENGTH,
+                                                    SEGMENT_OVERLAP)
+    return params
+
+#Loads and beat-tracks a file. This runs inside worker processes, so it has
+#to be a plain module-level function and return only picklable values.
+def analyzeFile(path, params, cache=None):
+    key = None
+    if cache != None:
+        key = cache.key(path, params)
+        entry = cache.load(key)
+        if entry != None:
+            return entry
+
+    if params["mode"] == "stream":
+        stream = BeatStream(path, hop=params["hop"])
+        for chunk in stream:
+            pass
+        analysis = stream.getAnalysis()
+    elif params["mode"] == "segments":
+        #One after the other here, see Song.analyzeSegmented() for running
+        #them in parallel.
+        results = [analyzeSegment(path, params, start, end)
+                    for (start, end) in getSegments(path, params)]
+        analysis = joinSegments(path, params, results)
+    else:
+        (y, sr) = loadFile(path)
+        analysis = trackBeats(*toTrackable(y, sr, params), params)
+
+    if key != None:
+        cache.store(key, analysis)
+    return analysis
+
+#Decodes path at its own sample rate, one row per channel, from start to
+#end seconds in (all of it by default). soundfile reads files exactly as
+#librosa.load() does (it's what librosa uses for them), so librosa only gets
+#imported for files soundfile can't open.
+def loadFile(path, start=0.0, end=None):
+    try:
+        sr = soundfile.info(path).samplerate
+        stop = None if (end == None) else int(round(end * sr))
+        y, sr = soundfile.read(path, start=int(round(start * sr)), stop=stop,
+                                dtype="float32", always_2d=True)
+        return (y.T, sr)
+    except Exception:
+        import librosa
+        duration = None if (end == None) else end - start
+        y, sr = librosa.load(path, sr=None, mono=False, offset=start,
+                                duration=duration)
+        return (numpy.atleast_2d(y), sr)
+
+#(length in seconds, native sample rate) of path, from its header.
+def probeFile(path):
+    try:
+        info = soundfile.info(path)
+        return (info.duration, info.samplerate)
+    except Exception:
+        import librosa
+        return (librosa.get_duration(path=path),
+                librosa.get_samplerate(path))
+
+#Mixes y down to mono and resamples it to the profile's rate, which is what
+#the trackers get. Returns (y, sr).
+def toTrackable(y, sr, params):
+    mono = y.mean(axis=0)
+    if (params["sr"] != None) and (params["sr"] != sr):
+        import librosa
+        mono = librosa.resample(mono, orig_sr=sr, target_sr=params["sr"],
+                                res_type=params["res_type"])
+        sr = params["sr"]
+    return (mono, sr)
+
+#Runs the tracker params asks for (see trackers.py) on mono samples y.
+def trackBeats(y, sr, params):
+    tracker = getTracker(params["tracker"], params["hop"])
+    (tempo, times) = tracker.analyze(y, sr)
+    beats = [int(round(time * sr / params["hop"])) for time in times]
+    return Analysis(tempo, beats, times, len(y) / sr)
+
+#Like analyzeFile(), but also returns the song ready to play: 16-bit PCM at
+#rate (the mixer's) with one column per channel. The file is decoded once
+#at its native rate, and both the analysis and the playback copy are made
+#from that. Only for "full" mode params. Runs in worker processes too.
+def analyzeForPlayback(path, params, rate, channels, cache=None):
+    (y, sr) = loadFile(path)
+    key = None
+    analysis = None
+    if cache != None:
+        key = cache.key(path, params)
+        analysis = cache.load(key)
+    if analysis == None:
+        analysis = trackBeats(*toTrackable(y, sr, params), params)
+        if key != None:
+            cache.store(key, analysis)
+
+    if sr != rate:
+        import librosa
+        y = librosa.resample(y, orig_sr=sr, target_sr=rate)
+    return (analysis, toPcm(y, channels))
+
+#Just the playback copy, for songs whose analysis is already cached. Files
+#soundfile can read at the mixer's rate skip librosa and resampling.
+#(Reading them as floats matters: libsndfile's own conversion to 16 bits
+#wraps samples over full scale around instead of clipping them.)
+def decodeForPlayback(path, rate, channels):
+    try:
+        if soundfile.info(path).samplerate == rate:
+            y, sr = soundfile.read(path, dtype="float32", always_2d=True)
+            return toPcm(y.T, channels)
+    except Exception:
+        #Not something soundfile can open, librosa falls back to audioread.
+        pass
+    import librosa
+    y, sr = librosa.load(path, sr=rate, mono=False)
+    return toPcm(y, channels)
+
+#(start, end) in seconds of each segment path is split into for "segments"
+#params, the last one's end None (the end of the song). Segments are as
+#close to params["segment"] long as will divide the song evenly, and reach
+#half the overlap into their neighbours.
+def getSegments(path, params):
+    (duration, sr) = probeFile(path)
+    count = max(1, int(round(duration / params["segment"])))
+    (length, margin) = (duration / count, params["overlap"] / 2)
+    segments = [(max(0.0, i * length - margin), (i + 1) * length + margin)
+                for i in range(count)]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+#Beat tracks the part of path from start to end seconds. Runs in worker
+#processes. Returns (start, tempo, beat times from the start of the song).
+def analyzeSegment(path, params, start, end):
+    (y, sr) = loadFile(path, start, end)
+    #Whole samples from the start, which is where the decoded part begins.
+    start = int(round(start * sr)) / sr
+    (y, sr) = toTrackable(y, sr, params)
+    tracker = getTracker(params["tracker"], params["hop"])
+    #Trackers drop weak beats at either end, but only the song's own ends
+    #should lose them. A quiet stretch just before a cut would lose its
+    #beats, and the next segment often starts too late to have them.
+    (tempo, times) = tracker.analyze(y, sr, trimStart=(start == 0),
+                                        trimEnd=(end == None))
+    return (start, tempo, [start + time for time in times])
+
+#Stitches the results of analyzeSegment(), in order, into one Analysis.
+def joinSegments(path, params, results):
+    (duration, sr) = probeFile(path)
+    if params["sr"] != None:
+        sr = params["sr"]
+    (start, tempo, times) = results[0]
+    for (start, segmentTempo, segmentTimes) in results[1:]:
+        #A folded segment is at the previous tempo now, and the next one
+        #has to be compared against that, not what its tracker said.
+        (segmentTimes, segmentTempo) = matchTempo(times, tempo, segmentTimes,
+                                                    segmentTempo)
+        times = stitchBeats(times, segmentTimes, start, 60 / tempo)
+        tempo = segmentTempo
+    beats = [int(round(time * sr / params["hop"])) for time in times]
+    return Analysis(getOverallTempo(times, tempo), beats, times, duration)
+
+#Trackers sometimes lock on to double or half the tempo. When a segment's
+#tempo is (nearly) exactly that compared to the one before it, it's taken
+#to be one of those mistakes rather than the song changing tempo, and its
+#beats are thinned out or filled in to match. The beats of the previous
+#segment, times, decide which half to keep. Returns the segment's beats and
+#the tempo they're at.
+def matchTempo(times, tempo, segmentTimes, segmentTempo, tolerance=0.04):
+    ratio = segmentTempo / tempo
+    if (abs(ratio - 2) < 2 * tolerance) and (len(segmentTimes) > 1):
+        period = 60 / tempo
+        (even, odd) = (segmentTimes[0::2], segmentTimes[1::2])
+        agree = lambda half: len(matchBeats(times, half, period / 5))
+        return (even if (agree(even) >= agree(odd)) else odd, tempo)
+    if abs(ratio - 0.5) < tolerance / 2:
+        filled = []
+        for (a, b) in zip(segmentTimes, segmentTimes[1:]):
+            filled.extend((a, (a + b) / 2))
+        return (filled + segmentTimes[-1:], tempo)
+    return (segmentTimes, segmentTempo)
+
+#(i, j) for every beat in a that has a beat in b within tolerance seconds.
+def matchBeats(a, b, tolerance):
+    if (len(a) == 0) or (len(b) == 0):
+        return []
+    b = numpy.asarray(b)
+    pairs = []
+    for (i, time) in enumerate(a):
+        j = int(numpy.argmin(numpy.abs(b - time)))
+        if abs(b[j] - time) <= tolerance:
+            pairs.append((i, j))
+    return pairs
+
+#Joins two overlapping beat lists, the second one starting at start. They
+#are cut over on the beat they agree on closest to the middle of the
+#overlap, so there's no jump in phase. If they don't agree anywhere, the cut
+#is in the middle, and beats of the second list less than 3/4 of a period
+#after the last one kept from the first are dropped (a long gap is easier to
+#play than two beats in quick succession).
+def stitchBeats(times, segmentTimes, start, period):
+    end = times[-1] if (len(times) > 0) else start
+    middle = (start + end) / 2
+    overlap = [i for (i, time) in enumerate(times) if time >= start]
+    pairs = matchBeats([times[i] for i in overlap], segmentTimes, period / 5)
+    if len(pairs) > 0:
+        (i, j) = min(pairs, key=lambda pair:
+                        abs(times[overlap[pair[0]]] - middle))
+        return times[:overlap[i]] + segmentTimes[j:]
+    kept = [time for time in times if time < middle]
+    last = kept[-1] if (len(kept) > 0) else -period
+    return kept + [time for time in segmentTimes
+                    if (time >= middle) and (time - last >= 0.75 * period)]
+
+#From the median gap between beats, so that a song whose tempo changes gets
+#the tempo it spends most time at. fallback is for fewer than two beats.
+def getOverallTempo(times, fallback):
+    if len(times) < 2:
+        return fallback
+    return 60 / float(numpy.median(numpy.diff(times)))
+
+#[(time, BPM)] for every point where the tempo changes by more than
+#tolerance (a fraction of it). Tempos are medians over window gaps between
+#beats, so a single odd gap doesn't count as a change.
+def getTempoMap(times, window=8, tolerance=0.03):
+    if len(times) < 2:
+        return []
+    gaps = numpy.diff(times)
+    tempoMap = []
+    for i in range(len(gaps)):
+        low = max(0, min(i - window // 2, len(gaps) - window))
+        bpm = 60 / float(numpy.median(gaps[low:low + window]))
+        if ((len(tempoMap) == 0) or
+                (abs(bpm - tempoMap[-1][1]) > tolerance * tempoMap[-1][1])):
+            tempoMap.append((float(times[i]), bpm))
+    return tempoMap
+
+#Runs beat tracking once on a few seconds of clicks. The first beat_track()
+#in a process imports most of librosa and compiles (or loads from
+#NUMBA_CACHE_DIR) its kernels, so doing it ahead of time keeps that out of
+#the first real analysis. Returns a StartupTimer with the time each took.
+def warmUp():
+    timer = StartupTimer()
+    import librosa
+    timer.mark("librosa")
+    sr = 22050
+    clicks = librosa.clicks(times=numpy.arange(0, 4, 0.5), sr=sr, length=4*sr)
+    timer.mark("clicks")
+    librosa.beat.beat_track(y=clicks, sr=sr)
+    timer.mark("beat_track")
+    return timer
+
+#Float samples from librosa (one row per channel, or 1-D for mono) to
+#16-bit PCM shaped (frames, channels), which is what the mixer plays.
+def toPcm(y, channels):
+    y = numpy.atleast_2d(y)
+    if y.shape[0] < channels:
+        y = numpy.repeat(y[:1], channels, axis=0)
+    pcm = numpy.clip(y[:channels].T, -1.0, 1.0) * 32767
+    return numpy.ascontiguousarray(pcm, dtype=numpy.int16)
+
+#Beat tracking that never holds more than one block of audio in memory.
+#The file is decoded block by block with librosa.stream, only the onset
+#strength envelope (one float per hop) is kept, and beat tracking runs on
+#that. Iterating yields lists of newly found beat times as the file is read,
+#so a caller can start using the first beats long before the end is decoded.
+#The beats are close to analyzing the whole file on most songs, but not all:
+#the envelope isn't clipped to the file's loudest frame the way librosa's
+#is, which can change the tempo it settles on (Bonetrousle streams at 152
+#BPM against 99.4 whole).
+class BeatStream(object):
+    #Bump when a change changes the beats it finds, like VERSION in
+    #trackers.py.
+    VERSION = 2
+
+    def __init__(self, path, hop=512, frameLength=2048, blockLength=256,
+                    margin=5.0, every=15.0):
+        self.path = os.path.normpath(path)
+        self.hop = hop
+        self.frameLength = frameLength
+        #In frames, 256 frames of 512 samples is about 3 seconds at 44.1kHz.
+        self.blockLength = blockLength
+        #Beats this close (in seconds) to the end of what has been decoded
+        #so far might still move, so they aren't reported yet.
+        self.margin = margin
+        #Seconds of new audio between beat tracking passes.
+        self.every = every
+        self.cancelled = False
+        self.tempo = None
+        self.beats = []
+        self.times = []
+        self.duration = None
+
+    def __iter__(self):
+        import librosa
+        sr = librosa.get_samplerate(self.path)
+        blocks = librosa.stream(self.path, block_length=self.blockLength,
+                                frame_length=self.frameLength,
+                                hop_length=self.hop, mono=True,
+                                fill_value=0)
+        #Uncentered frames are shifted by half a frame compared to what
+        #librosa.load + beat_track sees, and onset_strength pads its output
+        #a little on top of that, so pad to line them back up.
+        envelope = [numpy.zeros(self.frameLength // (2 * self.hop) + 2)]
+        previous = None
+        (samples, lastPass) = (0, 0)
+        for block in blocks:
+            if self.cancelled:
+                return
+            (onsets, previous) = self.onsetStrength(block, sr, previous)
+            envelope.append(onsets)
+            samples += self.blockLength * self.hop
+            if (samples - lastPass) >= self.every * sr:
+                lastPass = samples
+                newTimes = self.track(envelope, sr, samples/sr - self.margin)
+                if len(newTimes) > 0:
+                    yield newTimes
+
+        #The last block is padded, so count what was really there.
+        self.duration = librosa.get_duration(path=self.path)
+        newTimes = self.track(envelope, sr, None)
+        if len(newTimes) > 0:
+            yield newTimes
+
+    #Same as librosa.onset.onset_strength, except that it carries the last
+    #spectrogram frame over from the previous block so there is no seam at
+    #block edges, and it doesn't clip to a per-block top_db (which would
+    #make each block's loudness scale different).
+    def onsetStrength(self, block, sr, previous):
+        import librosa
+        #center=False so that consecutive blocks line up frame for frame.
+        S = librosa.feature.melspectrogram(y=block, sr=sr,
+                    n_fft=self.frameLength, hop_length=self.hop, center=False)
+        S = librosa.power_to_db(S, top_db=None)
+        if previous is None:
+            previous = S[:, :1]
+        S = numpy.concatenate((previous, S), axis=1)
+        onsets = numpy.maximum(0.0, numpy.diff(S, axis=1)).mean(axis=0)
+        return (onsets, S[:, -1:])
+
+    #Beat tracks everything seen so far and keeps the beats before cutoff
+    #that come after the ones already reported. A pass can shift the beats
+    #of the one before, so new beats must also leave 3/4 of a beat after the
+    #last one reported, or the player would get two in quick succession.
+    #Returns the new times.
+    def track(self, envelope, sr, cutoff):
+        import librosa
+        onsets = numpy.concatenate(envelope)
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onsets, sr=sr,
+                                                hop_length=self.hop)
+        self.tempo = toTempo(tempo)
+        times = librosa.frames_to_time(beats, sr=sr, hop_length=self.hop)
+        last = self.times[-1] if (len(self.times) > 0) else -numpy.inf
+        #librosa gives silence a tempo of 0.
+        minGap = (0.75 * 60 / self.tempo) if (self.tempo > 0) else 0
+        newTimes = []
+        for (frame, time) in zip(beats, times):
+            if (time - last < minGap) or (time <= last):
+                continue
+            if (cutoff == None) or (time < cutoff):
+                self.beats.append(int(frame))
+                newTimes.append(float(time))
+        self.times.extend(newTimes)
+        return newTimes
+
+    def getAnalysis(self):
+        return Analysis(self.tempo, self.beats, self.times, self.duration)
 
 class Song(object):
-    def __init__(self, path):
+    #With lazy=True nothing is analyzed until analyze() or analyzeAsync().
+    #profile is one of the keys of PROFILES, tracker one of trackers.TRACKERS
+    #and mode what analyze() uses (see getAnalysisParams()).
+    def __init__(self, path, cache=analysisCache, lazy=False,
+                    profile=DEFAULT_PROFILE, tracker=DEFAULT_TRACKER,
+                    mode="full"):
         self.path = os.path.normpath(path)
+        self.profile = profile
+        self.tracker = tracker
+        #Which of getAnalysisParams()' modes the analysis comes from. The
+        #other analyze methods set their own.
+        self.mode = mode
         self.tempo = None
         self.beats = None
         self.times = None
-        self.analyze()
+        self.duration = None
+        self.cache = cache
+        self.future = None
+        #The decoded song from analyzeAsync(..., playback=True) until
+        #SongPlayer.load() takes it, else None.
+        self.pcm = None
+        self.stream = None
+        self.streamError = None
+        #Lists registered by subscribe(), which get streamed beats appended.
+        self.listeners = []
+        self.lock = threading.Lock()
+        if not lazy:
+            self.analyze()
+
+    def getAnalysisParams(self, mode=None):
+        if mode == None:
+            mode = self.mode
+        return getAnalysisParams(mode, self.profile, self.tracker)
+
+    #Streaming always uses librosa (see getAnalysisParams()), so songs set
+    #to another tracker are analyzed whole.
+    def canStream(self):
+        return self.tracker == "librosa"
+
+    def isCached(self, mode=None):
+        if self.cache == None:
+            return False
+        key = self.cache.key(self.path, self.getAnalysisParams(mode))
+        return os.path.exists(self.cache.entryPath(key))
+
+    #Length of the file in seconds, read from its header without decoding.
+    def probeDuration(self):
+        try:
+            return soundfile.info(self.path).duration
+        except Exception:
+            #Same fallback as decodeForPlayback().
+            import librosa
+            return librosa.get_duration(path=self.path)
 
     def analyze(self):
-        audio_path = self.path
-        y, sr = librosa.load(audio_path, sr=None)
-        tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-        self.tempo = tempo
-        self.beats = list(beats)
-        self.times = list(librosa.frames_to_time(beats, sr=sr))
+        self.setAnalysis(analyzeFile(self.path, self.getAnalysisParams(),
+                                        self.cache))
+
+    def setAnalysis(self, analysis):
+        self.tempo = analysis.tempo
+        self.beats = analysis.beats
+        self.times = analysis.times
+        self.duration = analysis.duration
+
+    #Starts analysis on executor (ideally a process pool, librosa holds the
+    #GIL for long stretches) and returns the Future. Cache hits skip the
+    #worker entirely and come back as an already finished Future. With
+    #playback=True the worker also decodes the song for the mixer (see
+    #analyzeForPlayback()), which has to happen even on a cache hit. mode
+    #can also be another one the song is cached in, like "stream", to pick up
+    #that entry (when it's missing, the song is analyzed whole).
+    def analyzeAsync(self, executor, playback=False, mode="full"):
+        self.mode = mode
+        params = self.getAnalysisParams()
+        entry = None
+        if self.cache != None:
+            entry = self.cache.load(self.cache.key(self.path, params))
+        if entry == None:
+            #The workers check the cache for the "full" entry themselves.
+            self.mode = "full"
+            params = self.getAnalysisParams()
+
+        if playback:
+            (rate, size, channels) = pygame.mixer.get_init()
+            if entry == None:
+                self.future = executor.submit(analyzeForPlayback, self.path,
+                                        params, rate, channels, self.cache)
+            else:
+                #Decoding alone is quick and mostly outside the GIL, a thread
+                #will do and saves starting up the pool.
+                self.future = Future()
+                thread = threading.Thread(target=self.runDecode,
+                                    args=(entry, rate, channels), daemon=True)
+                thread.start()
+        elif entry != None:
+            self.future = Future()
+            self.future.set_result(entry)
+        else:
+            self.future = executor.submit(analyzeFile, self.path, params,
+                                            self.cache)
+        return self.future
+
+    def runDecode(self, analysis, rate, channels):
+        future = self.future
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            pcm = decodeForPlayback(self.path, rate, channels)
+        except Exception as error:
+            future.set_exception(error)
+            return
+        future.set_result((analysis, pcm))
+
+    #Streams the file on a background thread instead (see BeatStream). The
+    #song counts as ready as soon as the first beats are in, and the rest
+    #keep arriving in getBeatTimes() and in any list from subscribe().
+    def analyzeStreaming(self):
+        self.mode = "stream"
+        self.tempo = None
+        self.beats = []
+        self.times = []
+        self.streamError = None
+        self.stream = BeatStream(self.path,
+                                    hop=self.getAnalysisParams("stream")["hop"])
+        thread = threading.Thread(target=self.runStream, daemon=True)
+        thread.start()
+
+    def runStream(self):
+        stream = self.stream
+        try:
+            for newTimes in stream:
+                with self.lock:
+                    self.times.extend(newTimes)
+                    for listener in self.listeners:
+                        listener.extend(newTimes)
+        except Exception as error:
+            self.streamError = error
+        if stream.cancelled or (self.streamError != None):
+            return
+
+        analysis = stream.getAnalysis()
+        (self.tempo, self.beats) = (analysis.tempo, analysis.beats)
+        self.duration = analysis.duration
+        if self.cache != None:
+            key = self.cache.key(self.path, self.getAnalysisParams("stream"))
+            self.cache.store(key, analysis)
+        self.stream = None
+
+    #Analyzes the song in segments (see SEGMENT_LENGTH), all of them at once
+    #on executor, which should be a process pool with a worker per core.
+    #Returns a Future like analyzeAsync(). The segments are handed out and
+    #stitched on a thread here, which decodes the playback copy (with
+    #playback=True) while the workers run.
+    def analyzeSegmented(self, executor, playback=False):
+        self.mode = "segments"
+        #The mixer is only asked from the main thread.
+        mixer = pygame.mixer.get_init() if playback else None
+        self.future = Future()
+        thread = threading.Thread(target=self.runSegments,
+                                    args=(executor, mixer), daemon=True)
+        thread.start()
+        return self.future
+
+    def runSegments(self, executor, mixer):
+        future = self.future
+        if not future.set_running_or_notify_cancel():
+            return
+        params = self.getAnalysisParams("segments")
+        (key, analysis, pcm) = (None, None, None)
+        try:
+            if self.cache != None:
+                key = self.cache.key(self.path, params)
+                analysis = self.cache.load(key)
+            if analysis == None:
+                jobs = [executor.submit(analyzeSegment, self.path, params,
+                                        start, end)
+                        for (start, end) in getSegments(self.path, params)]
+            if mixer != None:
+                (rate, size, channels) = mixer
+                pcm = decodeForPlayback(self.path, rate, channels)
+            if analysis == None:
+                analysis = joinSegments(self.path, params,
+                                        [job.result() for job in jobs])
+                if key != None:
+                    self.cache.store(key, analysis)
+        except Exception as error:
+            future.set_exception(error)
+            return
+        future.set_result(analysis if (mixer == None) else (analysis, pcm))
+
+    def isStreaming(self):
+        return self.stream != None
+
+    #Returns a copy of the beat times found so far. While streaming, later
+    #beats get appended to that copy as they are found.
+    def subscribe(self):
+        with self.lock:
+            times = list(self.times)
+            if self.isStreaming():
+                self.listeners.append(times)
+        return times
+
+    def isReady(self):
+        if self.isStreaming():
+            return (len(self.times) > 0) or (self.streamError != None)
+        if self.times != None:
+            return True
+        return (self.future != None) and self.future.done()
+
+    #Copies the finished analysis over. Re-raises whatever the worker raised.
+    def collect(self):
+        if self.streamError != None:
+            raise self.streamError
+        if self.times == None:
+            result = self.future.result()
+            if isinstance(result, Analysis):
+                self.setAnalysis(result)
+            else:
+                (analysis, self.pcm) = result
+                self.setAnalysis(analysis)
+        self.future = None
+
+    #A job that already started can't be stopped, but its result is thrown
+    #away (it still ends up in the cache for next time). Streaming stops at
+    #the next block.
+    def cancel(self):
+        if self.future != None:
+            self.future.cancel()
+            self.future = None
+        if self.stream != None:
+            self.stream.cancelled = True
+            self.stream = None
+
+    #Key for things cached alongside this song's analysis, like the beat
+    #chart for one particular layout (extra holds the layout's params).
+    def getCacheKey(self, extra, mode=None):
+        params = self.getAnalysisParams(mode)
+        params.update(extra)
+        return self.cache.key(self.path, params)
 
     def getTempo(self):
         return self.tempo
@@ -27,10 +698,208 @@ class Song(object):
     def getBeatTimes(self):
         return self.times
 
+    #See getTempoMap(). Songs analyzed whole settle on one tempo, so their
+    #beats rarely show any changes, analyzing in segments finds them.
+    def getTempoMap(self):
+        return getTempoMap(self.times)
+
+    def getDuration(self):
+        return self.duration
+
     def getPath(self):
         return self.path
 
+#Plays a Song. Songs decoded ahead of time (Song.pcm) are played from
+#memory through mixer.Sounds, everything else is streamed from the file by
+#mixer.music, which decodes it all over again while it plays.
+class SongPlayer(object):
+    #The old hand-tuned offset for mixer.music, which also makes up for its
+    #position only moving once per buffer.
+    MUSIC_LATENCY = 0.45
+    #Reserved for songs, so sound effects can never take it.
+    CHANNEL = 0
+    #Songs played from memory are cut into Sounds this many seconds long,
+    #queued on the channel one after the other (see getPos()).
+    CHUNK_LENGTH = 2.0
+    #How many chunk starts getPos() averages over.
+    ANCHORS = 8
+
+    def __init__(self):
+        self.chunks = None
+        self.chunkLength = SongPlayer.CHUNK_LENGTH
+        self.channel = None
+        self.endEvent = None
+        #Index of the chunk playing, and perf_counter() less the song
+        #position (in seconds) at the last few chunk starts.
+        self.playing = 0
+        self.anchors = []
+        #When getPos() last looked at the channel, and when it was paused.
+        self.lastPoll = None
+        self.pausedAt = None
+        #Measured when the mixer starts up, see measureOutputLatency().
+        self.outputLatency = None
+        #From calibration.LatencyProfile, overrides outputLatency.
+        self.calibratedLatency = None
+
+    def load(self, song):
+        if song.pcm is not None:
+            self.loadPcm(song.pcm)
+            #The Sounds have their own copy, don't keep the song in memory
+            #twice.
+            song.pcm = None
+        else:
+            self.stop()
+            self.chunks = None
+            pygame.mixer.music.load(song.getPath())
+
+    #pcm is (frames, channels) int16 at the mixer's rate. The Sounds copy
+    #it, so it can be let go of afterwards.
+    def loadPcm(self, pcm):
+        self.stop()
+        rate = pygame.mixer.get_init()[0]
+        step = int(round(rate * SongPlayer.CHUNK_LENGTH))
+        self.chunkLength = step / rate
+        self.chunks = [pygame.mixer.Sound(buffer=pcm[i:i + step])
+                        for i in range(0, max(1, len(pcm)), step)]
+
+    def isDecoded(self):
+        return self.chunks != None
+
+    #Seconds between the mixer playing something and it being heard (and,
+    #once calibrated, the player's tap getting back to the game). The
+    #calibration is done on the song channel, so mixer.music keeps its old
+    #offset.
+    def getLatency(self):
+        if self.isDecoded():
+            if self.calibratedLatency != None:
+                return self.calibratedLatency
+            if self.outputLatency != None:
+                return self.outputLatency
+        return SongPlayer.MUSIC_LATENCY
+
+    #endEvent is posted when the song finishes.
+    def play(self, endEvent):
+        if self.isDecoded():
+            pygame.mixer.set_reserved(SongPlayer.CHANNEL + 1)
+            self.channel = pygame.mixer.Channel(SongPlayer.CHANNEL)
+            self.endEvent = endEvent
+            self.channel.play(self.chunks[0])
+            self.playing = 0
+            self.lastPoll = time.perf_counter()
+            self.anchors = [self.lastPoll]
+            self.pausedAt = None
+            self.queueNext()
+        else:
+            pygame.mixer.music.play()
+            pygame.mixer.music.set_endevent(endEvent)
+
+    #The channel posts its end event whenever a Sound finishes, so it only
+    #gets one once the last chunk is playing.
+    def queueNext(self):
+        if self.playing + 1 < len(self.chunks):
+            self.channel.queue(self.chunks[self.playing + 1])
+        else:
+            self.channel.set_endevent(self.endEvent)
+
+    def pause(self):
+        if self.channel != None:
+            self.channel.pause()
+            if self.pausedAt == None:
+                self.pausedAt = time.perf_counter()
+        else:
+            pygame.mixer.music.pause()
+
+    def unpause(self):
+        if self.channel != None:
+            self.channel.unpause()
+            if self.pausedAt != None:
+                now = time.perf_counter()
+                paused = now - self.pausedAt
+                self.anchors = [anchor + paused for anchor in self.anchors]
+                (self.lastPoll, self.pausedAt) = (now, None)
+        else:
+            pygame.mixer.music.unpause()
+
+    def stop(self):
+        if self.channel != None:
+            self.channel.set_endevent()
+            self.channel.stop()
+            self.channel = None
+        pygame.mixer.music.stop()
+        pygame.mixer.music.set_endevent()
+
+    #Milliseconds played, or -1 if the mixer can't say. mixer.music knows
+    #its own position. Channels don't, but the mixer starts each queued
+    #chunk right when the one before it runs out, which is a known number of
+    #samples into the song at a time the sound card's clock decided. Each
+    #call moves the queue along, and a chunk that started since the last
+    #call did so halfway between the two on average, which pins the song
+    #position to perf_counter(). The last ANCHORS of those are averaged to
+    #even out when the calls happened to come. So SongClock still follows
+    #the sound card, whose clock can run fast or slow against perf_counter()
+    #by tens of milliseconds over a long song.
+    def getPos(self):
+        if not self.isDecoded():
+            return pygame.mixer.music.get_pos()
+        if self.channel == None:
+            return -1
+        now = time.perf_counter()
+        if self.pausedAt == None:
+            self.advance(now)
+            self.lastPoll = now
+        else:
+            now = self.pausedAt
+        origin = sum(self.anchors) / len(self.anchors)
+        return 1000 * (now - origin)
+
+    #Queues the next chunk once the one queued before it has started.
+    def advance(self, now):
+        last = len(self.chunks) - 1
+        if (self.playing == last) or (self.channel.get_queue() != None):
+            return
+        self.playing += 1
+        if self.channel.get_busy():
+            start = self.playing * self.chunkLength
+            self.anchors.append((self.lastPoll + now) / 2 - start)
+            del self.anchors[:-SongPlayer.ANCHORS]
+        elif self.playing == last:
+            #Not called for longer than a chunk, and the song ran out.
+            pygame.event.post(pygame.event.Event(self.endEvent))
+            return
+        else:
+            #Not called for longer than a chunk, so the channel ran dry.
+            #The song carries on from there, late, and the clock jumps.
+            self.playing += 1
+            self.channel.play(self.chunks[self.playing])
+            self.anchors = [now - self.playing * self.chunkLength]
+        self.queueNext()
+
+    def measure(self, bufferSize):
+        self.outputLatency = measureOutputLatency(bufferSize)
+
+#Estimates how long sound takes to get out of the mixer: short silent
+#sounds are timed from play() until the mixer is done with them, which on
+#top of their length is the wait for the mixer's next pass, and the device
+#holds about one more buffer (bufferSize samples) before it's heard.
+def measureOutputLatency(bufferSize, trials=5):
+    (rate, size, channels) = pygame.mixer.get_init()
+    length = 0.02
+    silence = numpy.zeros((int(rate * length), channels), dtype=numpy.int16)
+    sound = pygame.mixer.Sound(buffer=silence)
+    delays = []
+    for i in range(trials):
+        start = time.perf_counter()
+        channel = sound.play()
+        if channel == None:
+            break
+        while channel.get_busy():
+            time.sleep(0.0005)
+        delays.append(time.perf_counter() - start - sound.get_length())
+    if len(delays) == 0:
+        return None
+    return max(0.0, statistics.median(delays)) + bufferSize / rate
+
 class Sound(pygame.mixer.Sound):
     def __init__(self, path):
         self.path = os.path.normpath(path)
-        super(Sound, self).__init__(file=self.path)
\ No newline at end of file
+        super(Sound, self).__init__(file=self.path)
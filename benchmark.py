@@ -0,0 +1,224 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import audio
+from library import Library
+from trackers import TRACKERS
+#Beats count as agreeing when they're within a judgement window.
+from scoring import WINDOW_WIDTH
+
+#Performance measurements that don't need a window. Each subcommand prints a
+#plain text table, run "python benchmark.py -h" for the list.
+
+#Peak resident memory of the current process in MB, or None where the
+#resource module doesn't exist (Windows).
+def peakMemory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes.
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+#Runs in a fresh worker process per measurement, so peak memory belongs to
+#this one analysis alone. With warm=False librosa's first-run costs are
+#left in.
+def timeAnalysis(path, params, warm=True):
+    if warm and (params["tracker"] == "librosa"):
+        #Gets numba's JIT compilation out of the way, so it isn't billed to
+        #whichever file happens to be analyzed first.
+        audio.warmUp()
+    startTime = time.perf_counter()
+    analysis = audio.analyzeFile(path, params, cache=None)
+    wallTime = time.perf_counter() - startTime
+    return (wallTime, peakMemory(), analysis)
+
+def measure(path, params, warm=True):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(timeAnalysis, path, params, warm).result()
+
+#How far each reference beat is from the closest beat in times, in seconds.
+def beatDeviation(reference, times):
+    (reference, times) = (numpy.asarray(reference), numpy.asarray(times))
+    if (len(reference) == 0) or (len(times) == 0):
+        return numpy.array([numpy.inf])
+    index = numpy.clip(numpy.searchsorted(times, reference), 1, len(times)-1)
+    before = numpy.abs(reference - times[index - 1])
+    after = numpy.abs(times[index] - reference)
+    return numpy.minimum(before, after)
+
+def formatMemory(peak):
+    return "n/a" if (peak == None) else "%.0f" % peak
+
+def benchProfiles(args):
+    profiles = args.profiles or sorted(audio.PROFILES)
+    paths = Library(args.directory).scan()
+    print("%-28s %-9s %8s %8s %6s %9s %9s %7s" % ("song", "profile",
+            "time(s)", "RSS(MB)", "beats", "mean(ms)", "p95(ms)", "in win"))
+
+    for path in paths:
+        reference = None
+        if "accurate" not in profiles:
+            params = audio.getAnalysisParams(profile="accurate")
+            reference = measure(path, params)[2].times
+
+        for profile in sorted(profiles, key=lambda p: p != "accurate"):
+            params = audio.getAnalysisParams(profile=profile)
+            (wallTime, peak, analysis) = measure(path, params)
+            times = analysis.times
+            if reference == None:
+                reference = times
+            deviation = beatDeviation(reference, times)
+            print("%-28s %-9s %8.2f %8s %6d %9.1f %9.1f %6.1f%%" % (
+                os.path.basename(path)[:28], profile, wallTime,
+                formatMemory(peak), len(times), 1000 * deviation.mean(),
+                1000 * numpy.percentile(deviation, 95),
+                100 * numpy.mean(deviation <= WINDOW_WIDTH)))
+
+#Every tracker on every song, with agreement measured against librosa's
+#beats. The first song is also analyzed once in a fresh process without
+#warming up, which is what the first song after launching the game costs.
+def benchTrackers(args):
+    trackers = args.trackers or sorted(TRACKERS)
+    paths = Library(args.directory).scan()
+    print("%-28s %-8s %8s %8s %6s %6s %9s %9s %7s" % ("song", "tracker",
+            "time(s)", "RSS(MB)", "BPM", "beats", "mean(ms)", "p95(ms)",
+            "in win"))
+
+    for path in paths:
+        params = audio.getAnalysisParams(profile=args.profile,
+                                            tracker="librosa")
+        reference = None
+        if "librosa" not in trackers:
+            reference = measure(path, params)[2].times
+
+        for tracker in sorted(trackers, key=lambda t: t != "librosa"):
+            params = audio.getAnalysisParams(profile=args.profile,
+                                                tracker=tracker)
+            (wallTime, peak, analysis) = measure(path, params)
+            if reference == None:
+                reference = analysis.times
+            deviation = beatDeviation(reference, analysis.times)
+            print("%-28s %-8s %8.2f %8s %6.1f %6d %9.1f %9.1f %6.1f%%" % (
+                os.path.basename(path)[:28], tracker, wallTime,
+                formatMemory(peak), analysis.tempo, len(analysis.times),
+                1000 * deviation.mean(),
+                1000 * numpy.percentile(deviation, 95),
+                100 * numpy.mean(deviation <= WINDOW_WIDTH)))
+
+    if len(paths) > 0:
+        print()
+        print("First song after launch (%s):" % os.path.basename(paths[0]))
+        for tracker in sorted(trackers):
+            params = audio.getAnalysisParams(profile=args.profile,
+                                                tracker=tracker)
+            (wallTime, peak, analysis) = measure(paths[0], params, warm=False)
+            print("  %-8s %8.2fs %8s MB" % (tracker, wallTime,
+                                            formatMemory(peak)))
+
+#Wall time of a segmented analysis (see audio.SEGMENT_LENGTH) with the
+#segments spread over workers processes, already started and warmed up.
+def timeSegments(path, params, workers):
+    context = multiprocessing.get_context("spawn")
+    warm = audio.warmUp if (params["tracker"] == "librosa") else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                initializer=warm) as pool:
+        #Starts every worker, they only get going on the first job.
+        for job in [pool.submit(peakMemory) for i in range(workers)]:
+            job.result()
+        startTime = time.perf_counter()
+        jobs = [pool.submit(audio.analyzeSegment, path, params, start, end)
+                for (start, end) in audio.getSegments(path, params)]
+        analysis = audio.joinSegments(path, params,
+                                        [job.result() for job in jobs])
+        return (time.perf_counter() - startTime, analysis)
+
+#Segmented analysis of every song with 1, 2, 4... workers (up to one per
+#core), against analyzing each song whole. Agreement is measured against the
+#whole song's beats, and "changes" counts the tempo changes found (see
+#audio.getTempoMap()).
+def benchSegments(args):
+    paths = Library(args.directory).scan()
+    counts = [1]
+    while counts[-1] * 2 <= (args.workers or os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    print("%-28s %-9s %8s %6s %6s %7s %7s" % ("song", "workers", "time(s)",
+            "BPM", "beats", "changes", "in win"))
+
+    for path in paths:
+        name = os.path.basename(path)[:28]
+        params = audio.getAnalysisParams(profile=args.profile,
+                                            tracker=args.tracker)
+        (wallTime, peak, whole) = measure(path, params)
+        print("%-28s %-9s %8.2f %6.1f %6d %7d" % (name, "whole", wallTime,
+                whole.tempo, len(whole.times),
+                len(audio.getTempoMap(whole.times)) - 1))
+
+        params = audio.getAnalysisParams("segments", args.profile,
+                                            args.tracker)
+        params["segment"] = args.length
+        for workers in counts:
+            (wallTime, analysis) = timeSegments(path, params, workers)
+            deviation = beatDeviation(whole.times, analysis.times)
+            print("%-28s %-9d %8.2f %6.1f %6d %7d %6.1f%%" % (name, workers,
+                    wallTime, analysis.tempo, len(analysis.times),
+                    len(audio.getTempoMap(analysis.times)) - 1,
+                    100 * numpy.mean(deviation <= WINDOW_WIDTH)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AudioBeat benchmarks.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    profiles = commands.add_parser("profiles",
+        help="compare analysis profiles on every song in a folder")
+    profiles.add_argument("directory", nargs="?", default=Library.DIRECTORY)
+    profiles.add_argument("--profile", dest="profiles", action="append",
+                          choices=sorted(audio.PROFILES),
+                          help="only run this profile (can be repeated)")
+    profiles.set_defaults(run=benchProfiles)
+
+    trackers = commands.add_parser("trackers",
+        help="compare beat trackers on every song in a folder")
+    trackers.add_argument("directory", nargs="?", default=Library.DIRECTORY)
+    trackers.add_argument("--tracker", dest="trackers", action="append",
+                          choices=sorted(TRACKERS),
+                          help="only run this tracker (can be repeated)")
+    trackers.add_argument("--profile", default=audio.DEFAULT_PROFILE,
+                          choices=sorted(audio.PROFILES),
+                          help="analysis profile (see audio.PROFILES)")
+    trackers.set_defaults(run=benchTrackers)
+
+    segments = commands.add_parser("segments",
+        help="time analysis in parallel segments on every song in a folder")
+    segments.add_argument("directory", nargs="?", default=Library.DIRECTORY)
+    segments.add_argument("--length", type=float,
+                          default=audio.SEGMENT_LENGTH,
+                          help="seconds per segment (default %.0f)" %
+                                audio.SEGMENT_LENGTH)
+    segments.add_argument("--workers", type=int, default=None,
+                          help="most workers to try (default one per core)")
+    segments.add_argument("--tracker", default="librosa",
+                          choices=sorted(TRACKERS),
+                          help="beat tracker (see trackers.py)")
+    segments.add_argument("--profile", default=audio.DEFAULT_PROFILE,
+                          choices=sorted(audio.PROFILES),
+                          help="analysis profile (see audio.PROFILES)")
+    segments.set_defaults(run=benchSegments)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import struct
+import hashlib
+import array
+import tempfile
+
+from collections import namedtuple
+
+#On-disk cache for beat analysis results. Entries are content-addressed: the
+#key is a hash of the audio file's bytes plus the analysis parameters, so
+#editing the file or changing a parameter simply produces a new key, and the
+#old entry ages out through LRU eviction.
+
+#Writes chunks (bytes) to path through a temporary file, so a crash (or
+#another process reading at the same time) never sees half a file. Makes
+#the directory if it isn't there. Every call gets a temporary file of its
+#own, since threads of the same process (the library, decoding, streaming)
+#can be writing the same path at once.
+def writeAtomic(path, *chunks):
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory or os.curdir,
+                prefix=os.path.basename(path) + ".", suffix=".tmp",
+                delete=False) as f:
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+#What one analysis run produces. Times and duration are in seconds.
+Analysis = namedtuple("Analysis", ["tempo", "beats", "times", "duration"])
+
+class AnalysisCache(object):
+    #Bump VERSION whenever the binary layout changes, old entries get ignored.
+    MAGIC = b"ABTC"
+    VERSION = 2
+    #magic, version, tempo, duration, number of beats
+    HEADER = struct.Struct("<4sHddI")
+    EXT = ".bin"
+    #Other files kept alongside analyses (see loadExtra()), which count
+    #towards maxBytes and get evicted the same way.
+    EXTRA_EXTS = (".chart",)
+    DIRECTORY = os.path.normpath("Cache/analysis")
+    #64 MB is thousands of songs worth of beat lists.
+    MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, directory=DIRECTORY, maxBytes=MAX_BYTES):
+        self.directory = os.path.normpath(directory)
+        self.maxBytes = maxBytes
+        #Hashing a whole song takes a while, so remember digests until the
+        #file's size or modification time changes.
+        self.digests = dict()
+
+    def fileDigest(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        known = self.digests.get(path)
+        if (known != None) and (known[0] == stamp):
+            return known[1]
+
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.digests[path] = (stamp, digest)
+        return digest
+
+    def key(self, path, params):
+        sha = hashlib.sha1(self.fileDigest(path).encode("ascii"))
+        #Sorted so that dict ordering never changes the key.
+        for name in sorted(params):
+            sha.update(("%s=%r;" % (name, params[name])).encode("utf-8"))
+        return sha.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key + AnalysisCache.EXT)
+
+    #Returns an Analysis, or None on a miss.
+    def load(self, key):
+        path = self.entryPath(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        entry = self.unpack(data)
+        if entry == None:
+            #Stale layout or truncated write, don't let it hang around.
+            self.discard(path)
+            return None
+
+        #Touching the entry is what makes eviction least-recently-used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, analysis):
+        self.write(self.entryPath(key), self.pack(analysis))
+
+    def write(self, path, data):
+        writeAtomic(path, data)
+        self.evict()
+
+    #Raw bytes stored under key with extension ext (one of EXTRA_EXTS), or
+    #None. For things derived from an analysis, like beat charts.
+    def loadExtra(self, key, ext):
+        path = os.path.join(self.directory, key + ext)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def storeExtra(self, key, ext, data):
+        self.write(os.path.join(self.directory, key + ext), data)
+
+    def pack(self, analysis):
+        header = AnalysisCache.HEADER.pack(AnalysisCache.MAGIC,
+                    AnalysisCache.VERSION, float(analysis.tempo),
+                    float(analysis.duration), len(analysis.beats))
+        frames = array.array("i", (int(frame) for frame in analysis.beats))
+        seconds = array.array("d", (float(time) for time in analysis.times))
+        return header + frames.tobytes() + seconds.tobytes()
+
+    def unpack(self, data):
+        size = AnalysisCache.HEADER.size
+        if len(data) < size:
+            return None
+        header = AnalysisCache.HEADER.unpack_from(data)
+        (magic, version, tempo, duration, count) = header
+        if (magic != AnalysisCache.MAGIC or
+                version != AnalysisCache.VERSION):
+            return None
+
+        frames = array.array("i")
+        seconds = array.array("d")
+        framesEnd = size + count * frames.itemsize
+        if len(data) != framesEnd + count * seconds.itemsize:
+            return None
+        frames.frombytes(data[size:framesEnd])
+        seconds.frombytes(data[framesEnd:])
+        return Analysis(tempo, list(frames), list(seconds), duration)
+
+    #Deletes least recently used entries until the cache fits in maxBytes.
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        exts = (AnalysisCache.EXT,) + AnalysisCache.EXTRA_EXTS
+        for name in names:
+            if not name.endswith(exts):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.maxBytes:
+                break
+            self.discard(path)
+            total -= size
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        exts = (AnalysisCache.EXT,) + AnalysisCache.EXTRA_EXTS
+        for name in os.listdir(self.directory):
+            if name.endswith(exts):
+                self.discard(os.path.join(self.directory, name))
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import platform
+import statistics
+
+import numpy
+import pygame
+
+from cache import writeAtomic
+
+#Measures how late this machine really is. A metronome plays, the player taps
+#along, and the average of how far each tap landed after its click is the
+#whole chain at once: mixer, sound card, speakers, input device and the
+#player's own reflexes. That replaces the estimated output latency in
+#PygameGame.getAudioDelay(), and is saved so it only has to be done once.
+
+#A click track made out of one sample. Every click is mixed into a single
+#Sound at an exact sample offset, so the clicks are evenly spaced whatever
+#the game loop is doing, and when each one plays is known to the sample.
+class Metronome(object):
+    SAMPLE = os.path.normpath("SFX/hit.ogg")
+
+    def __init__(self, bpm=90, clicks=28, path=SAMPLE):
+        (rate, size, channels) = pygame.mixer.get_init()
+        sample = pygame.sndarray.array(pygame.mixer.Sound(file=path))
+        #Mono mixers give a 1D array.
+        sample = sample.reshape(len(sample), -1).astype(numpy.int32)
+        spacing = int(round(rate * 60 / bpm))
+        starts = numpy.arange(clicks) * spacing
+        track = numpy.zeros((starts[-1] + len(sample), sample.shape[1]),
+                            dtype=numpy.int32)
+        for start in starts:
+            track[start:start + len(sample)] += sample
+        #SongPlayer.loadPcm() copies it into a Sound.
+        self.pcm = numpy.clip(track, -32768, 32767).astype(numpy.int16)
+        #Seconds between clicks, and when each click starts.
+        self.interval = spacing / rate
+        self.times = starts / rate
+
+#Matches taps to the clicks they were meant for and works out the latency.
+#The first few clicks are there to get into the rhythm, taps on them don't
+#count.
+class LatencyCalibrator(object):
+    TAPS = 16
+    WARMUP = 4
+    #Fewer taps than this (after outliers are gone) isn't worth saving.
+    MIN_TAPS = 8
+    #Taps further than this many deviations from the median are thrown out,
+    #e.g. a double tap or a missed click.
+    OUTLIER_LIMIT = 3.0
+    #Scales the median absolute deviation to a standard deviation.
+    MAD_SCALE = 1.4826
+
+    def __init__(self, times, interval, taps=TAPS, warmup=WARMUP):
+        self.times = times
+        self.interval = interval
+        self.taps = taps
+        self.warmup = warmup
+        #Seconds each counted tap was after its click, and which clicks have
+        #been tapped already.
+        self.offsets = []
+        self.tapped = set()
+
+    #t is where in the click track the tap arrived, in seconds. Returns how
+    #late it was, or None if it didn't count.
+    def tap(self, t):
+        #Taps are nearly always late, so a tap goes with the click up to
+        #three quarters of an interval before it, or the one a quarter
+        #interval after it for the odd early tap.
+        i = int(numpy.floor((t - self.times[0]) / self.interval + 0.25))
+        if (i < self.warmup) or (i >= len(self.times)) or (i in self.tapped):
+            return None
+        self.tapped.add(i)
+        offset = t - self.times[i]
+        self.offsets.append(offset)
+        return offset
+
+    def isDone(self):
+        return len(self.offsets) >= self.taps
+
+    #Returns a LatencyProfile, or None if there weren't enough good taps.
+    def getProfile(self, mixerBuffer):
+        kept = rejectOutliers(self.offsets, LatencyCalibrator.OUTLIER_LIMIT,
+                                LatencyCalibrator.MAD_SCALE)
+        if len(kept) < LatencyCalibrator.MIN_TAPS:
+            return None
+        return LatencyProfile(statistics.mean(kept),
+                                statistics.variance(kept),
+                                len(kept), len(self.offsets), mixerBuffer)
+
+#Drops values more than limit standard deviations from the median, with the
+#deviation estimated from the median absolute deviation so the outliers
+#themselves can't inflate it. Anything within a millisecond always stays.
+def rejectOutliers(values, limit, scale):
+    if len(values) == 0:
+        return []
+    median = statistics.median(values)
+    deviation = statistics.median([abs(v - median) for v in values]) * scale
+    bound = max(limit * deviation, 0.001)
+    return [v for v in values if abs(v - median) <= bound]
+
+#Name of this computer, for keeping calibrations apart when the same Cache
+#folder is used on more than one.
+def getMachine():
+    return "%s (%s)" % (platform.node(), platform.system())
+
+#A saved calibration: mean latency and its variance in seconds (squared),
+#how many taps went into it out of how many, and the mixer buffer size it
+#was measured with (a different buffer means a different latency).
+class LatencyProfile(object):
+    PATH = os.path.normpath("Cache/latency.json")
+
+    def __init__(self, latency, variance, kept, taps, mixerBuffer, date=None):
+        self.latency = latency
+        self.variance = variance
+        self.kept = kept
+        self.taps = taps
+        self.mixerBuffer = mixerBuffer
+        self.date = time.strftime("%Y-%m-%d %H:%M") if (date == None) else date
+
+    def getSpread(self):
+        return self.variance ** 0.5
+
+    def toDict(self):
+        return {"latency": self.latency, "variance": self.variance,
+                "kept": self.kept, "taps": self.taps,
+                "mixerBuffer": self.mixerBuffer, "date": self.date}
+
+    #This machine's profile, or None if it hasn't been calibrated.
+    @classmethod
+    def load(cls, path=PATH, machine=None):
+        machine = getMachine() if (machine == None) else machine
+        entry = readProfiles(path).get(machine)
+        if entry == None:
+            return None
+        try:
+            return cls(**entry)
+        except TypeError:
+            return None
+
+    #Saves this as the machine's profile, keeping everyone else's.
+    def save(self, path=PATH, machine=None):
+        machine = getMachine() if (machine == None) else machine
+        profiles = readProfiles(path)
+        profiles[machine] = self.toDict()
+        writeAtomic(path, json.dumps(profiles, indent=1,
+                                        sort_keys=True).encode("utf-8"))
+
+def readProfiles(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    return profiles if isinstance(profiles, dict) else dict()
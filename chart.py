@@ -0,0 +1,176 @@
+import io
+import random
+
+import numpy
+
+#A chart is every beat of a song laid out ahead of time: when it appears,
+#where, what color and which number it shows. Compiling it once before play
+#means the game loop only has to walk a cursor along some arrays, and since
+#the layout comes from one seeded random generator, saving the seed (or the
+#chart itself) is enough to replay exactly the same song.
+
+class Chart(object):
+    def __init__(self, seed=None):
+        self.seed = seed
+        #Beat times in seconds, when each beat should be hit.
+        self.times = numpy.zeros(0, dtype=numpy.float64)
+        self.xs = numpy.zeros(0, dtype=numpy.int32)
+        self.ys = numpy.zeros(0, dtype=numpy.int32)
+        #Index into the compiler's colors.
+        self.colors = numpy.zeros(0, dtype=numpy.int8)
+        self.ordinals = numpy.zeros(0, dtype=numpy.int8)
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, times, xs, ys, colors, ordinals):
+        self.times = numpy.concatenate((self.times, times))
+        self.xs = numpy.concatenate((self.xs, xs))
+        self.ys = numpy.concatenate((self.ys, ys))
+        self.colors = numpy.concatenate((self.colors, colors))
+        self.ordinals = numpy.concatenate((self.ordinals, ordinals))
+
+    #(time, x, y, color index, ordinal) of beat i.
+    def get(self, i):
+        return (float(self.times[i]), int(self.xs[i]), int(self.ys[i]),
+                int(self.colors[i]), int(self.ordinals[i]))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            self.write(f)
+
+    #Passing a file object also stops numpy from tacking on ".npz".
+    def write(self, f):
+        seed = -1 if (self.seed == None) else self.seed
+        numpy.savez(f, seed=numpy.int64(seed), times=self.times,
+                    xs=self.xs, ys=self.ys, colors=self.colors,
+                    ordinals=self.ordinals)
+
+    def toBytes(self):
+        f = io.BytesIO()
+        self.write(f)
+        return f.getvalue()
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as data:
+            seed = int(data["seed"])
+            chart = cls(None if (seed < 0) else seed)
+            chart.append(data["times"], data["xs"], data["ys"],
+                            data["colors"], data["ordinals"])
+        return chart
+
+    @classmethod
+    def fromBytes(cls, data):
+        return cls.load(io.BytesIO(data))
+
+#Lays beats out the way the game always has, but with all the randomness
+#drawn from one NumPy generator up front. Every beat takes the same five
+#numbers from the generator, so the layout only depends on the seed: laying
+#a song out in pieces (while it is still being analyzed) gives exactly the
+#same chart as doing it all at once.
+class ChartCompiler(object):
+    #Choices of color for beats: Red, Blue, Green, Orange
+    COLORS = [(255,0,0),(0,0,255),(24,226,24),(247,162,15)]
+    #Bump when the layout algorithm changes, so cached charts are redone.
+    VERSION = 2
+
+    def __init__(self, width, height, radius=50, minDist=100, maxDist=200,
+                    ordinalMax=4, colors=COLORS, seed=None):
+        (self.width, self.height) = (width, height)
+        self.r = radius
+        (self.minDist, self.maxDist) = (minDist, maxDist)
+        self.ordinalMax = ordinalMax
+        self.colors = colors
+        if seed == None:
+            seed = newSeed()
+        self.seed = seed
+        self.random = numpy.random.default_rng(seed)
+
+        self.prevX = None
+        self.prevY = None
+        #Color of the group of beats in progress, and how many beats have
+        #been laid out so far (which decides the ordinals).
+        self.color = None
+        self.count = 0
+        self.chart = Chart(seed)
+
+    #Everything that changes the layout, for caching charts.
+    def getParams(self):
+        return {"layout": ChartCompiler.VERSION, "seed": self.seed,
+                "size": (self.width, self.height), "r": self.r,
+                "dist": (self.minDist, self.maxDist),
+                "ordinalMax": self.ordinalMax, "colors": len(self.colors)}
+
+    #Lays out beats at times (seconds), adds them to the chart and returns it.
+    def extend(self, times):
+        count = len(times)
+        if count == 0:
+            return self.chart
+        #Columns: x sign, y sign, x distance, y distance, color change.
+        draws = self.random.random((count, 5))
+        xs = self.walk(draws[:, 0], draws[:, 2], self.prevX, self.width)
+        ys = self.walk(draws[:, 1], draws[:, 3], self.prevY, self.height)
+        (self.prevX, self.prevY) = (int(xs[-1]), int(ys[-1]))
+
+        index = self.count + numpy.arange(count)
+        ordinals = (index % self.ordinalMax) + 1
+        colors = self.layoutColors(index, draws[:, 4])
+        self.count += count
+
+        self.chart.append(numpy.asarray(times, dtype=numpy.float64), xs, ys,
+                            colors.astype(numpy.int8),
+                            ordinals.astype(numpy.int8))
+        return self.chart
+
+    def compile(self, times):
+        return self.extend(times)
+
+    #Positions along one axis. Biasing in effect here: if the previous beat
+    #is in the edge 1/4 of the screen, the next one is pushed towards the
+    #center, otherwise it goes either way at random. Each step depends on
+    #the last, so this is one cheap loop over numbers that were all drawn
+    #in advance.
+    def walk(self, signDraws, distDraws, prev, length):
+        signs = numpy.where(signDraws < 0.5, -1, 1)
+        span = self.maxDist - self.minDist + 1
+        steps = self.minDist + (distDraws * span).astype(numpy.int64)
+        (low, high) = (length // 4, 3 * (length // 4))
+
+        positions = numpy.zeros(len(steps), dtype=numpy.int32)
+        start = 0
+        if prev == None:
+            #Very first beat: anywhere, as long as it's fully on screen.
+            room = length - 2 * self.r + 1
+            prev = self.r + int(distDraws[0] * room)
+            positions[0] = prev
+            start = 1
+        for i in range(start, len(steps)):
+            if prev < low: sign = 1
+            elif prev > high: sign = -1
+            else: sign = signs[i]
+            prev = prev + sign * steps[i]
+            positions[i] = prev
+        return positions
+
+    #Beats come in groups of ordinalMax, each group a different color from
+    #the one before. Adding 1 to (number of colors - 1) to the previous color
+    #(mod the number of colors) picks uniformly among the other colors, and
+    #turns the whole sequence into a cumulative sum.
+    def layoutColors(self, index, draws):
+        choices = len(self.colors)
+        starts = (index % self.ordinalMax) == 0
+        offsets = 1 + (draws * (choices - 1)).astype(numpy.int64)
+        if self.color == None:
+            #The first group can be any color at all.
+            offsets[0] = int(draws[0] * choices)
+            previous = 0
+        else:
+            previous = self.color
+        colors = (previous + numpy.cumsum(numpy.where(starts, offsets, 0)))
+        colors %= choices
+        self.color = int(colors[-1])
+        return colors
+
+def newSeed():
+    return random.randrange(1 << 31)
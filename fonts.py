@@ -0,0 +1,81 @@
+import os
+import pygame
+
+from collections import OrderedDict
+
+#Shared fonts and rendered text. Loading a TTF and rendering a string are
+#both slow enough to show up in a frame, and the HUD and score screen draw
+#the same few strings over and over, so everything here is cached.
+
+#Fonts downloaded from http://google.com/fonts. Most text is in TEXT_FONT,
+#the score, combo and timing counters in HUD_FONT on a HUD_BACKGROUND box.
+TEXT_FONT = os.path.normpath("Fonts/Nunito-Regular.ttf")
+HUD_FONT = os.path.normpath("Fonts/Rubik-Italic.ttf")
+HUD_COLOR = (255, 255, 255, 0)
+HUD_BACKGROUND = (77, 119, 182, 0)
+
+#(path, size) -> pygame.font.Font. None as the path is pygame's default font.
+fonts = dict()
+
+def getFont(path, size):
+    if path != None:
+        path = os.path.normpath(path)
+    key = (path, size)
+    if key not in fonts:
+        fonts[key] = pygame.font.Font(path, size)
+    return fonts[key]
+
+#Least recently used cache of rendered text surfaces. The score changes all
+#the time, so this has to be bounded.
+class TextCache(object):
+    def __init__(self, maxSize=256):
+        self.maxSize = maxSize
+        self.surfaces = OrderedDict()
+
+    def render(self, path, size, text, color, background=None):
+        key = (path, size, text, tuple(color),
+                None if (background == None) else tuple(background))
+        surface = self.surfaces.get(key)
+        if surface != None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        font = getFont(path, size)
+        if background == None:
+            surface = font.render(text, 1, color)
+        else:
+            surface = font.render(text, 1, color, background)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.maxSize:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+textCache = TextCache()
+
+def renderText(path, size, text, color, background=None):
+    return textCache.render(path, size, text, color, background)
+
+#Top left corner for a width x height box anchored at (x, y). anchor is one
+#of "nw", "ne", "sw", "se" or "center".
+def anchorPoint(x, y, width, height, anchor="nw"):
+    if (anchor == "nw"):
+        return (x, y)
+    elif (anchor == "ne"):
+        return (x - width, y)
+    elif (anchor == "sw"):
+        return (x, y - height)
+    elif (anchor == "se"):
+        return (x - width, y - height)
+    elif (anchor == "center"):
+        return (x - width//2, y - height//2)
+
+#Draws text straight onto target, for text that doesn't need to be a sprite.
+#Returns the rect that was drawn to.
+def blitText(target, path, size, text, x, y, anchor="nw",
+                color=(255, 255, 255), background=None):
+    surface = renderText(path, size, text, color, background)
+    (width, height) = surface.get_size()
+    return target.blit(surface, anchorPoint(x, y, width, height, anchor))
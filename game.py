@@ -1,15 +1,32 @@
+import time
+#When the game was launched, for the startup report (see StartupTimer).
+LAUNCHED = time.perf_counter()
+
 import pygame
 import os
 import random
-import time
+import statistics
+import threading
+import multiprocessing
 #Eztext creates text input for pygame. 
 #Adapted from: http://pygame.org/project-EzText-920-.html
 #Edits were made by myself, details in eztext.py
 import eztext
 
-from sprites import Beat, MousePointer, Text, StText, Button
-from audio import Song, Sound
-from collections import deque
+from sprites import BeatAtlas, BeatField, HitMarkers, Button
+from audio import Song, Sound, SongPlayer, warmUp
+from fonts import getFont, blitText, TEXT_FONT, HUD_FONT, HUD_COLOR
+from fonts import HUD_BACKGROUND
+from library import Library, createPool
+from profiler import FrameProfiler, StartupTimer
+from timing import SongClock, FrameScheduler, EventStamper
+from chart import Chart, ChartCompiler, newSeed
+from hittest import HitGrid
+from assets import getImage
+from scoring import Scorer, APPROACH, WINDOW_WIDTH, STEP, ANY_BEAT
+from replay import Replay, toMicroseconds, fromMicroseconds, getChartDigest
+from calibration import Metronome, LatencyCalibrator, LatencyProfile
+from concurrent.futures import ProcessPoolExecutor
 
 #OOP Pygame framework adapted from:
 #http://blog.lukasperaza.com/getting-started-with-pygame/
@@ -28,6 +45,9 @@ os.environ['SDL_VIDEO_CENTERED'] = '1'
 class PygameGame(object):
     def __init__(self, width=1500, height=850,fps=60, 
                     title="My Game"):
+        #Printed once the menu is up, see menuLoop().
+        self.startup = StartupTimer(LAUNCHED)
+        self.startup.mark("imports")
         (self.width, self.height) = (width, height)
         self.fps = fps
         self.title = title
@@ -41,38 +61,102 @@ class PygameGame(object):
         #Create an event that will trigger when the song finishes.
         self.PLAYBACK_END = pygame.USEREVENT + 1
 
-        #Global delay of 450ms seems the best, as there is a noticeable delay
-        #in pygame audio otherwise.
-        #Need to start time a second early because we add a beat a second early.
-        self.audioDelay = -1.45
+        #Songs that were decoded along with their analysis play from memory
+        #(see SongPlayer), which saves decoding them a second time and has
+        #far less latency than streaming them with mixer.music.
+        self.preDecode = True
+        #Mixer buffer in samples. Smaller means less latency, but too small
+        #and the audio crackles.
+        self.mixerBuffer = 512
+        self.player = SongPlayer()
+        #Need to start time a second early because we add a beat a second
+        #early, plus however late the audio is heard, see getAudioDelay().
+        self.audioDelay = self.getAudioDelay()
         self.timeElapsed = 0 + self.audioDelay
+        #During a song, timeElapsed comes from the music's playback position
+        #(plus audioDelay) rather than from adding up frame times.
+        self.songClock = SongClock(getPos=self.player.getPos,
+                                    latency=self.audioDelay)
+        #The game itself moves in fixed steps of simStep seconds whatever the
+        #frame rate, and simTime is how far it has got (see simulate()).
+        self.simStep = STEP
+        self.simTime = self.timeElapsed
+        self.simSteps = 0
+        self.scheduler = FrameScheduler(fps)
+        #Inputs during a song are timestamped when they arrive and judged at
+        #that point of the song, not at the frame that handles them.
+        self.inputs = EventStamper()
+        #Menus, the score screen and the pause screen only change when
+        #something happens, so they sleep until there's input (see
+        #waitForEvents()) and are drawn from frames composed once (see
+        #getFrame()). idleShown is the one on screen, if any.
+        self.idleTimeout = 1.0
+        self.frames = dict()
+        self.idleShown = None
+        self.idleDirty = False
         #We want the game to end a bit after the song playback ends, so we add
         #a delayed end timer
         self.endDelay = 2.0
         self.countdown = None
 
-        #Preinitializing with this buffer value helps with audio lag.
-        pygame.mixer.pre_init(buffer=1024)
+        #Song analysis runs in here, see getAnalysisPool().
+        self.analysisPool = None
+        #Songs longer than this (in seconds) that haven't been analyzed yet
+        #are split into segments analyzed on every spare core at once (see
+        #audio.SEGMENT_LENGTH and getIndexPool()), or streamed where there's
+        #at most one core to spare, so they start sooner.
+        self.streamLength = 300
+        self.parallelAnalysis = True
+        #See audio.PROFILES and trackers.TRACKERS.
+        self.analysisProfile = "accurate"
+        self.beatTracker = "librosa"
+        #Gets librosa ready in the background while the menu is up, so the
+        #first song doesn't wait for it (see startWarmUp()).
+        self.warmUp = True
+        self.warmUpStarted = False
+        #Frame timings, F3 during a song shows them.
+        self.profiler = FrameProfiler()
+        #Built-in songs are analyzed ahead of time, see initLibrary().
+        self.library = Library(profile=self.analysisProfile,
+                                tracker=self.beatTracker)
+        self.indexPool = None
+
+        pygame.mixer.pre_init(frequency=44100, buffer=self.mixerBuffer)
         pygame.mixer.init()
+        #Tapping along to a metronome measures the real latency, see
+        #startCalibration(). It's kept per machine, and makes estimating it
+        #unnecessary. That's done once the menu is up, see startMeasure().
+        self.useLatencyProfile(LatencyProfile.load())
+        self.measureThread = None
+        self.startup.mark("mixer")
         self.initSounds()
         pygame.display.set_icon(self.icon)
         pygame.init()
         pygame.font.init()
+        self.startup.mark("setup")
 
     def initTracking(self):
-        self.combo = 0
-        self.maxCombo = 0
-        self.score = 0
-        self.prevAddition = 0
         self.lastBeatHit = (0, 0)
-        self.hits = pygame.sprite.Group()
+        #Score and miss markers. Like the beats, they report what they drew,
+        #see songLoopUpdate().
         self.hitKill = 0.5
+        self.hits = HitMarkers(self.hitKill)
+        #When the input being handled arrived, as time.perf_counter() and as
+        #a song position (None if unknown).
+        self.eventArrival = time.perf_counter()
+        self.eventSongTime = None
+        #Seconds each hit was off from perfect, negative when early.
+        self.hitErrors = []
+        #Every click of the song being played, see startSong().
+        self.replay = None
 
     def initModes(self):
         self.inGame = True
         self.inMenu = True
         self.songSelect = False
+        self.loading = False
         self.instructions = False
+        self.calibrating = False
         self.playSong = False
         self.scoreScreen = False
         self.paused = False
@@ -83,22 +167,14 @@ class PygameGame(object):
         pygame.scrap.init()
 
         #Menu picture from: https://goo.gl/bwppX2
-        path = "Pictures/menu.png"
-        path = os.path.normpath(path)
-        self.menu = pygame.image.load(path)
-        self.menu.convert()
+        self.menu = getImage("Pictures/menu.png", alpha=False)
         self.menuButtons = pygame.sprite.Group()
         self.initMenuButtons()
 
-        path = "Pictures/loading.png"
-        path = os.path.normpath(path)
-        self.loadScreen = pygame.image.load(path)
-        self.loadScreen.convert()
-
-        path = "Pictures/paused.png"
-        path = os.path.normpath(path)
-        self.pauseScreen = pygame.image.load(path)
-        self.pauseScreen.convert()
+        #Loaded when they're first shown, see assets.getImage().
+        self.loadScreenPath = "Pictures/loading.png"
+        self.pauseScreenPath = "Pictures/paused.png"
+        self.calibrateRect = None
 
     def initMenuButtons(self):
         (logoX, logoY) = (50, 275)
@@ -119,6 +195,7 @@ class PygameGame(object):
         logo.add(self.menuButtons)
         self.playButton.add(self.menuButtons)
         self.howToButton.add(self.menuButtons)
+        self.menuTargets = self.getTargets([self.playButton,self.howToButton])
 
     def initMenuMusic(self):
         #Menu music taken from: http://www.newgrounds.com/audio/listen/438759
@@ -130,67 +207,226 @@ class PygameGame(object):
 
     def initBeats(self):
         self.r = 50
-        self.beats = pygame.sprite.Group()
-
-        #Having a separate queue allows for indexing (so we can pull the most
-        #recent beat)
-        self.beatQueue = deque()
 
         #Choices of color for beats: Red, Blue, Green, Orange
-        self.colorChoices = [(255,0,0),(0,0,255),(24,226,24),(247,162,15)]
-        self.beatColor = (0, 0, 0)
-        self.shuffleColor()
+        self.colorChoices = ChartCompiler.COLORS
+        #Every beat on screen, oldest first (see BeatField).
+        self.beats = BeatField(self.colorChoices)
+        #Lets any beat under the cursor be hit, not just the oldest one.
+        self.anyBeat = ANY_BEAT
 
-        #Needed in order to properly randomize beat positions.
-        self.prevX = None
-        self.prevY = None
+        #Beat layout, see ChartCompiler.
         self.maxDist = 200
         self.minDist = 100
-        self.beatNum = 1
         self.beatNumMax = 4
+        #The same seed always lays a song out the same way. Unless the seed is
+        #locked (click it on song select), a new one is picked after each song.
+        self.chartSeed = newSeed()
+        self.lockSeed = False
+        self.seedRect = None
+        self.chart = None
+        self.compiler = None
+        #Index of the next beat in the chart to appear.
+        self.chartCursor = 0
 
         self.initBeatTiming()
-        self.initScoring()
-
-    def initScoring(self):
-        self.scoreBad = 50
-        self.scoreGood = 100
-        self.scorePerfect = 300
-
-        self.misses = 0
-        self.bads = 0
-        self.goods = 0
-        self.perfects = 0
 
     def initBeatTiming(self):
         #Beats appear a second early (beatApproach), and the width between the
-        #different scores is dictated by windowWidth.
-        self.beatApproach = 1.0
-        self.windowWidth = 0.06
-
-        self.goodLate = self.beatApproach + self.windowWidth
-        self.badLate = self.goodLate + self.windowWidth
-        self.missLate = self.badLate + self.windowWidth
-        self.beatKill = self.missLate + self.windowWidth
-
-        self.perfectEarly = self.beatApproach - self.windowWidth
-        self.goodEarly = self.perfectEarly - self.windowWidth
-        self.badEarly = self.goodEarly - self.windowWidth
-        self.missEarly = self.badEarly - self.windowWidth
-
+        #different scores is dictated by windowWidth. The Scorer works out
+        #the windows, and keeps the score.
+        self.beatApproach = APPROACH
+        self.windowWidth = WINDOW_WIDTH
+        self.scorer = Scorer(self.beatApproach, self.windowWidth)
+        self.beatKill = self.scorer.kill
+
+    #Kicks off analysis in the background, startSong() finishes the job once
+    #the beats are ready.
     def initSong(self, path):
-        self.songPath = os.path.normpath(self.songPath)
-
-        startTime = time.time()
-        self.song = Song(self.songPath)
-        self.times = self.song.getBeatTimes()
-        self.nextBeat = self.times.pop(0)
-        pygame.mixer.music.load(self.songPath)
-        endTime = time.time()
-        
-        loadTime = abs(endTime - startTime)
-        #Necessary offset, or else song and game go out of sync.
-        self.timeElapsed -= loadTime
+        self.songPath = os.path.normpath(path)
+        self.song = Song(self.songPath, lazy=True,
+                            profile=self.analysisProfile,
+                            tracker=self.beatTracker)
+        song = self.song
+        if song.isCached("full") or (song.probeDuration() < self.streamLength):
+            song.analyzeAsync(self.getAnalysisPool(), self.preDecode)
+        elif song.canStream() and song.isCached("stream"):
+            #Streamed before, its beats are all there now.
+            song.analyzeAsync(self.getAnalysisPool(), self.preDecode, "stream")
+        elif self.parallelAnalysis and ((os.cpu_count() or 1) > 2):
+            song.analyzeSegmented(self.getIndexPool(), self.preDecode)
+        elif song.canStream():
+            song.analyzeStreaming()
+        else:
+            song.analyzeAsync(self.getAnalysisPool(), self.preDecode)
+        self.loadStart = time.time()
+
+    #chart replays a saved layout instead of compiling a new one.
+    def startSong(self, chart=None):
+        self.song.collect()
+        #While streaming, this list keeps growing as the rest of the song is
+        #analyzed, and gameTimerFired() compiles the new beats as they come.
+        self.times = self.song.subscribe()
+        if chart == None:
+            self.compileChart()
+        else:
+            (self.compiler, self.chart) = (None, chart)
+        self.chartCursor = 0
+        self.player.load(self.song)
+        self.finishMeasure()
+        self.audioDelay = self.getAudioDelay()
+        self.songClock.latency = self.audioDelay
+        self.timeElapsed = self.simTime = self.audioDelay
+        self.simSteps = 0
+        self.startReplay()
+        BeatAtlas.build(self.colorChoices, range(1, self.beatNumMax + 1))
+        self.fullRedraw = True
+
+    #Records every click from here on, see replay.py. Everything the replay
+    #needs to lay the song out and judge it again goes in its header. The
+    #chart's digest waits for finishReplay(): a streamed song's chart only
+    #has the beats found so far.
+    def startReplay(self):
+        digest = self.song.cache.fileDigest(self.song.getPath())
+        layout = (self.width, self.height, self.r, self.minDist,
+                    self.maxDist, self.beatNumMax, len(self.colorChoices))
+        self.replay = Replay(digest, None,
+                        self.chart.seed, self.simTime, self.simStep, layout,
+                        self.analysisProfile, self.beatApproach,
+                        self.windowWidth, BeatField.START_CLOCK,
+                        BeatField.HIT_RADIUS, self.anyBeat,
+                        self.song.tracker, self.song.mode)
+
+    #Beats streamed in since the last step still go in the chart, so that it
+    #is the one replay.verify() builds from the whole analysis.
+    def finishReplay(self):
+        if (self.compiler != None) and (len(self.times) > len(self.chart)):
+            self.compiler.extend(self.times[len(self.chart):])
+        self.replay.chartDigest = getChartDigest(self.chart)
+        self.replay.finish(self.simSteps, self.scorer.getResults())
+        return self.replay
+
+    #How far the game clock runs behind the song: beats appear beatApproach
+    #early, and the song is heard the player's audio latency late (measured
+    #if they calibrated, estimated by SongPlayer if not).
+    def getAudioDelay(self):
+        return -(self.beatApproach + self.player.getLatency())
+
+    #Uses profile's latency from now on, unless it was measured with a
+    #different mixer buffer (which changes the latency).
+    def useLatencyProfile(self, profile):
+        if (profile != None) and (profile.mixerBuffer != self.mixerBuffer):
+            profile = None
+        self.latencyProfile = profile
+        if profile == None:
+            self.player.calibratedLatency = None
+        else:
+            self.player.calibratedLatency = profile.latency
+        self.audioDelay = self.getAudioDelay()
+        #The menu shows the calibration.
+        self.frames.pop("menu", None)
+
+    #Lays the song out with chartSeed. Charts are cached next to the song's
+    #analysis, so playing the same song with the same seed again doesn't
+    #redo the layout.
+    def compileChart(self):
+        self.compiler = ChartCompiler(self.width, self.height, self.r,
+                            self.minDist, self.maxDist, self.beatNumMax,
+                            self.colorChoices, self.chartSeed)
+        if self.song.isStreaming():
+            #Only part of the song is known, the rest is laid out as it comes.
+            self.chart = self.compiler.compile(self.times)
+            return
+        key = self.song.getCacheKey(self.compiler.getParams())
+        data = self.song.cache.loadExtra(key, ".chart")
+        if data != None:
+            try:
+                (self.compiler, self.chart) = (None, Chart.fromBytes(data))
+                return
+            except Exception:
+                pass
+        self.chart = self.compiler.compile(self.times)
+        self.song.cache.storeExtra(key, ".chart", self.chart.toBytes())
+
+    def getAnalysisPool(self):
+        #Created on first use, so that the worker (and its librosa import)
+        #doesn't slow down getting to the menu.
+        if self.analysisPool == None:
+            #Spawn rather than fork, a forked copy of a running SDL app is
+            #asking for trouble (and spawn is what Windows does anyway).
+            context = multiprocessing.get_context("spawn")
+            self.analysisPool = ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=context)
+        return self.analysisPool
+
+    #Indexes the library (see initLibrary()) and analyzes long songs a
+    #segment per worker (see initSong()).
+    def getIndexPool(self):
+        if self.indexPool == None:
+            #Leave a core free so the menus stay smooth.
+            workers = max(1, (os.cpu_count() or 2) - 1)
+            self.indexPool = createPool(workers)
+        return self.indexPool
+
+    #Runs audio.warmUp() in the analysis worker, which gets started for it,
+    #and prints the timings once it's done. Never in this process: librosa
+    #would be imported here after all, and numba compiling while a song
+    #plays costs frames. Songs that are streamed (see initSong()) do import
+    #it here when they start, but the worker leaves librosa's compiled
+    #kernels in NUMBA_CACHE_DIR for them, which is most of what that costs.
+    #Only librosa needs warming up, the other trackers are plain NumPy.
+    def startWarmUp(self):
+        self.warmUpStarted = True
+        if self.beatTracker != "librosa":
+            return
+        worker = self.getAnalysisPool().submit(warmUp)
+        worker.add_done_callback(self.reportWarmUp)
+
+    #Estimates the output latency (see audio.measureOutputLatency()) on a
+    #thread, when there's no calibration to go by. It plays a few short
+    #sounds one after the other, which would hold up the menu for a good
+    #part of startup, and it's only needed once a song starts.
+    def startMeasure(self):
+        self.measureThread = threading.Thread(target=self.measureLatency,
+                                                daemon=True)
+        self.measureThread.start()
+
+    def measureLatency(self):
+        timer = StartupTimer(title="Latency: %.0f ms estimating it while "
+                                    "the menu is up")
+        self.player.measure(self.mixerBuffer)
+        timer.mark("measure")
+        print(timer.report())
+
+    #Songs and the calibration wait for the estimate, the first one might
+    #come along before it's done.
+    def finishMeasure(self):
+        if self.measureThread != None:
+            self.measureThread.join()
+
+    def reportWarmUp(self, worker):
+        try:
+            timer = worker.result()
+        except Exception:
+            #Cancelled when quitting, or the worker died (which the first
+            #song will report).
+            return
+        timer.title = "Warm-up: %.0f ms in the analysis worker"
+        print(timer.report())
+
+    #Surfaces for drawing the game itself, which only updates the parts of
+    #the screen that changed (see songLoopUpdate()).
+    def initSongRender(self):
+        BLACK = (0, 0, 0)
+        self.background = pygame.Surface((self.width, self.height)).convert()
+        self.background.fill(BLACK)
+        #The end of song fade reuses this every frame.
+        self.fadeOut = pygame.Surface((self.width, self.height)).convert()
+        self.fadeOut.fill(BLACK)
+        #Where the score and combo were drawn last frame.
+        self.hudRects = []
+        self.fullRedraw = True
+        self.pauseDrawn = False
 
     def initSounds(self):
         #Hit sound from:
@@ -221,6 +457,7 @@ class PygameGame(object):
         howToPlay.add(self.howToItems)
         howToHeader.add(self.howToItems)
         self.toMenu.add(self.howToItems)
+        self.howToTargets = self.getTargets([self.toMenu])
 
     def initSongSelect(self):
         self.songSelItems = pygame.sprite.Group()
@@ -268,6 +505,14 @@ class PygameGame(object):
         self.feelgoodBox = Button(goodPath, x, y5, width, height)
         self.feelgoodBox.add(self.songSelItems)
 
+        #Which song each box plays.
+        self.songBoxes = [(self.badAppleBox, "Songs/Bad Apple.mp3"),
+                          (self.bonetrousleBox, "Songs/Bonetrousle.ogg"),
+                          (self.dummyBox, "Songs/Dummy!.ogg"),
+                          (self.megalovaniaBox, "Songs/MEGALOVANIA.ogg"),
+                          (self.rhinestoneBox, "Songs/Rhinestone Eyes.ogg"),
+                          (self.feelgoodBox, "Songs/Feel Good Inc.ogg")]
+
         self.backSmallGrp = pygame.sprite.GroupSingle()
         (width, height) = (175, 175)
         (x, y) = (50, self.height - 50 - height)
@@ -278,9 +523,21 @@ class PygameGame(object):
         self.initError()
         self.initTextClear()
 
+        buttons = list(self.songSelItems) + [self.clearText, self.backSmall]
+        self.songSelTargets = self.getTargets(buttons)
+        self.loadingTargets = self.getTargets([self.backSmall])
+
+    #Clicks are looked up in a HitGrid per screen (see mousePressed()), with
+    #the buttons themselves as keys.
+    def getTargets(self, buttons):
+        targets = HitGrid()
+        for button in buttons:
+            targets.addRect(button, button.rect)
+        return targets
+
     def initInput(self):
         menuFont = "Fonts/SourceCodePro-Regular.ttf"
-        font = pygame.font.Font(menuFont, 25)
+        font = getFont(menuFont, 25)
         textColor = (217, 230, 255)
         self.usrSong = eztext.Input(color=textColor, maxlength=50, x=70, 
             y=150, font=font)
@@ -301,17 +558,34 @@ class PygameGame(object):
         self.clearText = Button(path, x, y, width, height)
         self.clearText.add(self.clearTextGrp)
 
+    #Analyzes everything in Songs/ in the background while the player is in
+    #the menus, so song select can show BPM and length, and picking a song
+    #is just a cache hit.
+    def initLibrary(self):
+        self.library.load()
+        self.library.buildAsync(self.getIndexPool())
+
     def run(self):
         clock = pygame.time.Clock()
         self.screen = pygame.display.set_mode((self.width, self.height))
         pygame.display.set_caption(self.title)
+        self.startup.mark("display")
         self.initMenu()
+        self.startup.mark("menu")
         self.initHowTo()
         self.initSongSelect()
+        self.initSongRender()
+        self.startup.mark("screens")
+        self.initLibrary()
+        self.startup.mark("library")
 
         while self.inGame:
             self.mainLoop(clock)
 
+        self.library.cancel()
+        for pool in (self.analysisPool, self.indexPool):
+            if pool != None:
+                pool.shutdown(wait=False, cancel_futures=True)
         pygame.font.quit()
         pygame.mixer.quit()
         pygame.quit()
@@ -329,12 +603,21 @@ class PygameGame(object):
         while self.instructions:
             self.instructionLoop(clock)
 
+        while self.calibrating:
+            self.calibrationLoop(clock)
+
         while self.songSelect:
             self.songSelectLoop(clock)
 
+        while self.loading:
+            self.loadingLoop(clock)
+
         if self.playSong:
-            pygame.mixer.music.play()
-            pygame.mixer.music.set_endevent(self.PLAYBACK_END)
+            self.player.play(self.PLAYBACK_END)
+            self.songClock.start()
+            self.scheduler.reset()
+            self.inputs.clear()
+            self.profiler.reset()
 
         while self.playSong:
             self.songLoop(clock)
@@ -349,13 +632,17 @@ class PygameGame(object):
         self.mainLoopUpdate()
 
     def menuLoop(self, clock):
-        clock.tick(self.fps)
+        self.library.poll()
 
-        self.screen.blit(self.menu, (0, 0))
-        self.menuButtons.draw(self.screen)
-        pygame.display.flip()
+        self.showIdle("menu", self.getFrame("menu", self.composeMenu))
+        if not self.startup.finished:
+            print(self.startup.finish("first frame"))
+        if self.warmUp and (not self.warmUpStarted):
+            self.startWarmUp()
+        if (self.latencyProfile == None) and (self.measureThread == None):
+            self.startMeasure()
 
-        for event in pygame.event.get():
+        for event in self.waitForEvents():
             if event.type == pygame.QUIT:
                 self.inGame = False
                 self.inMenu = False
@@ -364,13 +651,9 @@ class PygameGame(object):
                 self.mousePressed()
 
     def instructionLoop(self, clock):
-        clock.tick(self.fps)
+        self.showIdle("howTo", self.getFrame("howTo", self.composeHowTo))
 
-        self.screen.blit(self.menu, (0, 0))
-        self.howToItems.draw(self.screen)
-        pygame.display.flip()
-
-        for event in pygame.event.get():
+        for event in self.waitForEvents():
             if event.type == pygame.QUIT:
                 self.inGame = False
                 self.instructions = False
@@ -383,17 +666,51 @@ class PygameGame(object):
                     (event.button == 1)):
                 self.mousePressed()
 
-    def songSelectLoop(self, clock):
-        clock.tick(self.fps)
+    #Paced like a song, so taps are timestamped as precisely.
+    def calibrationLoop(self, clock):
+        self.scheduler.wait(self.inputs.poll)
 
-        events = pygame.event.get()
+        for (arrival, event) in self.inputs.get():
+            if event.type == pygame.QUIT:
+                self.inGame = False
+                self.player.stop()
+                self.calibrating = False
+            elif event.type == self.PLAYBACK_END:
+                if not self.calibrationDone:
+                    self.finishCalibration()
+            elif event.type == pygame.KEYDOWN:
+                if (event.key == pygame.K_ESCAPE):
+                    self.soundMiss.play()
+                    self.stopCalibration()
+                elif self.calibrationDone:
+                    if (event.key == pygame.K_RETURN):
+                        self.startCalibration()
+                elif event.key in (pygame.K_z, pygame.K_x, pygame.K_SPACE):
+                    self.calibrationTap(arrival)
+            elif ((event.type == pygame.MOUSEBUTTONDOWN) and
+                    (event.button == 1) and (not self.calibrationDone)):
+                self.calibrationTap(arrival)
 
-        self.songSelUpdate(events)
+        if self.calibrating:
+            if (not self.calibrationDone) and self.calibrator.isDone():
+                self.finishCalibration()
+            self.calibrationUpdate()
 
-        if self.error:
-            self.oops.draw(self.screen)
+    def songSelectLoop(self, clock):
+        #Song info shows up as songs get indexed.
+        indexed = len(self.library.entries)
+        self.library.poll()
+        if len(self.library.entries) != indexed:
+            self.idleDirty = True
 
-        pygame.display.flip()
+        frame = self.getFrame("songSelect", self.composeSongSelect)
+        self.showIdle("songSelect", frame, self.songSelUpdate)
+
+        events = self.waitForEvents()
+        self.usrSong.update(events)
+        #Held down, backspace deletes without any events coming in.
+        if pygame.key.get_pressed()[pygame.K_BACKSPACE]:
+            self.idleDirty = True
 
         for event in events:
             if event.type == pygame.QUIT:
@@ -408,20 +725,59 @@ class PygameGame(object):
                     (event.button == 1)):
                 self.mousePressed()
 
+    #Keeps the window alive while the song is analyzed in the background.
+    def loadingLoop(self, clock):
+        clock.tick(self.fps)
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.inGame = False
+                self.cancelLoading()
+            elif event.type == pygame.KEYDOWN:
+                if (event.key == pygame.K_ESCAPE):
+                    self.soundMiss.play()
+                    self.cancelLoading()
+            elif ((event.type == pygame.MOUSEBUTTONDOWN) and
+                    (event.button == 1)):
+                self.mousePressed()
+
+        if self.loading and self.song.isReady():
+            self.finishLoading()
+
+        if self.loading:
+            self.loadingUpdate()
+
     def songLoop(self, clock):
-        #tick_busy_loop is more expensive (more accurate too) than just
-        #clock.tick, but this is necessary in a rhythm game.
-        tick = clock.tick_busy_loop(self.fps) / 1000 #Convert to seconds
+        self.profiler.startFrame()
+        #Sleeps most of the frame and only spins for the last moment, see
+        #FrameScheduler. tick is wall time, for things that aren't synced
+        #to the music.
+        if self.paused:
+            #The pause screen is drawn once (see songLoopUpdate()), nothing
+            #needs doing until a key unpauses. The fade out waits too.
+            self.inputs.wait(self.idleTimeout)
+            self.scheduler.reset()
+            tick = 0
+        else:
+            tick = self.scheduler.wait(self.inputs.poll)
+        self.profiler.mark("tick")
         if not self.paused:
-            pygame.mixer.music.unpause()
-            self.timeElapsed += tick
-            self.gameTimerFired(self.timeElapsed, tick)
+            self.player.unpause()
+            self.songClock.resume()
+            self.simulate(self.songClock.position())
 
-        for event in pygame.event.get():
+        for (arrival, event) in self.inputs.get():
+            self.eventArrival = arrival
+            if self.paused:
+                self.eventSongTime = None
+            else:
+                self.eventSongTime = self.songClock.at(arrival)
             self.actEvent(event)
+        self.profiler.mark("events")
 
         if self.paused:
-            pygame.mixer.music.pause()
+            self.player.pause()
+            self.songClock.pause()
 
         if self.countdown != None:
             self.countdown -= tick
@@ -430,14 +786,28 @@ class PygameGame(object):
                 self.scoreScreen = True
 
         self.songLoopUpdate()
+        self.profiler.endFrame(self.getAudioDrift())
+
+        if self.scoreScreen:
+            name = os.path.splitext(os.path.basename(self.songPath))[0]
+            self.profiler.dump(name)
+            self.finishReplay().dump(name)
+
+    #How far ahead of the music the game clock is, in seconds. None when
+    #there is nothing to compare against.
+    def getAudioDrift(self):
+        position = self.player.getPos()
+        if self.paused or (position < 0):
+            return None
+        return (self.timeElapsed - self.audioDelay) - position / 1000
 
     def scoreScreenLoop(self, clock):
-        clock.tick(self.fps)
-
         if not pygame.mixer.music.get_busy():
                 self.initMenuMusic()
 
-        for event in pygame.event.get():
+        self.showIdle("score", self.getFrame("score", self.composeScore))
+
+        for event in self.waitForEvents():
             if event.type == pygame.QUIT:
                 self.inGame = False
                 self.scoreScreen = False
@@ -451,43 +821,218 @@ class PygameGame(object):
                     (event.button == 1)):
                 self.mousePressed()
 
+    #Waits (up to idleTimeout) for input and returns it. Songs still being
+    #indexed need polling, and eztext repeats a held backspace every frame,
+    #so those wait a frame at most.
+    def waitForEvents(self):
+        timeout = self.idleTimeout
+        if ((len(self.library.pending) > 0) or
+                pygame.key.get_pressed()[pygame.K_BACKSPACE]):
+            timeout = 1 / self.fps
+        self.inputs.wait(timeout)
+        events = [event for (arrival, event) in self.inputs.get()]
+        #Only the mouse moving changes nothing on these screens.
+        if any((event.type != pygame.MOUSEMOTION) for event in events):
+            self.idleDirty = True
+        return events
+
+    #Frame name, composing it with compose() (which draws on the screen) if
+    #there isn't one yet.
+    def getFrame(self, name, compose):
+        frame = self.frames.get(name)
+        if frame == None:
+            compose()
+            frame = self.frames[name] = self.screen.copy()
+        return frame
+
+    #Puts idle screen name up, unless it's already there and nothing has
+    #happened. overlay() draws whatever changes on top of frame.
+    def showIdle(self, name, frame, overlay=None):
+        if (self.idleShown == name) and (not self.idleDirty):
+            return
+        self.screen.blit(frame, (0, 0))
+        if overlay != None:
+            overlay()
+        pygame.display.flip()
+        (self.idleShown, self.idleDirty) = (name, False)
+
+    def composeMenu(self):
+        self.screen.blit(self.menu, (0, 0))
+        self.menuButtons.draw(self.screen)
+        self.printCalibration()
+
+    def composeHowTo(self):
+        self.screen.blit(self.menu, (0, 0))
+        self.howToItems.draw(self.screen)
+
+    def composeSongSelect(self):
+        self.screen.blit(self.menu, (0, 0))
+        self.backSmallGrp.draw(self.screen)
+        self.songSelItems.draw(self.screen)
+        self.clearTextGrp.draw(self.screen)
+
+    def composeScore(self):
         self.screen.blit(self.menu, (0, 0))
         self.scoreItems.draw(self.screen)
         self.printScoreText()
+
+    #Deliberately nothing moves in time with the clicks: the player has to
+    #tap to what they hear, not to what they see.
+    def calibrationUpdate(self):
+        self.idleShown = None
+        self.screen.fill((0, 0, 0))
+        (x, y) = (self.width // 2, 280)
+        size = 40
+        calibrator = self.calibrator
+        lines = ["Tap Z, X, space or click along with the metronome"]
+        if not self.calibrationDone:
+            lines.append("%d / %d taps" % (len(calibrator.offsets),
+                                            calibrator.taps))
+        elif self.calibrationProfile == None:
+            lines.append("Not enough steady taps, try again")
+        else:
+            profile = self.calibrationProfile
+            lines.append("Latency %.1f ms, spread %.1f ms" % (
+                            profile.latency * 1000, profile.getSpread() * 1000))
+            lines.append("%d of %d taps used, saved" % (profile.kept,
+                                                        profile.taps))
+        if self.calibrationDone:
+            lines.append("Enter to go again, Esc to go back")
+        else:
+            lines.append("Esc to go back")
+        for line in lines:
+            blitText(self.screen, TEXT_FONT, size, line, x, y, "center")
+            y += 90
         pygame.display.flip()
 
     def mainLoopUpdate(self):
         BLACK = (0, 0, 0)
         self.screen.fill(BLACK)
         pygame.display.flip()
+        self.idleShown = None
 
-    def songSelUpdate(self, events):
-        self.screen.blit(self.menu, (0, 0))
+    def loadingUpdate(self):
+        self.idleShown = None
+        self.screen.blit(getImage(self.loadScreenPath, alpha=False), (0, 0))
         self.backSmallGrp.draw(self.screen)
-        self.songSelItems.draw(self.screen)
-        self.clearTextGrp.draw(self.screen)
-        self.usrSong.update(events)
+
+        #Nothing to report progress on, so just show that we're still alive.
+        elapsed = time.time() - self.loadStart
+        (dots, dotR, spacing) = (8, 10, 40)
+        lit = int(elapsed * dots) % dots
+        x0 = (self.width - (dots - 1) * spacing) // 2
+        y = self.height - 100
+        for i in range(dots):
+            shade = 255 if (i == lit) else 90
+            pygame.draw.circle(self.screen, (shade, shade, shade),
+                                (x0 + i * spacing, y), dotR)
+
+        text = "%.1fs" % elapsed
+        (x, y) = (self.width // 2, self.height - 60)
+        blitText(self.screen, TEXT_FONT, 30, text, x, y, "center")
+        pygame.display.flip()
+
+    #Everything on song select that changes, drawn over its frame.
+    def songSelUpdate(self):
         self.usrSong.draw(self.screen)
+        self.printSongInfo()
+        self.printSeed()
+        if self.error:
+            self.oops.draw(self.screen)
 
+    #BPM and length of each indexed song, in the corner of its box.
+    def printSongInfo(self):
+        (margin, size) = (15, 25)
+        for (box, path) in self.songBoxes:
+            entry = self.library.get(path)
+            if entry == None:
+                continue
+            (minutes, seconds) = divmod(int(entry["duration"]), 60)
+            text = "%d BPM  %d:%02d" % (round(entry["tempo"]), minutes, seconds)
+            (x, y) = (box.rect.right - margin, box.rect.bottom - margin)
+            blitText(self.screen, TEXT_FONT, size, text, x, y, "se")
+
+    #Click to measure the audio latency, see startCalibration().
+    def printCalibration(self):
+        if self.latencyProfile == None:
+            text = "Calibrate audio latency"
+        else:
+            text = "Audio latency %.0f ms (click to calibrate)" % (
+                        self.latencyProfile.latency * 1000)
+        rect = blitText(self.screen, TEXT_FONT, 30, text, 1100, 660, "center")
+        if rect != self.calibrateRect:
+            self.menuTargets.addRect("calibrate", rect)
+            self.calibrateRect = rect
+
+    #Click to lock the seed, to play the same layout again.
+    def printSeed(self):
+        lock = "locked" if self.lockSeed else "click to lock"
+        text = "Seed %d (%s)" % (self.chartSeed, lock)
+        rect = blitText(self.screen, TEXT_FONT, 25, text, 240, 795, "sw")
+        if rect != self.seedRect:
+            self.songSelTargets.addRect("seed", rect)
+            self.seedRect = rect
+
+    #Only the areas that changed get redrawn and sent to the display: last
+    #frame's sprites and HUD text are painted over with the background, then
+    #everything is drawn again and just those rects are updated.
     def songLoopUpdate(self):
-        if not self.paused:
-            BLACK = (0, 0, 0)
-            self.screen.fill(BLACK)
-            self.printText()
-            self.hits.draw(self.screen)
-            self.beats.draw(self.screen)
-            if self.countdown != None:
-                fadeOut = pygame.Surface((self.width, self.height))
-                BLACK = (0, 0, 0)
-                fadeOut.fill(BLACK)
-                alpha = int((1 - self.countdown/self.endDelay) * 255)
-                alpha = max(alpha, 0)
-                fadeOut.set_alpha(alpha)
-                self.screen.blit(fadeOut, (0,0))
         if self.paused:
-            self.screen.blit(self.pauseScreen, (0,0))
+            #Nothing moves while paused, so draw the pause screen once.
+            if not self.pauseDrawn:
+                pauseScreen = getImage(self.pauseScreenPath, alpha=False)
+                self.screen.blit(pauseScreen, (0,0))
+                pygame.display.flip()
+                self.pauseDrawn = True
+            return
+        if self.pauseDrawn:
+            self.pauseDrawn = False
+            self.fullRedraw = True
+        self.drawSong()
+        self.profiler.mark("draw")
+
+        if self.fullRedraw:
+            pygame.display.flip()
+            self.fullRedraw = False
+        else:
+            pygame.display.update(self.dirty)
+        self.profiler.mark("flip")
 
-        pygame.display.flip()
+    def drawSong(self):
+        self.idleShown = None
+        #The fade covers the whole screen anyway.
+        if self.countdown != None:
+            self.fullRedraw = True
+
+        dirty = self.dirty = []
+        if self.fullRedraw:
+            self.screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.hudRects:
+                self.screen.blit(self.background, rect, rect)
+            dirty.extend(self.hudRects)
+            self.hits.clear(self.screen, self.background)
+            self.beats.clear(self.screen, self.background)
+
+        self.hudRects = self.printText()
+        dirty.extend(self.hudRects)
+        #Song time not simulated yet, see simulate().
+        lead = self.timeElapsed - self.simTime
+        dirty.extend(self.hits.draw(self.screen, lead))
+        dirty.extend(self.beats.draw(self.screen, lead))
+
+        if self.profiler.showOverlay:
+            rect = self.profiler.drawOverlay(self.screen)
+            if rect != None:
+                #Erased along with the HUD next frame.
+                self.hudRects.append(rect)
+                dirty.append(rect)
+
+        if self.countdown != None:
+            alpha = int((1 - self.countdown/self.endDelay) * 255)
+            alpha = max(alpha, 0)
+            self.fadeOut.set_alpha(alpha)
+            self.screen.blit(self.fadeOut, (0,0))
 
     def actEvent(self, event):
         if event.type == pygame.QUIT:
@@ -495,6 +1040,7 @@ class PygameGame(object):
             self.playSong = False
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE: self.paused = not self.paused
+            if event.key == pygame.K_F3: self.profiler.toggleOverlay()
             if self.paused:
                 if event.key == pygame.K_r:
                     self.reset()
@@ -504,37 +1050,44 @@ class PygameGame(object):
                 if (event.key == pygame.K_z or event.key == pygame.K_x):
                     self.beatPressed()
         if not self.paused:
-            if event.type == pygame.MOUSEBUTTONDOWN: self.beatPressed()
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                self.beatPressed(event.pos)
             elif event.type == self.PLAYBACK_END:
-                if (self.combo > self.maxCombo): self.maxCombo = self.combo
+                self.scorer.endCombo()
+                self.replay.addEnd(self.simSteps)
                 self.initScoreScreen()
                 self.countdown = self.endDelay
 
+    #Each check...Collision() gets the buttons that were clicked on.
     def mousePressed(self):
         (x, y) = pygame.mouse.get_pos()
-        click = MousePointer(x, y)
 
         if self.inMenu:
-            self.checkMenuCollision(click)
+            self.checkMenuCollision(self.menuTargets.at(x, y))
         elif self.instructions:
-            self.checkHowToCollision(click)
+            self.checkHowToCollision(self.howToTargets.at(x, y))
         elif self.songSelect:
-            self.checkSongSelCollision(click)
+            self.checkSongSelCollision(self.songSelTargets.at(x, y))
+        elif self.loading:
+            self.checkLoadingCollision(self.loadingTargets.at(x, y))
         elif self.scoreScreen:
-            self.checkScoreCollision(click)
+            self.checkScoreCollision(self.scoreTargets.at(x, y))
 
     def checkMenuCollision(self, click):
-        if pygame.sprite.collide_rect(self.playButton, click):
+        if self.playButton in click:
             self.soundHit.play()
             self.songSelect = True
             self.inMenu = False
-        elif pygame.sprite.collide_rect(self.howToButton, click):
+        elif self.howToButton in click:
             self.soundHit.play()
             self.instructions = True
             self.inMenu = False
+        elif "calibrate" in click:
+            self.inMenu = False
+            self.startCalibration()
 
     def checkHowToCollision(self, click):
-        if pygame.sprite.collide_rect(self.toMenu, click):
+        if self.toMenu in click:
             self.soundMiss.play()
             self.instructions = False
             self.inMenu = True
@@ -542,37 +1095,38 @@ class PygameGame(object):
     def checkSongSelCollision(self, click):
         self.checkSelectedSong(click)
 
-        if pygame.sprite.collide_rect(self.clearText, click):
+        if "seed" in click:
+            self.soundHit.play()
+            self.lockSeed = not self.lockSeed
+
+        if self.clearText in click:
             self.soundMiss.play()
             self.usrSong.clear()
 
-        if pygame.sprite.collide_rect(self.backSmall, click):
+        if self.backSmall in click:
             self.soundMiss.play()
             self.songSelect = False
             self.inMenu = True
 
-        if pygame.sprite.spritecollideany(click, self.songSelItems):
+        if any((button in click) for button in self.songSelItems):
             self.soundHit.play()
             self.play()
 
+    def checkLoadingCollision(self, click):
+        if self.backSmall in click:
+            self.soundMiss.play()
+            self.cancelLoading()
+
     def checkSelectedSong(self, click):
-        if pygame.sprite.collide_rect(self.badAppleBox, click):
-            self.songPath = "Songs/Bad Apple.mp3"
-        elif pygame.sprite.collide_rect(self.bonetrousleBox, click):
-            self.songPath = "Songs/Bonetrousle.ogg"
-        elif pygame.sprite.collide_rect(self.dummyBox, click):
-            self.songPath = "Songs/Dummy!.ogg"
-        elif pygame.sprite.collide_rect(self.megalovaniaBox, click):
-            self.songPath = "Songs/MEGALOVANIA.ogg"
-        elif pygame.sprite.collide_rect(self.rhinestoneBox, click):
-            self.songPath = "Songs/Rhinestone Eyes.ogg"
-        elif pygame.sprite.collide_rect(self.feelgoodBox, click):
-            self.songPath = "Songs/Feel Good Inc.ogg"
-        elif pygame.sprite.collide_rect(self.textInput, click):
+        for (box, path) in self.songBoxes:
+            if box in click:
+                self.songPath = path
+                return
+        if self.textInput in click:
             self.songPath = self.usrSong.value.replace('"', "")
 
     def checkScoreCollision(self, click):
-        if pygame.sprite.collide_rect(self.backScore, click):
+        if self.backScore in click:
             self.soundMiss.play()
             self.scoreScreen = False
             self.songSelect = True
@@ -593,47 +1147,62 @@ class PygameGame(object):
 
         howToPlay.add(self.scoreItems)
         self.backScore.add(self.scoreItems)
+        self.scoreTargets = self.getTargets([self.backScore])
+        #A new score to show.
+        self.frames.pop("score", None)
 
     def printScoreText(self):
         (width, height) = self.screen.get_size()
 
-        textScore = str(self.score)
+        textScore = str(self.scorer.score)
         (xScore, yScore) = (1390, 90)
         scoreSize = 70
-        scoreText = StText(self.screen, textScore, scoreSize, xScore, yScore, "ne")
+        self.printStText(textScore, scoreSize, xScore, yScore, "ne")
         
-        textCombo = str(self.maxCombo) + "x"
+        textCombo = str(self.scorer.maxCombo) + "x"
         (xCombo, yCombo) = (110, 240)
         comboSize = 80
-        comboText = StText(self.screen, textCombo, comboSize, xCombo, yCombo)
+        self.printStText(textCombo, comboSize, xCombo, yCombo)
 
         self.printTimingText()
 
+        if (self.chart != None) and (self.chart.seed != None):
+            textSeed = "Seed %d" % self.chart.seed
+            self.printStText(textSeed, 25, 1440, 845, "se")
+
+        if len(self.hitErrors) > 0:
+            errors = [error * 1000 for error in self.hitErrors]
+            textErrors = "Timing %+.1f ms, spread %.1f ms" % (
+                            statistics.mean(errors), statistics.pstdev(errors))
+            self.printStText(textErrors, 25, 60, 845, "sw")
+
     def printTimingText(self):
-        textScore = str(self.perfects)
+        textScore = str(self.scorer.perfects)
         (xScore, yScore) = (620, 445)
         scoreSize = 50
-        scoreText = StText(self.screen, textScore, scoreSize, xScore, yScore)
+        self.printStText(textScore, scoreSize, xScore, yScore)
 
-        textScore = str(self.goods)
+        textScore = str(self.scorer.goods)
         (xScore, yScore) = (1190, 445)
         scoreSize = 50
-        scoreText = StText(self.screen, textScore, scoreSize, xScore, yScore)
+        self.printStText(textScore, scoreSize, xScore, yScore)
 
-        textScore = str(self.bads)
+        textScore = str(self.scorer.bads)
         (xScore, yScore) = (620, 540)
         scoreSize = 50
-        scoreText = StText(self.screen, textScore, scoreSize, xScore, yScore)
+        self.printStText(textScore, scoreSize, xScore, yScore)
 
-        textScore = str(self.misses)
+        textScore = str(self.scorer.misses)
         (xScore, yScore) = (1190, 540)
         scoreSize = 50
-        scoreText = StText(self.screen, textScore, scoreSize, xScore, yScore)
+        self.printStText(textScore, scoreSize, xScore, yScore)
 
-    def play(self):
-        self.screen.blit(self.loadScreen, (0, 0))
-        pygame.display.flip()
+    #Stable text: the HUD's font on its background box.
+    def printStText(self, text, size, x, y, anchor="nw"):
+        blitText(self.screen, HUD_FONT, size, text, x, y, anchor, HUD_COLOR,
+                    HUD_BACKGROUND)
 
+    def play(self):
         #If custom path doesn't work (crashes), then we go back to song select.
         try:
             self.initSong(self.songPath)
@@ -641,13 +1210,66 @@ class PygameGame(object):
             self.error = True
             return
 
-        pygame.mixer.music.stop()
         self.songSelect = False
+        self.loading = True
+
+    def finishLoading(self):
+        self.loading = False
+        try:
+            self.startSong()
+        except:
+            self.error = True
+            self.songSelect = True
+            return
+
+        pygame.mixer.music.stop()
         self.playSong = True
 
+    def cancelLoading(self):
+        self.song.cancel()
+        self.loading = False
+        self.songSelect = True
+
+    #Plays a metronome on the song channel (so the latency is the one songs
+    #get) and times taps the same way songLoop() does. Taps make no sound,
+    #that would give the player something else to follow.
+    def startCalibration(self):
+        pygame.mixer.music.stop()
+        self.metronome = Metronome()
+        self.calibrator = LatencyCalibrator(self.metronome.times,
+                                            self.metronome.interval)
+        self.calibrationDone = False
+        self.calibrationProfile = None
+        self.finishMeasure()
+        self.player.loadPcm(self.metronome.pcm)
+        self.player.play(self.PLAYBACK_END)
+        #No latency added, that's what is being measured.
+        self.calibrationClock = SongClock(getPos=self.player.getPos)
+        self.scheduler.reset()
+        self.inputs.clear()
+        self.calibrating = True
+
+    #arrival is when the tap arrived, as time.perf_counter().
+    def calibrationTap(self, arrival):
+        self.calibrator.tap(self.calibrationClock.at(arrival))
+
+    def finishCalibration(self):
+        self.player.stop()
+        self.calibrationDone = True
+        self.calibrationProfile = self.calibrator.getProfile(self.mixerBuffer)
+        if self.calibrationProfile != None:
+            self.calibrationProfile.save()
+            self.useLatencyProfile(self.calibrationProfile)
+
+    def stopCalibration(self):
+        self.player.stop()
+        self.metronome = None
+        self.calibrating = False
+        self.inMenu = True
+
     #Resets variables to prepare for next song.
     def reset(self):
-        pygame.mixer.music.stop()
+        self.player.stop()
 
         self.error = False
 
@@ -655,201 +1277,162 @@ class PygameGame(object):
         self.playSong = False
         self.paused = False
 
-        self.combo = 0
-        self.maxCombo = 0
-        self.score = 0
-        self.prevAddition = 0
         self.lastBeatHit = (0, 0)
-        self.hits = pygame.sprite.Group()
+        self.hits.empty()
+        self.eventSongTime = None
+        self.hitErrors = []
         self.timeElapsed = 0 + self.audioDelay
-        self.beats = pygame.sprite.Group()
-        self.beatQueue = deque()
-        self.beatNum = 1
-        self.initScoring()
-
-        pygame.mixer.music.set_endevent()
+        self.simTime = self.timeElapsed
+        self.simSteps = 0
+        self.beats.empty()
+        self.chartCursor = 0
+        if not self.lockSeed:
+            self.chartSeed = newSeed()
+        self.scorer.reset()
 
 ###############################################################################
 ########################### Game code starts here #############################
 ###############################################################################
-    def beatPressed(self):
-        if (len(self.beatQueue) == 0):
+    #pos is where the player clicked, keyboard hits use the mouse position.
+    def beatPressed(self, pos=None):
+        if (self.beats.waiting() == 0):
             return
-        (x, y) = pygame.mouse.get_pos()
-        click = MousePointer(x, y)
-
-        #Only the oldest beat placed can be clicked on.
-        beat = self.beatQueue[0]
-        if (pygame.sprite.collide_circle(beat, click)):
-            mistake = self.addScore(beat.clock, beat)
+        if pos == None:
+            pos = pygame.mouse.get_pos()
+        (x, y) = pos
+        offset = self.getInputOffset()
+        self.replay.addInput(self.simSteps, offset, x, y)
+
+        #Unless anyBeat is on, only the oldest beat placed can be clicked on.
+        under = self.beats.under(x, y)
+        if len(under) == 0:
+            return
+        beat = under[0]
+        if self.anyBeat or (beat == self.beats.front()):
+            #Where the beat was when the input arrived.
+            clock = self.beats.clock[beat] + fromMicroseconds(offset)
+            mistake = self.scorer.addScore(clock)
             if (mistake == None):
                 return
             elif mistake:
                 self.mistake(beat)
+                result = "miss"
             else:
                 self.soundHit.play()
-                self.combo += 1
-            beat.dying()
-            self.beatQueue.popleft()
+                self.scorer.hit()
+                result = str(self.scorer.prevAddition)
+            error = clock - self.beatApproach
+            self.hitErrors.append(error)
+            self.profiler.recordInput(self.eventArrival, time.perf_counter(),
+                                        result, error)
+            self.beats.judge(beat)
             self.addHit(beat)
 
-    #Returns True if a mistake is made, None if player clicks early, and 
-    #increments score otherwise.
-    def addScore(self, time, beat):
-        if (time >= self.missLate):
-            return True
-        elif (time >= self.badLate):
-            addition = self.scoreBad
-        elif (time >= self.goodLate):
-            addition = self.scoreGood
-        elif (time >= self.perfectEarly):
-            addition = self.scorePerfect
-        elif (time >= self.goodEarly):
-            addition = self.scoreGood
-        elif (time >= self.badEarly):
-            addition = self.scoreBad
-        elif (time >= self.missEarly):
-            return True
-        else:
-            return None
-
-        self.scoreTrack(addition)
-
-        return False
-
-    #Increments counter for each hit type.
-    def scoreTrack(self, addition):
-        mult = self.getComboMult()
-        self.score = int(self.score + (addition * mult))
-        self.prevAddition = addition
-
-        if (addition == self.scoreBad):
-            self.bads += 1
-        elif (addition == self.scoreGood):
-            self.goods += 1
-        elif (addition == self.scorePerfect):
-            self.perfects += 1
-
-    #Based off how osu! calculates this, from: https://osu.ppy.sh/wiki/Score
-    def getComboMult(self):
-        return (1 + self.combo/25)
+    #How far the song had moved on from simTime (the last beat update) when
+    #the input being handled arrived, in whole microseconds so that replays
+    #judge it exactly the same. Negative if it arrived before.
+    def getInputOffset(self):
+        if self.eventSongTime == None:
+            return 0
+        return toMicroseconds(self.eventSongTime - self.simTime)
+
+    #Steps the game up to songTime, one simStep at a time, so everything in
+    #it happens at the same song time at any frame rate. Drawing makes up
+    #for whatever is left over, less than a step (see drawSong()).
+    def simulate(self, songTime):
+        step = self.simStep
+        while self.simTime + step <= songTime:
+            self.simTime += step
+            self.simSteps += 1
+            self.gameTimerFired(self.simTime, step)
+        self.timeElapsed = max(self.timeElapsed, songTime)
 
     #Checks internal clocks of each beat.
     def gameTimerFired(self, time, tick):
-        if (time + self.beatApproach) >= self.nextBeat:
-            if len(self.times) > 0:
-                self.addBeat()
-                self.nextBeat = self.times.pop(0)
-
-        for beat in self.beats:
-            beat.update(tick)
-            if ((beat.killClock == None) and (beat.clock >= self.beatKill)):
-                beat.dying()
-                self.beatQueue.remove(beat)
-                self.mistake(beat)
-        for hit in self.hits:
-            hit.update(tick)
-            if ((hit.killClock == None) and (hit.clock >= self.hitKill)):
-                hit.dying()
-
-    def addBeat(self):
-        #Can't let beat go off-screen.
-        (offsetW, offsetH) = (self.width-self.r, self.height-self.r)
-        if (self.prevX == None) and (self.prevY == None):
-            x = random.randint(0+self.r, offsetW)
-            y = random.randint(0+self.r, offsetH)
-        #Biasing in effect here. If beat position is in the edge 1/4 of the
-        #screen, it will push the next beat to the center of the screen. If
-        #it's in the center already, it's completely random.
-        else:
-            if (self.prevX < self.width // 4): xMult = 1
-            elif (self.prevX > 3*(self.width // 4)): xMult = -1
-            else: xMult = random.choice([-1, 1])
-
-            if (self.prevY < self.height // 4): yMult = 1
-            elif (self.prevY > 3*(self.height // 4)): yMult = -1
-            else: yMult = random.choice([-1, 1])
-
-            dx = random.randint(self.minDist, self.maxDist) * xMult
-            dy = random.randint(self.minDist, self.maxDist) * yMult
-            (x, y) = (self.prevX + dx, self.prevY + dy)
-
-        (self.prevX, self.prevY) = (x, y)
-        beat = Beat(x, y, self.beatColor, self.beatNum)
-        beat.add(self.beats)
-        self.beatQueue.append(beat)
-        self.updateOrdinal()
-
-    #Updates number drawn on the beat.
-    def updateOrdinal(self):
-        self.beatNum += 1
-        if self.beatNum > self.beatNumMax:
-            self.beatNum = 1
-            self.shuffleColor()
-
+        chart = self.chart
+        if (self.compiler != None) and (len(self.times) > len(chart)):
+            self.compiler.extend(self.times[len(chart):])
+        #Beats appear in chart order, so only the one under the cursor can
+        #be due.
+        while ((self.chartCursor < len(chart)) and
+                (time + self.beatApproach >= chart.times[self.chartCursor])):
+            self.addBeat(self.chartCursor)
+            self.chartCursor += 1
+        self.profiler.mark("timer")
+
+        self.beats.update(tick)
+        #Every beat lives equally long, so the ones that ran out are always
+        #the oldest waiting.
+        beats = self.beats
+        while ((beats.waiting() > 0) and
+                (beats.clock[beats.front()] >= self.beatKill)):
+            self.mistake(beats.judge())
+        self.hits.update(tick)
+        self.profiler.mark("update")
+
+    #Puts beat i of the chart on screen.
+    def addBeat(self, i):
+        (beatTime, x, y, color, ordinal) = self.chart.get(i)
+        self.beats.add(x, y, color, ordinal)
+
+    #beat is the index of the beat in self.beats.
     def mistake(self, beat):
-        if (self.combo > self.maxCombo): self.maxCombo = self.combo
         #Only play noise when the player has a decent-sized combo.
         #Otherwise it's annoying as hell.
-        if (self.combo >= 10):
+        if (self.scorer.combo >= 10):
             self.soundMiss.play()
 
-        self.combo = 0
+        self.scorer.miss()
 
         xColor = (255, 0, 0)
-        (x, y) = beat.getPos()
+        (x, y) = self.beats.getPos(beat)
         text = "x"
         size = 100
-        missText = Text(self.screen, text, size, x, y, "center", xColor)
-        missText.add(self.hits)
-
-        self.misses += 1
-
-    #Change color of beats.
-    def shuffleColor(self):
-        newColor = random.choice(self.colorChoices)
-        while (newColor == self.beatColor):
-            newColor = random.choice(self.colorChoices)
-        self.beatColor = newColor
+        self.hits.add(text, size, x, y, xColor)
 
-    #Prints combo and score on screen.
+    #Prints combo and score on screen, returns the rects drawn to.
     def printText(self):
         (width, height) = self.screen.get_size()
-        textScore = str(self.score)
+        textScore = str(self.scorer.score)
         (xScore, yScore) = (width-10, 0)
         scoreSize = 60
-        scoreText = Text(self.screen, textScore, scoreSize, xScore, yScore,"ne")
+        scoreRect = blitText(self.screen, TEXT_FONT, scoreSize, textScore,
+                                xScore, yScore, "ne")
         
-        textCombo = str(self.combo) + "x"
+        textCombo = str(self.scorer.combo) + "x"
         (xCombo, yCombo) = (10, height)
         comboSize = 75
-        comboText = Text(self.screen, textCombo, comboSize, xCombo, yCombo,"sw")
+        comboRect = blitText(self.screen, TEXT_FONT, comboSize, textCombo,
+                                xCombo, yCombo, "sw")
+        return [scoreRect, comboRect]
 
     def addHit(self, beat):
         colorPerfect = (125, 200, 255)
         colorGood = (88, 255, 88)
         colorBad = (255, 226, 125)
 
-        (x, y) = beat.getPos()
-        text = str(self.prevAddition)
-        if (self.prevAddition == self.scorePerfect):
+        (x, y) = self.beats.getPos(beat)
+        addition = self.scorer.prevAddition
+        text = str(addition)
+        if (addition == Scorer.PERFECT):
             color = colorPerfect
-        elif (self.prevAddition == self.scoreGood):
+        elif (addition == Scorer.GOOD):
             color = colorGood
-        elif (self.prevAddition == self.scoreBad):
+        elif (addition == Scorer.BAD):
             color = colorBad
         else: return
         size = 50
-        hitText = Text(self.screen, text, size, x, y, "center", color)
-        hitText.add(self.hits)
+        self.hits.add(text, size, x, y, color)
 
 #Randomized taglines for additional fun!
 taglines = ["Tap to the Beat!", "Just Beat it!", "Tap or die!",
             "Play your own songs!", "WUBWUBWUBWUBWUBWUB",
             "Randomized taglines!", "Algo-rhythmic!"]
 
-title = "AudioBeat" + " - " + random.choice(taglines)
+#The guard matters: analysis worker processes import this module too.
+if __name__ == "__main__":
+    title = "AudioBeat" + " - " + random.choice(taglines)
 
-game = PygameGame(title=title)
+    game = PygameGame(title=title)
 
-game.run()
\ No newline at end of file
+    game.run()
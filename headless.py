@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+#Must be set before pygame is imported anywhere.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from game import PygameGame
+from audio import Song
+from chart import Chart
+from trackers import TRACKERS, DEFAULT_TRACKER
+
+#Plays a whole song without a window or sound card, as fast as the CPU
+#allows. Time advances by a fixed step per frame rather than by the wall
+#clock, and every beat is clicked dead center at its perfect moment (inputs
+#are timestamped in between frames), so two runs of the same song do exactly
+#the same work. That makes the frame times
+#comparable between commits, e.g. in CI:
+#
+#   python headless.py Songs/MEGALOVANIA.ogg --min-fps 300
+
+class HeadlessRun(object):
+    #chart is a saved Chart to replay, which overrides seed. tracker is one
+    #of trackers.TRACKERS, mode how the song is analyzed (see
+    #audio.getAnalysisParams()).
+    def __init__(self, path, fps=60, seed=0, allocations=False, chart=None,
+                    tracker=DEFAULT_TRACKER, mode="full"):
+        self.path = path
+        self.fps = fps
+        self.seed = seed
+        self.chart = chart
+        self.tracker = tracker
+        self.mode = mode
+        self.allocations = allocations
+        #Seconds spent on each frame, wall clock.
+        self.frameTimes = []
+        #With allocations, how far each frame's memory rose above where it
+        #started (in bytes), which is what it allocated and then threw away.
+        self.frameAllocations = []
+        #Blocks allocated at the end that weren't at the start: what the run
+        #kept (hit errors, replay events) or leaked. Anything freed again
+        #within a frame doesn't show up here, see frameAllocations for that.
+        self.blockGrowth = 0
+        self.peakMemory = None
+
+    def setUp(self):
+        self.game = PygameGame(fps=self.fps, title="AudioBeat (headless)")
+        game = self.game
+        game.chartSeed = self.seed
+        game.beatTracker = self.tracker
+        game.screen = pygame.display.set_mode((game.width, game.height))
+        game.initMenu()
+        game.initSongRender()
+        game.songPath = os.path.normpath(self.path)
+        self.startSong(game)
+
+    #Analyzes the song all at once (or loads it from the cache), however
+    #mode says to, and starts it.
+    def startSong(self, game):
+        game.song = Song(game.songPath, tracker=self.tracker, mode=self.mode)
+        game.startSong(self.chart)
+
+    #Clicks the oldest beat once it has passed the perfect point, with the
+    #input stamped at the exact moment it got there.
+    def press(self):
+        game = self.game
+        beats = game.beats
+        if beats.waiting() == 0:
+            return
+        beat = beats.front()
+        late = beats.clock[beat] - game.beatApproach
+        if late >= 0:
+            game.eventSongTime = game.simTime - late
+            game.beatPressed(beats.getPos(beat))
+
+    def frame(self, tick):
+        game = self.game
+        game.simulate(game.timeElapsed + tick)
+        game.eventArrival = time.perf_counter()
+        self.press()
+        game.songLoopUpdate()
+
+    def run(self):
+        self.setUp()
+        game = self.game
+        tick = 1 / self.fps
+        #The song plays from timeElapsed == audioDelay, run until the music
+        #would have ended, plus the time the last beat needs to play out.
+        end = game.audioDelay + game.song.getDuration() + game.beatKill
+
+        if self.allocations:
+            tracemalloc.start()
+        blocksBefore = sys.getallocatedblocks()
+        while game.timeElapsed < end:
+            if self.allocations:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            self.frame(tick)
+            self.frameTimes.append(time.perf_counter() - start)
+            if self.allocations:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.frameAllocations.append(peak - before)
+                self.peakMemory = max(self.peakMemory or 0, peak)
+        #What the game does when playback ends (see actEvent()), there's no
+        #mixer here to say so.
+        game.scorer.endCombo()
+        game.replay.addEnd(game.simSteps)
+        self.blockGrowth = sys.getallocatedblocks() - blocksBefore
+        if self.allocations:
+            tracemalloc.stop()
+        return self.getResults()
+
+    def getResults(self):
+        times = sorted(self.frameTimes)
+        total = sum(times)
+        percentile = lambda p: times[min(len(times)-1, int(p * len(times)))]
+        game = self.game
+        allocations = sorted(self.frameAllocations)
+        return {"frames": len(times),
+                "seconds": total,
+                "fps": len(times) / total if (total > 0) else 0,
+                "p50": percentile(0.50),
+                "p90": percentile(0.90),
+                "p99": percentile(0.99),
+                "max": times[-1] if (len(times) > 0) else 0,
+                "blockGrowth": self.blockGrowth,
+                "frameBytes": (sum(allocations) / max(1, len(allocations))
+                                if self.allocations else None),
+                "frameBytesP99": (allocations[int(0.99 * len(allocations))]
+                                    if (len(allocations) > 0) else None),
+                "peakMemory": self.peakMemory,
+                "maxError": max(map(abs, game.hitErrors), default=0),
+                "score": game.scorer.score,
+                "perfects": game.scorer.perfects,
+                "goods": game.scorer.goods,
+                "bads": game.scorer.bads,
+                "misses": game.scorer.misses}
+
+def printResults(path, results):
+    print(path)
+    print("  %d frames in %.2fs, %.0f fps" % (results["frames"],
+            results["seconds"], results["fps"]))
+    print("  frame ms: p50 %.3f  p90 %.3f  p99 %.3f  max %.3f" % (
+            1000 * results["p50"], 1000 * results["p90"],
+            1000 * results["p99"], 1000 * results["max"]))
+    print("  allocated blocks, net growth over the run: %d" %
+            results["blockGrowth"])
+    if results["frameBytes"] != None:
+        print("  bytes allocated per frame: mean %.0f  p99 %.0f" % (
+                results["frameBytes"], results["frameBytesP99"]))
+    if results["peakMemory"] != None:
+        print("  peak traced memory: %.1f MB" %
+                (results["peakMemory"] / (1024 * 1024)))
+    print("  worst judgement error: %.3f ms" % (1000 * results["maxError"]))
+    print("  score %d: %d perfect, %d good, %d bad, %d miss" % (
+            results["score"], results["perfects"], results["goods"],
+            results["bads"], results["misses"]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Play songs without a display and time every frame.")
+    parser.add_argument("songs", nargs="+")
+    parser.add_argument("--fps", type=int, default=60,
+                        help="simulated frame rate (default 60)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed for beat placement")
+    parser.add_argument("--tracker", default=DEFAULT_TRACKER,
+                        choices=sorted(TRACKERS),
+                        help="beat tracker (see trackers.py)")
+    parser.add_argument("--mode", default="full",
+                        choices=["full", "stream", "segments"],
+                        help="analyze songs whole, streamed or in segments")
+    parser.add_argument("--chart", default=None,
+                        help="replay a chart saved with --save-chart")
+    parser.add_argument("--save-chart", default=None,
+                        help="save the chart that was played to this file")
+    parser.add_argument("--save-replay", default=None,
+                        help="save a replay of the run to this file")
+    parser.add_argument("--allocations", action="store_true",
+                        help="also trace memory allocated per frame and "
+                                "peak memory (much slower)")
+    parser.add_argument("--min-fps", type=float, default=None,
+                        help="exit with an error if any song runs slower")
+    args = parser.parse_args(argv)
+
+    chart = None
+    if args.chart != None:
+        chart = Chart.load(args.chart)
+
+    failed = False
+    for path in args.songs:
+        run = HeadlessRun(path, args.fps, args.seed, args.allocations, chart,
+                            args.tracker, args.mode)
+        results = run.run()
+        printResults(path, results)
+        if args.save_chart != None:
+            run.game.chart.save(args.save_chart)
+        if args.save_replay != None:
+            run.game.finishReplay().save(args.save_replay)
+        if (args.min_fps != None) and (results["fps"] < args.min_fps):
+            print("  FAILED: below %.0f fps" % args.min_fps)
+            failed = True
+    pygame.quit()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#Answers "what is under this point" for clicks. Targets (beats, buttons) are
+#filed under every grid cell their bounding box touches, so a lookup only
+#tests the handful of targets in the clicked cell, however many there are.
+
+class HitGrid(object):
+    #Beats are 100 pixels across, so each one touches at most 4 cells.
+    CELL = 128
+
+    def __init__(self, cell=CELL):
+        self.cell = cell
+        #(column, row) -> keys, in the order they were added.
+        self.cells = dict()
+        #key -> (shape, cells it's filed under). Shapes are ("rect", x0, y0,
+        #x1, y1) or ("circle", x, y, radius).
+        self.targets = dict()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __contains__(self, key):
+        return key in self.targets
+
+    #rect is anything with left, top, right and bottom, like pygame.Rect.
+    #Adding a key that's already there moves it.
+    def addRect(self, key, rect):
+        shape = ("rect", rect.left, rect.top, rect.right, rect.bottom)
+        self.add(key, shape, rect.left, rect.top, rect.right, rect.bottom)
+
+    def addCircle(self, key, x, y, radius):
+        shape = ("circle", x, y, radius)
+        self.add(key, shape, x - radius, y - radius, x + radius, y + radius)
+
+    def add(self, key, shape, left, top, right, bottom):
+        if key in self.targets:
+            self.remove(key)
+        cells = []
+        for column in range(left // self.cell, right // self.cell + 1):
+            for row in range(top // self.cell, bottom // self.cell + 1):
+                self.cells.setdefault((column, row), []).append(key)
+                cells.append((column, row))
+        self.targets[key] = (shape, cells)
+
+    def remove(self, key):
+        (shape, cells) = self.targets.pop(key)
+        for cell in cells:
+            keys = self.cells[cell]
+            keys.remove(key)
+            if len(keys) == 0:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.targets.clear()
+
+    #Keys of everything under (x, y), oldest first.
+    def at(self, x, y):
+        keys = self.cells.get((x // self.cell, y // self.cell))
+        if keys == None:
+            return []
+        return [key for key in keys if self.contains(key, x, y)]
+
+    #Whether (x, y) is inside key. Rects include their top and left edges
+    #only, like pygame.Rect.collidepoint().
+    def contains(self, key, x, y):
+        shape = self.targets[key][0]
+        if shape[0] == "rect":
+            (kind, left, top, right, bottom) = shape
+            return (left <= x < right) and (top <= y < bottom)
+        (kind, cx, cy, radius) = shape
+        (dx, dy) = (x - cx, y - cy)
+        return dx * dx + dy * dy <= radius * radius
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import audio
+from cache import writeAtomic
+from trackers import TRACKERS, DEFAULT_TRACKER
+
+#Batch indexer for a folder of songs. Every track is analyzed up front across
+#all cores, and the results go both into the analysis cache (so picking the
+#song later is a cache hit) and into a small JSON index that song select
+#reads to show BPM and length without touching librosa.
+
+#Formats librosa can decode through soundfile/audioread.
+EXTENSIONS = (".ogg", ".mp3", ".wav", ".flac")
+
+#Runs in a worker process.
+def indexFile(path, params, cache):
+    analysis = audio.analyzeFile(path, params, cache)
+    stat = os.stat(path)
+    return {"path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "params": repr(sorted(params.items())),
+            "duration": analysis.duration,
+            "tempo": analysis.tempo,
+            "beatCount": len(analysis.times),
+            "times": analysis.times}
+
+class Library(object):
+    DIRECTORY = os.path.normpath("Songs")
+    INDEX = os.path.normpath("Cache/library.json")
+
+    def __init__(self, directory=DIRECTORY, indexPath=INDEX,
+                    cache=audio.analysisCache, profile=audio.DEFAULT_PROFILE,
+                    tracker=DEFAULT_TRACKER):
+        self.directory = os.path.normpath(directory)
+        self.indexPath = os.path.normpath(indexPath)
+        self.cache = cache
+        self.params = audio.getAnalysisParams(profile=profile,
+                                                tracker=tracker)
+        self.entries = dict()
+        #path -> Future, for tracks still being analyzed by buildAsync().
+        self.pending = dict()
+        self.errors = dict()
+
+    def scan(self):
+        paths = []
+        for (root, dirs, files) in os.walk(self.directory):
+            for name in sorted(files):
+                if name.lower().endswith(EXTENSIONS):
+                    paths.append(os.path.normpath(os.path.join(root, name)))
+        return paths
+
+    def load(self):
+        try:
+            with open(self.indexPath, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for entry in entries:
+            self.entries[os.path.normpath(entry["path"])] = entry
+
+    def save(self):
+        entries = [self.entries[path] for path in sorted(self.entries)]
+        writeAtomic(self.indexPath, json.dumps(entries).encode("utf-8"))
+
+    #Returns the index entry for path, or None if it isn't indexed (yet).
+    def get(self, path):
+        return self.entries.get(os.path.normpath(path))
+
+    def isStale(self, path):
+        entry = self.entries.get(path)
+        if entry == None:
+            return True
+        stat = os.stat(path)
+        return ((entry["size"] != stat.st_size) or
+                (entry["mtime"] != stat.st_mtime) or
+                (entry["params"] != repr(sorted(self.params.items()))))
+
+    #Submits every missing or outdated track to executor without waiting.
+    #Call poll() now and then to pick up the results.
+    def buildAsync(self, executor):
+        paths = self.scan()
+        for path in paths:
+            if (path not in self.pending) and self.isStale(path):
+                self.pending[path] = executor.submit(indexFile, path,
+                                                    self.params, self.cache)
+
+        #Forget songs that have been deleted since the last run.
+        existing = set(paths)
+        for path in list(self.entries):
+            if path not in existing:
+                del self.entries[path]
+
+    #Collects finished jobs, saving the index once nothing is left pending.
+    #Returns True while work is still outstanding.
+    def poll(self):
+        changed = False
+        for (path, future) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[path]
+            if future.cancelled():
+                continue
+            try:
+                self.entries[path] = future.result()
+                changed = True
+            except Exception as error:
+                #One broken file shouldn't stop the rest from being indexed.
+                self.errors[path] = error
+        if changed and (len(self.pending) == 0):
+            self.save()
+        return len(self.pending) > 0
+
+    def build(self, executor):
+        self.buildAsync(executor)
+        while self.poll():
+            time.sleep(0.05)
+        self.save()
+
+    def cancel(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = dict()
+
+def createPool(workers=None):
+    #Spawn, for the same reason as PygameGame.getAnalysisPool().
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Analyze every song in a folder ahead of time.")
+    parser.add_argument("directory", nargs="?", default=Library.DIRECTORY)
+    parser.add_argument("--index", default=Library.INDEX,
+                        help="where to write the library index")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--profile", default=audio.DEFAULT_PROFILE,
+                        choices=sorted(audio.PROFILES),
+                        help="analysis profile (see audio.PROFILES)")
+    parser.add_argument("--tracker", default=DEFAULT_TRACKER,
+                        choices=sorted(TRACKERS),
+                        help="beat tracker (see trackers.py)")
+    args = parser.parse_args(argv)
+
+    library = Library(args.directory, args.index, profile=args.profile,
+                        tracker=args.tracker)
+    library.load()
+    startTime = time.time()
+    with createPool(args.workers) as pool:
+        library.build(pool)
+
+    for path in sorted(library.entries):
+        entry = library.entries[path]
+        print("%-40s %6.1f BPM %6.1fs %5d beats" % (path, entry["tempo"],
+                entry["duration"], entry["beatCount"]))
+    for (path, error) in sorted(library.errors.items()):
+        print("%-40s failed: %s" % (path, error), file=sys.stderr)
+    print("Indexed %d songs in %.1fs" % (len(library.entries),
+                                            time.time() - startTime))
+    return 1 if library.errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import os
+import csv
+import json
+import time
+
+from fonts import blitText
+
+#Per-frame timing for the song loop. Each frame is split into phases by
+#calling mark() at the end of each one; inputs and audio drift are recorded
+#alongside. The whole song can be written out as CSV (for spreadsheets) or as
+#a Chrome trace (open chrome://tracing or https://ui.perfetto.dev and load
+#the .json file).
+
+class FrameProfiler(object):
+    #In the order they happen in PygameGame.songLoop().
+    PHASES = ("tick", "timer", "update", "events", "draw", "flip")
+    DIRECTORY = os.path.normpath("Traces")
+    FONT = os.path.normpath("Fonts/SourceCodePro-Regular.ttf")
+    #Overlay numbers are averaged over, and refreshed every, this many frames.
+    WINDOW = 30
+
+    def __init__(self):
+        self.showOverlay = False
+        self.reset()
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        #One row per frame: start time then one duration per phase.
+        self.frames = []
+        #(event arrival, judged, result, error) for every judged input.
+        self.inputs = []
+        #(time, audio drift) once per frame.
+        self.drift = []
+        self.frameStart = None
+        self.phaseStart = None
+        self.durations = None
+        self.overlayLines = []
+
+    def startFrame(self):
+        now = time.perf_counter()
+        self.frameStart = now
+        self.phaseStart = now
+        self.durations = [0.0] * len(FrameProfiler.PHASES)
+
+    #Ends phase (one of PHASES) and starts timing the next one.
+    def mark(self, phase):
+        if self.durations == None:
+            return
+        now = time.perf_counter()
+        self.durations[FrameProfiler.PHASES.index(phase)] += now-self.phaseStart
+        self.phaseStart = now
+
+    #drift is how far (in seconds) the game clock is from the audio clock.
+    def endFrame(self, drift=None):
+        if self.durations == None:
+            return
+        self.frames.append([self.frameStart] + self.durations)
+        if drift != None:
+            self.drift.append((self.frameStart, drift))
+        self.durations = None
+        if (len(self.frames) % FrameProfiler.WINDOW) == 0:
+            self.updateOverlay()
+
+    #arrival is when the input arrived, judged when beatPressed() finished
+    #with it (both time.perf_counter()). result is a short description, e.g.
+    #the score added or "miss", and error how far off perfect it was in
+    #seconds.
+    def recordInput(self, arrival, judged, result, error=None):
+        self.inputs.append((arrival, judged, result, error))
+
+    def toggleOverlay(self):
+        self.showOverlay = not self.showOverlay
+
+    def updateOverlay(self):
+        recent = self.frames[-FrameProfiler.WINDOW:]
+        if len(recent) < 2:
+            return
+        span = recent[-1][0] - recent[0][0]
+        fps = (len(recent) - 1) / span if (span > 0) else 0
+        frameTimes = [sum(frame[1:]) * 1000 for frame in recent]
+        lines = ["%5.1f fps  avg %5.2f ms  max %5.2f ms" % (fps,
+                    sum(frameTimes) / len(frameTimes), max(frameTimes))]
+        for (i, phase) in enumerate(FrameProfiler.PHASES):
+            average = sum(frame[i + 1] for frame in recent) / len(recent)
+            lines.append("%-7s %6.2f ms" % (phase, average * 1000))
+        if len(self.inputs) > 0:
+            (arrival, judged, result, error) = self.inputs[-1]
+            if error != None:
+                result = "%s, %+.1f ms" % (result, error * 1000)
+            lines.append("input   %6.2f ms (%s)" % ((judged-arrival) * 1000,
+                                                    result))
+        if len(self.drift) > 0:
+            lines.append("drift   %6.1f ms" % (self.drift[-1][1] * 1000))
+        self.overlayLines = lines
+
+    #Draws the overlay in the top left corner, returns the rect it covers.
+    def drawOverlay(self, surface, x=10, y=10, size=16):
+        rect = None
+        for line in self.overlayLines:
+            lineRect = blitText(surface, FrameProfiler.FONT, size, line, x, y,
+                                color=(255, 255, 0), background=(0, 0, 0))
+            rect = lineRect if (rect == None) else rect.union(lineRect)
+            y += lineRect.height
+        return rect
+
+    #Writes <name>-<date>.csv and .json into DIRECTORY, returns both paths.
+    def dump(self, name, directory=DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(directory, "%s-%s" % (name, stamp))
+        self.writeCsv(base + ".csv")
+        self.writeTrace(base + ".json")
+        return (base + ".csv", base + ".json")
+
+    def writeCsv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "start_ms"] +
+                            ["%s_ms" % phase for phase in FrameProfiler.PHASES])
+            for (i, frame) in enumerate(self.frames):
+                writer.writerow([i, "%.3f" % self.toMs(frame[0])] +
+                                ["%.3f" % (t * 1000) for t in frame[1:]])
+
+    def toMs(self, t):
+        return (t - self.origin) * 1000
+
+    def toUs(self, t):
+        return int((t - self.origin) * 1000000)
+
+    #Chrome's trace event format: one complete ("X") event per phase, one
+    #per input spanning arrival to judgement, and a counter track for drift.
+    def writeTrace(self, path):
+        events = []
+        for frame in self.frames:
+            start = frame[0]
+            for (i, phase) in enumerate(FrameProfiler.PHASES):
+                duration = frame[i + 1]
+                events.append({"name": phase, "ph": "X", "pid": 0, "tid": 0,
+                               "ts": self.toUs(start),
+                               "dur": int(duration * 1000000)})
+                start += duration
+        for (arrival, judged, result, error) in self.inputs:
+            args = {"result": result}
+            if error != None:
+                args["error_ms"] = error * 1000
+            events.append({"name": "input", "ph": "X", "pid": 0, "tid": 1,
+                           "ts": self.toUs(arrival),
+                           "dur": int((judged - arrival) * 1000000),
+                           "args": args})
+        for (t, drift) in self.drift:
+            events.append({"name": "drift", "ph": "C", "pid": 0,
+                           "ts": self.toUs(t), "args": {"ms": drift * 1000}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+#Where the time goes between launching the game and its first menu frame
+#(and in audio.warmUp()). Like FrameProfiler, each phase is ended by calling
+#mark().
+class StartupTimer(object):
+    #title is the report's first line, with the total in ms.
+    def __init__(self, start=None, title="Startup: %.0f ms to the menu"):
+        #time.perf_counter() when the game was launched.
+        self.start = time.perf_counter() if (start == None) else start
+        self.title = title
+        self.last = self.start
+        #(phase, seconds), in order.
+        self.phases = []
+        self.finished = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def getTotal(self):
+        return self.last - self.start
+
+    #Ends the last phase, returns the report.
+    def finish(self, phase):
+        self.mark(phase)
+        self.finished = True
+        return self.report()
+
+    def report(self):
+        lines = [self.title % (self.getTotal() * 1000)]
+        for (phase, duration) in self.phases:
+            lines.append("  %-12s %7.1f ms" % (phase, duration * 1000))
+        return "\n".join(lines)
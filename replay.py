@@ -0,0 +1,389 @@
+import os
+import sys
+import time
+import struct
+import hashlib
+import argparse
+
+import numpy
+
+import scoring
+from scoring import Scorer
+from trackers import DEFAULT_TRACKER
+
+#Replays: every click of a song, which is all it takes to score the song
+#again. The game runs in fixed steps (see PygameGame.simulate()), so a click
+#is pinned down by the step it was handled at, how far the song had moved
+#on from that step when it arrived, and where it was. Together with the song
+#(by hash) and the layout seed, that replays the judgement exactly, and
+#rescore() does it without pygame or a clock, in a tiny fraction of the
+#song's length. Check replays with
+#
+#   python replay.py Replays/MEGALOVANIA-20161018-120000.replay
+
+MAGIC = b"ABRP"
+#Bump when the format changes, replays of any other version are turned down.
+VERSION = 3
+#Magic, version, song SHA-1, chart digest, seed, any beat, then the rules:
+#start time, step, approach, window width, start clock, hit radius.
+HEADER = struct.Struct("<4sB20s8sqB5dH")
+#Layout: width, height, radius, min and max distance, ordinal max, colors.
+LAYOUT = struct.Struct("<7H")
+RESULTS = ("score", "maxCombo", "perfects", "goods", "bads", "misses")
+
+#Song positions are stored in whole microseconds, and the game judges with
+#exactly that (see PygameGame.getInputOffset()).
+def toMicroseconds(seconds):
+    return int(round(seconds * 1000000))
+
+def fromMicroseconds(us):
+    return us / 1000000
+
+#Identifies the chart a replay was played on: the same song and seed with
+#different analysis would give different beats.
+def getChartDigest(chart):
+    sha = hashlib.sha1()
+    for array in (chart.times, chart.xs, chart.ys):
+        sha.update(numpy.ascontiguousarray(array).tobytes())
+    return sha.digest()[:8]
+
+#Unsigned LEB128, 7 bits per byte.
+def writeVarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def readVarint(data, pos):
+    (value, shift) = (0, 0)
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+#Signed numbers as unsigned ones, small either way: 0, -1, 1, -2, ...
+def zigzag(value):
+    return (value << 1) if (value >= 0) else ((-value << 1) - 1)
+
+def unzigzag(value):
+    return (value >> 1) if ((value & 1) == 0) else -((value + 1) >> 1)
+
+class Replay(object):
+    DIRECTORY = os.path.normpath("Replays")
+
+    #digest is the song file's SHA-1 (hex), chartDigest getChartDigest() of
+    #the chart (None until it's known), start the game's simTime before
+    #the first step, layout the ChartCompiler settings, and profile and
+    #tracker the analysis profile and beat tracker, mode the analysis mode
+    #(see audio.getAnalysisParams()). The rest are the game's timing rules.
+    def __init__(self, digest, chartDigest, seed, start, step, layout,
+                    profile, approach=1.0, width=0.06, startClock=0.1,
+                    hitRadius=51, anyBeat=False, tracker=DEFAULT_TRACKER,
+                    mode="full"):
+        self.digest = digest
+        self.chartDigest = chartDigest
+        self.seed = seed
+        self.start = start
+        self.step = step
+        self.layout = layout
+        self.profile = profile
+        self.approach = approach
+        self.width = width
+        self.startClock = startClock
+        self.hitRadius = hitRadius
+        self.anyBeat = anyBeat
+        self.tracker = tracker
+        self.mode = mode
+        #(step, offset in microseconds, x, y) per click, in order. The song
+        #ending is (step, None, None, None).
+        self.events = []
+        #Steps played in all, and the results the game came up with.
+        self.steps = 0
+        self.results = None
+
+    def addInput(self, step, offset, x, y):
+        self.events.append((step, offset, x, y))
+
+    def addEnd(self, step):
+        self.events.append((step, None, None, None))
+
+    def finish(self, steps, results):
+        self.steps = steps
+        self.results = results
+
+    def getDuration(self):
+        return self.steps * self.step
+
+    #Fixed header, the layout, the profile, tracker and mode names, the
+    #results, then one entry per event: steps since the last one (shifted
+    #left, with the low bit set for the song ending), and for clicks the
+    #offset and the change in position since the last click.
+    def toBytes(self):
+        seed = -1 if (self.seed == None) else self.seed
+        out = bytearray(HEADER.pack(MAGIC, VERSION,
+                        bytes.fromhex(self.digest), self.chartDigest, seed,
+                        int(self.anyBeat), self.start, self.step,
+                        self.approach, self.width, self.startClock,
+                        self.hitRadius))
+        out += LAYOUT.pack(*self.layout)
+        for name in (self.profile, self.tracker, self.mode):
+            name = name.encode("utf-8")
+            out.append(len(name))
+            out += name
+        for name in RESULTS:
+            writeVarint(out, self.results[name])
+        writeVarint(out, self.steps)
+
+        (prevStep, prevX, prevY) = (0, 0, 0)
+        for (step, offset, x, y) in self.events:
+            isEnd = offset == None
+            writeVarint(out, ((step - prevStep) << 1) | int(isEnd))
+            prevStep = step
+            if isEnd:
+                continue
+            writeVarint(out, zigzag(offset))
+            writeVarint(out, zigzag(x - prevX))
+            writeVarint(out, zigzag(y - prevY))
+            (prevX, prevY) = (x, y)
+        return bytes(out)
+
+    @classmethod
+    def fromBytes(cls, data):
+        fields = HEADER.unpack_from(data, 0)
+        (magic, version, digest, chartDigest, seed, anyBeat) = fields[:6]
+        if magic != MAGIC:
+            raise ValueError("not a replay")
+        if version != VERSION:
+            raise ValueError("unsupported replay version %d" % version)
+        (start, step, approach, width, startClock, hitRadius) = fields[6:]
+        pos = HEADER.size
+        layout = LAYOUT.unpack_from(data, pos)
+        pos += LAYOUT.size
+        #Profile, tracker and mode.
+        names = []
+        for i in range(3):
+            length = data[pos]
+            names.append(data[pos + 1:pos + 1 + length].decode("utf-8"))
+            pos += 1 + length
+        (profile, tracker, mode) = names
+        replay = cls(digest.hex(), chartDigest, None if (seed < 0) else seed,
+                        start, step, layout, profile, approach, width,
+                        startClock, hitRadius, bool(anyBeat), tracker,
+                        mode)
+        results = dict()
+        for name in RESULTS:
+            (results[name], pos) = readVarint(data, pos)
+        (steps, pos) = readVarint(data, pos)
+        replay.finish(steps, results)
+
+        (prevStep, prevX, prevY) = (0, 0, 0)
+        while pos < len(data):
+            (value, pos) = readVarint(data, pos)
+            prevStep += value >> 1
+            if value & 1:
+                replay.addEnd(prevStep)
+                continue
+            (offset, pos) = readVarint(data, pos)
+            (dx, pos) = readVarint(data, pos)
+            (dy, pos) = readVarint(data, pos)
+            (prevX, prevY) = (prevX + unzigzag(dx), prevY + unzigzag(dy))
+            replay.addInput(prevStep, unzigzag(offset), prevX, prevY)
+        return replay
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.toBytes())
+
+    #Writes <name>-<date>.replay into directory, returns the path.
+    def dump(self, name, directory=DIRECTORY):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(directory, "%s-%s.replay" % (name, stamp))
+        self.save(path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.fromBytes(f.read())
+
+#Scores a replay on a chart again. This goes through the same steps as the
+#game, but from click to click rather than one step at a time: every beat's
+#clock goes up by the same step from the same start, so one table of clock
+#values (added up in the same order as the game does, for the same rounding)
+#gives any beat's clock at any step.
+class Rescorer(object):
+    def __init__(self, replay, chart):
+        self.replay = replay
+        self.scorer = Scorer(replay.approach, replay.width)
+        simTimes = numpy.cumsum(numpy.concatenate(([replay.start],
+                                    numpy.full(replay.steps, replay.step))))
+        #A beat appears at the first step where simTime + approach reaches
+        #its time, and is a miss at the step its clock reaches scorer.kill.
+        appear = numpy.searchsorted(simTimes + replay.approach, chart.times)
+        self.appear = numpy.maximum(appear, 1).tolist()
+        kill = self.scorer.kill
+        length = int(numpy.ceil((kill - replay.startClock) / replay.step)) + 2
+        self.clocks = numpy.cumsum(numpy.concatenate(([replay.startClock],
+                                    numpy.full(length, replay.step))))
+        self.lifeSteps = int(numpy.searchsorted(self.clocks, kill))
+        (self.xs, self.ys) = (chart.xs.tolist(), chart.ys.tolist())
+        self.count = len(self.appear)
+        self.judged = [False] * self.count
+        #Oldest beat not judged yet, and the next one that might run out.
+        self.front = 0
+        self.expired = 0
+
+    def run(self):
+        for (step, offset, x, y) in self.replay.events:
+            self.expire(step)
+            if offset == None:
+                self.scorer.endCombo()
+            else:
+                self.click(step, offset, x, y)
+        self.expire(self.replay.steps)
+        return self.scorer
+
+    #Misses every beat that ran out by step, like gameTimerFired().
+    def expire(self, step):
+        i = self.expired
+        while (i < self.count) and (self.appear[i]+self.lifeSteps-1 <= step):
+            if not self.judged[i]:
+                self.judged[i] = True
+                self.scorer.miss()
+            i += 1
+        self.expired = i
+        while (self.front < self.count) and self.judged[self.front]:
+            self.front += 1
+
+    #Same as PygameGame.beatPressed().
+    def click(self, step, offset, x, y):
+        beat = self.find(step, x, y)
+        if beat == None:
+            return
+        clock = (self.clocks[step - self.appear[beat] + 1] +
+                    fromMicroseconds(offset))
+        mistake = self.scorer.addScore(clock)
+        if mistake == None:
+            return
+        elif mistake:
+            self.scorer.miss()
+        else:
+            self.scorer.hit()
+        self.judged[beat] = True
+
+    #The beat a click at step lands on: the oldest one on screen, if it's
+    #under (x, y), or with anyBeat the oldest one under (x, y).
+    def find(self, step, x, y):
+        radius2 = self.replay.hitRadius * self.replay.hitRadius
+        i = self.front
+        while (i < self.count) and (self.appear[i] <= step):
+            (dx, dy) = (x - self.xs[i], y - self.ys[i])
+            if (not self.judged[i]) and (dx * dx + dy * dy <= radius2):
+                return i
+            if not self.replay.anyBeat:
+                return None
+            i += 1
+        return None
+
+def rescore(replay, chart):
+    return Rescorer(replay, chart).run()
+
+#Rebuilds the chart a replay was played on from the song at path.
+def buildChart(replay, path):
+    import audio
+    from chart import ChartCompiler
+    params = audio.getAnalysisParams(replay.mode, replay.profile,
+                                        replay.tracker)
+    analysis = audio.analyzeFile(path, params, audio.analysisCache)
+    (width, height, radius, minDist, maxDist, ordinalMax, colors) = \
+        replay.layout
+    #Only the number of colors matters to the layout.
+    compiler = ChartCompiler(width, height, radius, minDist, maxDist,
+                                ordinalMax, list(range(colors)), replay.seed)
+    return compiler.compile(analysis.times)
+
+#The rules in a replay's header (name, recorded, the game's) that aren't the
+#game's own (see scoring.py). Scores can only be vouched for under those,
+#the header comes from the same file as the results.
+def getRuleMismatches(replay):
+    rules = [("approach", replay.approach, scoring.APPROACH),
+             ("width", replay.width, scoring.WINDOW_WIDTH),
+             ("step", replay.step, scoring.STEP),
+             ("startClock", replay.startClock, scoring.START_CLOCK),
+             ("hitRadius", replay.hitRadius, scoring.HIT_RADIUS),
+             ("anyBeat", replay.anyBeat, scoring.ANY_BEAT)]
+    return [rule for rule in rules if rule[1] != rule[2]]
+
+#Looks through directory for the song a replay was played on.
+def findSong(replay, directory):
+    import audio
+    from library import EXTENSIONS
+    for (root, dirs, files) in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith(EXTENSIONS):
+                continue
+            path = os.path.normpath(os.path.join(root, name))
+            if audio.analysisCache.fileDigest(path) == replay.digest:
+                return path
+    return None
+
+#Returns True if the replay's results are what rescoring it gives.
+def verify(path, songPath=None, songDirectory="Songs"):
+    replay = Replay.load(path)
+    mismatches = getRuleMismatches(replay)
+    if len(mismatches) > 0:
+        print("%s: not played by the game's rules" % path)
+        for (name, recorded, rule) in mismatches:
+            print("  %-10s %s, should be %s" % (name, recorded, rule))
+        return False
+    if songPath == None:
+        songPath = findSong(replay, songDirectory)
+        if songPath == None:
+            print("%s: song %s not found in %s" % (path, replay.digest,
+                                                    songDirectory))
+            return False
+    chart = buildChart(replay, songPath)
+    if getChartDigest(chart) != replay.chartDigest:
+        print("%s: the chart for %s came out differently" % (path, songPath))
+        return False
+
+    start = time.perf_counter()
+    results = rescore(replay, chart).getResults()
+    elapsed = time.perf_counter() - start
+
+    matches = results == replay.results
+    print("%s: %s" % (path, "OK" if matches else "MISMATCH"))
+    print("  %s, %d clicks, seed %s" % (songPath, sum(1 for event in
+            replay.events if event[1] != None), replay.seed))
+    for name in RESULTS:
+        mark = "" if (results[name] == replay.results[name]) else "  <--"
+        print("  %-9s %8d  replayed %8d%s" % (name, replay.results[name],
+                                            results[name], mark))
+    speed = replay.getDuration() / elapsed if (elapsed > 0) else 0
+    print("  rescored in %.2f ms, %.0fx real time" % (elapsed * 1000, speed))
+    return matches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Score replays again and check they match.")
+    parser.add_argument("replays", nargs="+")
+    parser.add_argument("--song", default=None,
+                        help="the song the replays were played on")
+    parser.add_argument("--songs", default="Songs",
+                        help="folder to look for the song in (default Songs)")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for path in args.replays:
+        if not verify(path, args.song, args.songs):
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#Judging hits and keeping score. This is everything that decides a player's
+#score, kept apart from the game so a replay can be scored again without
+#pygame (see replay.py).
+
+#The rules every score is judged by. The game plays by these, and replay.py
+#turns down replays recorded under anything else.
+#Seconds a beat is on screen before its perfect moment, and the width of
+#each judgement window (see Scorer).
+APPROACH = 1.0
+WINDOW_WIDTH = 0.06
+#Seconds per game step (see PygameGame.simulate()).
+STEP = 1 / 1000
+#A beat's clock when it appears. Due to timing imprecisions with pygame, a
+#global offset on beats needs to be implemented, so clocks start at 0.1
+#seconds.
+START_CLOCK = 0.1
+#Clicks this far from a beat's center (in pixels) hit it, one pixel more
+#than it's drawn.
+HIT_RADIUS = 51
+#Whether any beat under the cursor can be hit, not just the oldest one.
+ANY_BEAT = False
+
+class Scorer(object):
+    BAD = 50
+    GOOD = 100
+    PERFECT = 300
+
+    #A beat is perfect when its clock reaches approach, and the width
+    #between the different scores is dictated by width.
+    def __init__(self, approach=1.0, width=0.06):
+        self.approach = approach
+        self.width = width
+
+        self.goodLate = approach + width
+        self.badLate = self.goodLate + width
+        self.missLate = self.badLate + width
+        #Beats nobody hit are a miss once their clock gets here.
+        self.kill = self.missLate + width
+
+        self.perfectEarly = approach - width
+        self.goodEarly = self.perfectEarly - width
+        self.badEarly = self.goodEarly - width
+        self.missEarly = self.badEarly - width
+        self.reset()
+
+    def reset(self):
+        self.combo = 0
+        self.maxCombo = 0
+        self.score = 0
+        self.prevAddition = 0
+
+        self.misses = 0
+        self.bads = 0
+        self.goods = 0
+        self.perfects = 0
+
+    #Judges a beat clicked when its clock was at time. Returns True if a
+    #mistake is made, None if player clicks early, and increments score
+    #otherwise. Hits don't add to the combo until hit() is called.
+    def addScore(self, time):
+        if (time >= self.missLate):
+            return True
+        elif (time >= self.badLate):
+            addition = Scorer.BAD
+        elif (time >= self.goodLate):
+            addition = Scorer.GOOD
+        elif (time >= self.perfectEarly):
+            addition = Scorer.PERFECT
+        elif (time >= self.goodEarly):
+            addition = Scorer.GOOD
+        elif (time >= self.badEarly):
+            addition = Scorer.BAD
+        elif (time >= self.missEarly):
+            return True
+        else:
+            return None
+
+        self.scoreTrack(addition)
+
+        return False
+
+    #Increments counter for each hit type.
+    def scoreTrack(self, addition):
+        mult = self.getComboMult()
+        self.score = int(self.score + (addition * mult))
+        self.prevAddition = addition
+
+        if (addition == Scorer.BAD):
+            self.bads += 1
+        elif (addition == Scorer.GOOD):
+            self.goods += 1
+        elif (addition == Scorer.PERFECT):
+            self.perfects += 1
+
+    #Based off how osu! calculates this, from: https://osu.ppy.sh/wiki/Score
+    def getComboMult(self):
+        return (1 + self.combo/25)
+
+    def hit(self):
+        self.combo += 1
+
+    #Clicked too early or late, or never clicked at all.
+    def miss(self):
+        self.endCombo()
+        self.combo = 0
+        self.misses += 1
+
+    def endCombo(self):
+        if (self.combo > self.maxCombo): self.maxCombo = self.combo
+
+    def getResults(self):
+        return {"score": self.score, "maxCombo": self.maxCombo,
+                "perfects": self.perfects, "goods": self.goods,
+                "bads": self.bads, "misses": self.misses}
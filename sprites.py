@@ -4,176 +4,331 @@ import os
 from pygame import gfxdraw
 import random
 
-class Beat(pygame.sprite.Sprite):
-    #RGB numbers for white
+import numpy
+
+from fonts import renderText, anchorPoint, TEXT_FONT
+from hittest import HitGrid
+from assets import getImage
+from scoring import HIT_RADIUS, START_CLOCK
+
+#Pre-rendered pieces of a Beat: the numbered body for every (color, ordinal)
+#and approach rings, which fading beats need as surfaces (live rings are
+#drawn straight to the screen). Building these once per song means drawing
+#a beat each frame is a handful of blits, with no surfaces, fonts or
+#smoothscales created on the way.
+class BeatAtlas(object):
     WHITE = (255, 255, 255)
-    def __init__(self, x, y, color, ordinal):
-        super(Beat, self).__init__()
-        #Due to timing imprecisions with pygame, a global offset on beats needs
-        #to be implemented, so self.clock is initialized to 0.1 seconds.
-        self.clock = 0.1
-        self.radius = 50
-        self.rOuter = self.radius * 5
-        self.rRing = self.rOuter
-        self.ringWidth = 3
-        self.dRadius = (self.rOuter // 60) - (self.radius // 60)
-        self.outline = 4
-        self.x = x
-        self.y = y
-        self.rect = pygame.Rect(self.x - self.rOuter, self.y - self.rOuter,
-                                2 * self.rOuter, 2 * self.rOuter)
-        self.image = pygame.Surface((2 * self.rOuter, 2 * self.rOuter),
-                                    pygame.SRCALPHA|pygame.HWSURFACE)
-        self.ord = ordinal
-        self.fontSize = 50
-        #2 tenths of a second.
-        self.killTime = 0.2
-        self.killClock = None
-        self.color = color
-        self.draw()
+    RADIUS = 50
+    R_OUTER = RADIUS * 5
+    RING_WIDTH = 3
+    #How far the ring closes per 1/60 of a second, the frame rate the game
+    #was tuned at.
+    D_RADIUS = (R_OUTER // 60) - (RADIUS // 60)
+    RING_SPEED = D_RADIUS * 60
+    OUTLINE = 4
+    FONT_SIZE = 50
 
-    def update(self, tick):
-        self.clock += tick
-        if self.killClock != None:
-            self.killClock -= tick
-            if self.killClock <= 0:
-                self.kill()
-        if (self.rRing > self.radius):
-            self.rRing -= self.dRadius
-        self.draw()
-
-    def draw(self):
-        #Fills in white, with the fourth number being the alpha (transparent).
-        self.image.fill((255,255,255,0))
-        pygame.draw.circle(self.image, Beat.WHITE, (self.rOuter, self.rOuter),
-            self.rRing, self.ringWidth)
-        (radius, outline) = (2 * self.radius, 2 * self.outline)
+    bodies = dict()
+    rings = dict()
+
+    #Renders everything a song can need up front.
+    @classmethod
+    def build(cls, colors, ordinals):
+        for color in colors:
+            for ordinal in ordinals:
+                cls.getBody(color, ordinal)
+        #Most beats fade out after their ring has closed.
+        cls.getRing(cls.RADIUS)
+
+    @classmethod
+    def getBody(cls, color, ordinal):
+        key = (tuple(color), ordinal)
+        if key not in cls.bodies:
+            cls.bodies[key] = cls.renderBody(color, ordinal)
+        return cls.bodies[key]
+
+    @classmethod
+    def getRing(cls, rRing):
+        if rRing not in cls.rings:
+            cls.rings[rRing] = cls.renderRing(rRing)
+        return cls.rings[rRing]
+
+    @classmethod
+    def renderBody(cls, color, ordinal):
+        #Drawn at twice the size and scaled down, for antialiasing.
+        (radius, outline) = (2 * cls.RADIUS, 2 * cls.OUTLINE)
         surface = pygame.Surface((2 * radius, 2 * radius),
                                     pygame.SRCALPHA|pygame.HWSURFACE)
-        pygame.draw.circle(surface, Beat.WHITE, (radius, radius), radius)
-        pygame.draw.circle(surface, self.color, (radius, radius),
-                        radius-outline)
-        (width, height) = (2 * self.radius, 2 * self.radius)
-        surface = pygame.transform.smoothscale(surface, (width, height))
-        startPoint = self.rOuter - self.radius
-        self.image.blit(surface, (startPoint,startPoint))
-        self.drawText()
-
-        if self.killClock != None:
-            alpha = max(int((self.killClock/self.killTime) * 255), 0)
-            alpha = max(alpha, 0)
-            rectToFill = (startPoint, startPoint, width, height)
-            self.image.fill((255, 255, 255, alpha), rectToFill,
-                                pygame.BLEND_RGBA_MIN)
-
-    def drawText(self):
-        font = pygame.font.Font(None, self.fontSize)
-        text = font.render(str(self.ord), 1, Beat.WHITE)
+        pygame.draw.circle(surface, cls.WHITE, (radius, radius), radius)
+        pygame.draw.circle(surface, color, (radius, radius), radius-outline)
+        size = (2 * cls.RADIUS, 2 * cls.RADIUS)
+        body = pygame.transform.smoothscale(surface, size)
+
+        text = renderText(None, cls.FONT_SIZE, str(ordinal), cls.WHITE)
         pos = text.get_rect()
-        pos.centerx = self.image.get_rect().centerx
-        pos.centery = self.image.get_rect().centery
-        self.image.blit(text, pos)
-
-    def getPos(self):
-        return (self.x, self.y)
-
-    def dying(self):
-        self.killClock = self.killTime
-
-#Used for collision detection.
-class MousePointer(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        super(MousePointer, self).__init__()
-        self.radius = 1
-        self.x = x
-        self.y = y
-        self.rect = pygame.Rect(self.x - self.radius, self.y - self.radius,
-                                2 * self.radius, 2 * self.radius)
-
-class Text(pygame.sprite.Sprite):
-    WHITE = (255, 255, 255)
-    FONT = os.path.normpath("Fonts/Nunito-Regular.ttf")
-    def __init__(self, surface, text, size, x, y, anchor="nw", 
-                                                color=WHITE, fontType=FONT):
-        super(Text, self).__init__()
-        (self.x, self.y) = (x, y)
-        self.text = text
-        self.anchor = anchor
-        self.color = color
-        self.clock = 0
-
-        #Font downloaded from http://google.com/fonts
-        self.font = pygame.font.Font(fontType, size)
-
-        (self.width, self.height) = self.font.size(self.text)
-        self.initPos()
-        self.rect = pygame.Rect(self.rectX, self.rectY, 
-                        self.width, self.height)
-        self.image = pygame.Surface((self.width, self.height), pygame.HWSURFACE)
-        self.killTime = 0.2
-        self.killClock = None
-        self.draw()
-        self.target = surface
-        self.target.blit(self.image, (self.rectX, self.rectY))
-
-    def initPos(self):
-        if (self.anchor == "nw"):
-            self.rectX = self.x
-            self.rectY = self.y
-        elif (self.anchor == "ne"):
-            self.rectX = self.x - self.width
-            self.rectY = self.y
-        elif (self.anchor == "sw"):
-            self.rectX = self.x
-            self.rectY = self.y - self.height
-        elif (self.anchor == "se"):
-            self.rectX = self.x - self.width
-            self.rectY = self.y - self.height
-        elif (self.anchor == "center"):
-            self.rectX = self.x - self.width//2
-            self.rectY = self.y - self.height//2
-
-    def draw(self):
-        text = self.font.render(self.text, 1, self.color)
-        self.image.blit(text, (0, 0))
-
-        if self.killClock != None:
-            alpha = int((self.killClock/self.killTime) * 255)
-            alpha = max(alpha, 0)
-            self.image.set_alpha(alpha)
-
-    def update(self, tick=0):
-        self.clock += tick
-        if self.killClock != None:
-            self.killClock -= tick
-            if self.killClock <= 0:
-                self.kill()
-        self.draw()
-        self.target.blit(self.image, (self.rectX, self.rectY))
-
-    def dying(self):
-        self.killClock = self.killTime
-
-#Stable text, or text that doesn't need to fade out.
-class StText(Text):
-    WHITE = (255, 255, 255, 0)
-    BG = (77, 119, 182, 0)
-    FONT = os.path.normpath("Fonts/Rubik-Italic.ttf")
-    def __init__(self, surface, text, size, x, y, anchor="nw", 
-                                                color=WHITE, fontType=FONT):
-        super().__init__(surface, text, size, x, y, anchor, color, fontType)
-
-    def draw(self):
-        super().draw()
-        text = self.font.render(self.text, 1, self.color, StText.BG)
-        self.image.blit(text, (0, 0))
-
-#Button uses an image for the visuals.
+        pos.center = body.get_rect().center
+        body.blit(text, pos)
+        return body
+
+    @classmethod
+    def renderRing(cls, rRing):
+        size = 2 * rRing + 1
+        surface = pygame.Surface((size, size),
+                                    pygame.SRCALPHA|pygame.HWSURFACE)
+        pygame.draw.circle(surface, cls.WHITE, (rRing, rRing), rRing,
+                            cls.RING_WIDTH)
+        return surface
+
+#Everything on screen that lives for a while and then fades out, stored as
+#one NumPy array per attribute instead of one Sprite per object. Objects are
+#always added in time order and all live equally long, so they (almost
+#always) leave in order too, and removing finished ones is a single shift
+#at the front of the arrays.
+class FadingField(object):
+    #Seconds an object takes to fade out.
+    KILL_TIME = 0.2
+    #Name -> dtype of every per-object array.
+    FIELDS = {"x": numpy.int32, "y": numpy.int32, "clock": numpy.float64,
+              "killClock": numpy.float64}
+
+    def __init__(self, capacity=32):
+        for (name, dtype) in self.FIELDS.items():
+            setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+        #Objects on screen. killClock is infinite for the ones not fading.
+        self.count = 0
+        #Rects drawn to last frame, see clear().
+        self.drawn = []
+
+    def __len__(self):
+        return self.count
+
+    #Index for a new object at the back, with the arrays grown if needed.
+    def append(self):
+        if self.count == len(self.clock):
+            for name in self.FIELDS:
+                array = getattr(self, name)
+                setattr(self, name, numpy.concatenate((array, array)))
+        i = self.count
+        self.count += 1
+        self.killClock[i] = numpy.inf
+        return i
+
+    #Drops the n oldest objects.
+    def removeFront(self, n):
+        if n <= 0:
+            return
+        count = self.count
+        for name in self.FIELDS:
+            array = getattr(self, name)
+            array[:count - n] = array[n:count]
+        self.count -= n
+
+    def fade(self, i):
+        self.killClock[i] = FadingField.KILL_TIME
+
+    def isFading(self, i):
+        return self.killClock[i] != numpy.inf
+
+    #Moves every clock forward and removes whatever finished fading. One
+    #that started fading out of order (see BeatField.judge()) stays in the
+    #arrays, not drawn, until the ones before it are gone too.
+    def update(self, tick):
+        self.clock[:self.count] += tick
+        killClocks = self.killClock[:self.count]
+        killClocks -= tick
+        done = killClocks <= 0
+        self.removeFront(self.count if done.all() else int(done.argmin()))
+
+    #Alpha of fading object i, lead seconds after the last update.
+    def getAlpha(self, i, lead=0.0):
+        killClock = self.killClock[i] - lead
+        return max(int((killClock / FadingField.KILL_TIME) * 255), 0)
+
+    #Paints the background over last frame's rects, like Group.clear().
+    def clear(self, surface, background):
+        for rect in self.drawn:
+            surface.blit(background, rect, rect)
+
+    #Returns last frame's rects and this frame's, like RenderUpdates.draw().
+    #Objects are drawn as they are lead seconds after the last update().
+    def draw(self, surface, lead=0.0):
+        previous = self.drawn
+        self.drawn = self.drawObjects(surface, lead)
+        return previous + self.drawn
+
+    def empty(self):
+        self.count = 0
+
+#The beats on screen, drawn from BeatAtlas. Beats waiting to be hit are
+#also in a HitGrid, so clicks can find them.
+class BeatField(FadingField):
+    RADIUS = BeatAtlas.RADIUS
+    #See scoring.py.
+    HIT_RADIUS = HIT_RADIUS
+    START_CLOCK = START_CLOCK
+    FIELDS = dict(FadingField.FIELDS, color=numpy.int8, ordinal=numpy.int8,
+                    id=numpy.int64)
+
+    #colors is what the color indices passed to add() refer to.
+    def __init__(self, colors, capacity=32):
+        super().__init__(capacity)
+        self.colors = colors
+        #Keyed by id, which unlike the index never changes.
+        self.grid = HitGrid()
+        self.nextId = 0
+        self.waitingCount = 0
+
+    def add(self, x, y, color, ordinal):
+        i = self.append()
+        (self.x[i], self.y[i]) = (x, y)
+        self.clock[i] = BeatField.START_CLOCK
+        (self.color[i], self.ordinal[i]) = (color, ordinal)
+        self.id[i] = self.nextId
+        self.grid.addCircle(self.nextId, x, y, BeatField.HIT_RADIUS)
+        self.nextId += 1
+        self.waitingCount += 1
+
+    #Beats still waiting to be hit.
+    def waiting(self):
+        return self.waitingCount
+
+    #Index of the oldest beat waiting to be hit.
+    def front(self):
+        return int(numpy.isinf(self.killClock[:self.count]).argmax())
+
+    #Indices of the beats waiting to be hit under (x, y), oldest first.
+    def under(self, x, y):
+        ids = self.grid.at(x, y)
+        if len(ids) == 0:
+            return []
+        return self.id[:self.count].searchsorted(ids).tolist()
+
+    #Judges beat i (the oldest waiting one by default): it starts fading and
+    #can't be clicked any more. Returns its index.
+    def judge(self, i=None):
+        if i == None:
+            i = self.front()
+        self.fade(i)
+        self.grid.remove(int(self.id[i]))
+        self.waitingCount -= 1
+        return i
+
+    def getPos(self, i):
+        return (int(self.x[i]), int(self.y[i]))
+
+    #Ring radius of every beat, lead seconds after the last update. Rings
+    #close at a fixed speed, however often they get drawn.
+    def getRings(self, lead=0.0):
+        elapsed = self.clock[:self.count] + (lead - BeatField.START_CLOCK)
+        rings = BeatAtlas.R_OUTER - (elapsed * BeatAtlas.RING_SPEED)
+        return numpy.maximum(rings.astype(numpy.int32), BeatField.RADIUS)
+
+    def empty(self):
+        super().empty()
+        self.grid.clear()
+        self.waitingCount = 0
+
+    def getBody(self, i):
+        return BeatAtlas.getBody(self.colors[self.color[i]],
+                                    int(self.ordinal[i]))
+
+    #Live rings are drawn straight onto surface, exactly like the atlas
+    #renders them. Fading beats need their own alpha, so they are drawn from
+    #the atlas' shared surfaces instead.
+    def drawObjects(self, surface, lead=0.0):
+        rects = []
+        radius = BeatField.RADIUS
+        (white, width) = (BeatAtlas.WHITE, BeatAtlas.RING_WIDTH)
+        xs = self.x[:self.count].tolist()
+        ys = self.y[:self.count].tolist()
+        rings = self.getRings(lead).tolist()
+        killClocks = self.killClock[:self.count].tolist()
+        for i in range(self.count):
+            (x, y, rRing) = (xs[i], ys[i], rings[i])
+            body = self.getBody(i)
+            bodyPos = (x - radius, y - radius)
+            if killClocks[i] == numpy.inf:
+                rects.append(pygame.draw.circle(surface, white, (x, y),
+                                                rRing, width))
+                surface.blit(body, bodyPos)
+                continue
+            alpha = self.getAlpha(i, lead)
+            if alpha <= 0:
+                continue
+            ring = BeatAtlas.getRing(rRing)
+            ring.set_alpha(alpha)
+            body.set_alpha(alpha)
+            rects.append(surface.blit(ring, (x - rRing, y - rRing)))
+            surface.blit(body, bodyPos)
+            #Not None, that would turn off per-pixel alpha too.
+            ring.set_alpha(255)
+            body.set_alpha(255)
+        return rects
+
+#Score and miss markers left where beats were hit. Each kind of marker is
+#rendered once onto a shared surface; x and y are the top left corners.
+class HitMarkers(FadingField):
+    FIELDS = dict(FadingField.FIELDS, kind=numpy.int16)
+    FONT = TEXT_FONT
+
+    #lifetime is how long markers stay before they start fading.
+    def __init__(self, lifetime, capacity=32):
+        super().__init__(capacity)
+        self.lifetime = lifetime
+        #(text, size, color) -> index into surfaces.
+        self.kinds = dict()
+        self.surfaces = []
+
+    def getKind(self, text, size, color):
+        key = (text, size, tuple(color))
+        if key not in self.kinds:
+            text = renderText(HitMarkers.FONT, size, text, color)
+            surface = pygame.Surface(text.get_size(), pygame.HWSURFACE)
+            surface.blit(text, (0, 0))
+            self.kinds[key] = len(self.surfaces)
+            self.surfaces.append(surface)
+        return self.kinds[key]
+
+    #Centered on (x, y).
+    def add(self, text, size, x, y, color):
+        kind = self.getKind(text, size, color)
+        (width, height) = self.surfaces[kind].get_size()
+        i = self.append()
+        (self.x[i], self.y[i]) = anchorPoint(x, y, width, height, "center")
+        self.clock[i] = 0
+        self.kind[i] = kind
+
+    def update(self, tick):
+        super().update(tick)
+        count = self.count
+        expired = ((self.clock[:count] >= self.lifetime) &
+                    numpy.isinf(self.killClock[:count]))
+        self.killClock[:count][expired] = FadingField.KILL_TIME
+
+    def drawObjects(self, surface, lead=0.0):
+        rects = []
+        xs = self.x[:self.count].tolist()
+        ys = self.y[:self.count].tolist()
+        kinds = self.kind[:self.count].tolist()
+        for i in range(self.count):
+            image = self.surfaces[kinds[i]]
+            if self.isFading(i):
+                image.set_alpha(self.getAlpha(i, lead))
+            else:
+                image.set_alpha(255)
+            rects.append(surface.blit(image, (xs[i], ys[i])))
+        return rects
+
+#Button uses an image for the visuals, which isn't loaded until the button
+#is first drawn (see assets.getImage()).
 class Button(pygame.sprite.Sprite):
     def __init__(self, path, x, y, width, height):
         super(Button, self).__init__()
         (self.x, self.y) = (x, y)
         (self.width, self.height) = (width, height)
-        self.image = pygame.image.load(os.path.normpath(path))
-        self.image = self.image.convert_alpha()
-        self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
\ No newline at end of file
+        self.path = os.path.normpath(path)
+        self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
+
+    @property
+    def image(self):
+        return getImage(self.path)
\ No newline at end of file
@@ -0,0 +1,49 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from cache import writeAtomic
+
+class WriteAtomicTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "sub", "entry.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testWritesChunks(self):
+        writeAtomic(self.path, b"ab", b"cd")
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abcd")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                            ["entry.bin"])
+
+    #Threads writing the same path leave one of them's data, whole.
+    def testThreadsWritingOnePath(self):
+        contents = [bytes([i]) * 100000 for i in range(8)]
+        errors = []
+        def write(data):
+            try:
+                for i in range(20):
+                    writeAtomic(self.path, data[:50000], data[50000:])
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=write, args=(data,))
+                    for data in contents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with open(self.path, "rb") as f:
+            self.assertIn(f.read(), contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                            ["entry.bin"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+import soundfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+#Sets up pygame without a display or sound card.
+from headless import HeadlessRun
+import audio
+import replay
+from cache import AnalysisCache
+
+#Seconds of clicks at bpm, long enough for BeatStream to report beats a
+#few times over.
+def writeClicks(path, bpm=120, seconds=40, sr=22050):
+    y = numpy.zeros(seconds * sr, dtype=numpy.float32)
+    click = numpy.exp(-numpy.arange(sr // 50) / (sr / 500))
+    noise = numpy.random.default_rng(0).uniform(-1, 1, len(click))
+    for start in numpy.arange(0.5, seconds - 0.5, 60 / bpm):
+        i = int(start * sr)
+        y[i:i + len(click)] += (0.8 * click * noise).astype(numpy.float32)
+    soundfile.write(path, y, sr)
+
+#Plays the song the way the game does when it streams one: from the first
+#beats found, with the rest of the chart laid out as they come in. The run
+#only starts once the stream is done, so it can't get ahead of it.
+class StreamedRun(HeadlessRun):
+    def __init__(self, path, cache):
+        super().__init__(path, mode="stream")
+        self.cache = cache
+        self.startBeats = None
+
+    def startSong(self, game):
+        song = audio.Song(game.songPath, self.cache, lazy=True,
+                            tracker=self.tracker)
+        song.analyzeStreaming()
+        while not song.isReady():
+            time.sleep(0.01)
+        game.song = song
+        game.startSong()
+        self.startBeats = len(game.chart)
+        while song.isStreaming():
+            time.sleep(0.01)
+
+class ReplayFormatTest(unittest.TestCase):
+    def makeReplay(self):
+        layout = (1500, 850, 50, 100, 200, 4, 4)
+        result = replay.Replay("ab" * 20, bytes(8), 5, -1.0, 0.001, layout,
+                                "accurate", tracker="numpy", mode="stream")
+        result.addInput(1200, -350, 700, 400)
+        result.addEnd(90000)
+        result.finish(92000, dict.fromkeys(replay.RESULTS, 1))
+        return result
+
+    def testRoundTrip(self):
+        original = self.makeReplay()
+        loaded = replay.Replay.fromBytes(original.toBytes())
+        self.assertEqual((loaded.profile, loaded.tracker, loaded.mode),
+                            ("accurate", "numpy", "stream"))
+        self.assertEqual(loaded.events, original.events)
+        self.assertEqual(loaded.results, original.results)
+
+    def testOtherVersionsAreTurnedDown(self):
+        data = bytearray(self.makeReplay().toBytes())
+        data[4] = replay.VERSION - 1
+        with self.assertRaisesRegex(ValueError, "unsupported replay version"):
+            replay.Replay.fromBytes(bytes(data))
+
+class StreamedReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.songPath = os.path.join(self.directory, "clicks.wav")
+        writeClicks(self.songPath)
+        self.cache = AnalysisCache(os.path.join(self.directory, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testStreamedRunVerifies(self):
+        run = StreamedRun(self.songPath, self.cache)
+        run.run()
+        game = run.game
+        self.assertLess(run.startBeats, len(game.chart))
+        path = os.path.join(self.directory, "clicks.replay")
+        game.finishReplay().save(path)
+        with mock.patch.object(audio, "analysisCache", self.cache):
+            self.assertTrue(replay.verify(path, self.songPath))
+
+if __name__ == "__main__":
+    unittest.main()
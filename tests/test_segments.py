@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import audio
+
+PARAMS = {"sr": None, "hop": 512}
+
+#Beats every 60 / bpm seconds from start up to (not including) end.
+def beatsAt(bpm, start, end):
+    return [float(time) for time in numpy.arange(start, end - 1e-9, 60 / bpm)]
+
+class MatchTempoTest(unittest.TestCase):
+    def testDoubleKeepsHalfInPhase(self):
+        times = beatsAt(100, 0, 72)
+        segmentTimes = beatsAt(200, 60.3, 132)
+        (kept, tempo) = audio.matchTempo(times, 100, segmentTimes, 200)
+        self.assertEqual(tempo, 100)
+        self.assertEqual(kept, segmentTimes[1::2])
+
+    def testHalfIsFilledIn(self):
+        times = beatsAt(100, 0, 72)
+        segmentTimes = beatsAt(50, 60, 132)
+        (filled, tempo) = audio.matchTempo(times, 100, segmentTimes, 50)
+        self.assertEqual(tempo, 100)
+        self.assertEqual(len(filled), 2 * len(segmentTimes) - 1)
+        self.assertTrue(numpy.allclose(numpy.diff(filled), 0.6))
+
+    def testOtherTempoIsKept(self):
+        times = beatsAt(100, 0, 72)
+        segmentTimes = beatsAt(150, 60, 132)
+        self.assertEqual(audio.matchTempo(times, 100, segmentTimes, 150),
+                            (segmentTimes, 150))
+
+class StitchBeatsTest(unittest.TestCase):
+    def testCutsOnMatchingBeat(self):
+        times = beatsAt(100, 0, 72)
+        segmentTimes = [time + 0.01 for time in beatsAt(100, 60, 132)]
+        stitched = audio.stitchBeats(times, segmentTimes, 60, 0.6)
+        self.assertEqual(stitched[0], times[0])
+        self.assertEqual(stitched[-1], segmentTimes[-1])
+        gaps = numpy.diff(stitched)
+        self.assertTrue(numpy.all((gaps > 0.58) & (gaps < 0.62)))
+
+    def testNoMatchDropsCloseBeats(self):
+        times = beatsAt(100, 0, 72)
+        segmentTimes = beatsAt(100, 60.3, 132)
+        stitched = audio.stitchBeats(times, segmentTimes, 60, 0.6)
+        gaps = numpy.diff(stitched)
+        self.assertTrue(numpy.all(gaps >= 0.45))
+        self.assertTrue(all(time < 66 for time in stitched
+                            if time in times))
+        self.assertEqual(stitched[-1], segmentTimes[-1])
+
+class JoinSegmentsTest(unittest.TestCase):
+    #The middle segment's tracker doubled the tempo. Once that's folded,
+    #the last segment is at the same tempo as the song, not half of it.
+    def testFoldedTempoCarriesOver(self):
+        results = [(0.0, 100.0, beatsAt(100, 0, 66)),
+                    (54.0, 200.0, beatsAt(200, 54, 126)),
+                    (114.0, 100.0, beatsAt(100, 114, 180))]
+        with mock.patch.object(audio, "probeFile",
+                                return_value=(180.0, 22050)):
+            analysis = audio.joinSegments("song.ogg", PARAMS, results)
+        gaps = numpy.diff(analysis.times)
+        self.assertTrue(numpy.allclose(gaps, 0.6))
+        self.assertEqual(len(analysis.times), 300)
+        self.assertAlmostEqual(analysis.tempo, 100)
+
+    def testTempoChangeIsKept(self):
+        results = [(0.0, 100.0, beatsAt(100, 0, 66)),
+                    (54.0, 150.0, beatsAt(150, 54, 120))]
+        with mock.patch.object(audio, "probeFile",
+                                return_value=(120.0, 22050)):
+            analysis = audio.joinSegments("song.ogg", PARAMS, results)
+        self.assertEqual(analysis.times[0], 0)
+        self.assertAlmostEqual(analysis.times[-1], 119.6)
+        tempoMap = audio.getTempoMap(analysis.times)
+        self.assertAlmostEqual(tempoMap[0][1], 100)
+        self.assertAlmostEqual(tempoMap[-1][1], 150)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import time
+
+#Timing for the song loop. Summing frame deltas drifts away from the music
+#over a long song, so SongClock takes the song position from the mixer
+#instead, FrameScheduler paces frames without spinning a whole core, and
+#EventStamper notes when each input actually arrived.
+
+#Song position in seconds, based on pygame.mixer.music.get_pos(). The mixer
+#only advances its position once per audio buffer, so on its own it moves in
+#steps of ~20ms. In between, the position is extrapolated from
+#time.perf_counter(), and that extrapolation is slowly pulled towards the
+#mixer's number so the two never drift apart.
+class SongClock(object):
+    #Fraction of the error between extrapolated and mixer position that gets
+    #corrected per call. Small enough to hide the mixer's steps.
+    SLEW = 0.05
+    #Errors bigger than this are a real jump (e.g. a hiccup in the audio
+    #thread), so snap to the mixer instead of slewing.
+    SNAP = 0.1
+
+    #getPos returns milliseconds since playback started or -1 when it can't
+    #tell, like pygame.mixer.music.get_pos. latency is added to every
+    #position, for audio output delay.
+    def __init__(self, getPos=None, latency=0.0, now=time.perf_counter):
+        if getPos == None:
+            import pygame
+            getPos = pygame.mixer.music.get_pos
+        self.getPos = getPos
+        self.latency = latency
+        self.now = now
+        self.start()
+
+    #Call right after playback starts.
+    def start(self):
+        #Position = base + (now - anchor) while running.
+        self.base = 0.0
+        self.anchor = self.now()
+        self.pausedAt = None
+        self.last = 0.0
+
+    def pause(self):
+        if self.pausedAt == None:
+            self.pausedAt = self.extrapolate()
+
+    def resume(self):
+        if self.pausedAt != None:
+            (self.base, self.anchor) = (self.pausedAt, self.now())
+            self.pausedAt = None
+
+    def isPaused(self):
+        return self.pausedAt != None
+
+    def extrapolate(self):
+        if self.pausedAt != None:
+            return self.pausedAt
+        return self.base + (self.now() - self.anchor)
+
+    #Song position at time t (a now() value), extrapolated from the last
+    #position(). For inputs, which happen in between frames.
+    def at(self, t):
+        if self.pausedAt != None:
+            return self.pausedAt + self.latency
+        return self.base + (t - self.anchor) + self.latency
+
+    def position(self):
+        estimate = self.extrapolate()
+        mixer = self.getPos()
+        if (mixer >= 0) and (self.pausedAt == None):
+            error = mixer / 1000 - estimate
+            if abs(error) > SongClock.SNAP:
+                correction = error
+            else:
+                correction = error * SongClock.SLEW
+            self.base += correction
+            estimate += correction
+        #Never let the song go backwards, beats would be judged twice.
+        self.last = max(self.last, estimate)
+        return self.last + self.latency
+
+#Waits out the rest of each frame. Sleeping is cheap but imprecise, spinning
+#is precise but burns a core, so this sleeps until shortly before the
+#deadline and spins only for the last bit. How early it wakes up adapts to
+#how much the OS has been oversleeping.
+class FrameScheduler(object):
+    #Longest sleep between poll() calls, see wait().
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, fps, now=time.perf_counter, sleep=time.sleep):
+        self.now = now
+        self.sleep = sleep
+        self.setFps(fps)
+        #Running estimate of how late sleep() returns.
+        self.oversleep = 0.001
+        self.reset()
+
+    #fps of 0 means no cap.
+    def setFps(self, fps):
+        self.period = (1 / fps) if fps > 0 else 0
+
+    def reset(self):
+        self.last = self.now()
+        self.deadline = self.last + self.period
+
+    #Returns seconds since the previous call, like pygame's Clock.tick. If
+    #given, poll is called about every POLL_INTERVAL while sleeping.
+    def wait(self, poll=None):
+        margin = max(0.0005, 2 * self.oversleep)
+        while True:
+            remaining = self.deadline - self.now()
+            if remaining <= margin:
+                break
+            wanted = remaining - margin
+            if poll != None:
+                poll()
+                wanted = min(wanted, FrameScheduler.POLL_INTERVAL)
+            before = self.now()
+            self.sleep(wanted)
+            late = (self.now() - before) - wanted
+            self.oversleep = 0.9 * self.oversleep + 0.1 * max(0.0, late)
+        while self.now() < self.deadline:
+            pass
+
+        now = self.now()
+        tick = now - self.last
+        self.last = now
+        self.deadline += self.period
+        #Fell more than a frame behind, don't try to catch up with a burst of
+        #zero-length frames.
+        if self.deadline < now:
+            self.deadline = now + self.period
+        return tick
+
+#Timestamps events as they arrive rather than when the frame gets to them.
+#SDL only lets the main thread read events, so instead of a separate input
+#thread, poll() is called from FrameScheduler.wait() while the game would
+#otherwise sleep, which catches each event within about a millisecond.
+#Events that carry SDL's own timestamp (not every pygame build sets one)
+#use that instead.
+class EventStamper(object):
+    def __init__(self, now=time.perf_counter):
+        import pygame
+        self.pygame = pygame
+        self.now = now
+        #(arrival, event), oldest first.
+        self.pending = []
+
+    def poll(self):
+        events = self.pygame.event.get()
+        if len(events) == 0:
+            return
+        polled = self.now()
+        for event in events:
+            self.pending.append((self.stamp(event, polled), event))
+
+    #Arrival time of event, as a now() value.
+    def stamp(self, event, polled):
+        timestamp = getattr(event, "timestamp", None)
+        if timestamp == None:
+            return polled
+        #SDL timestamps are milliseconds on the same clock as get_ticks().
+        sdlNow = self.pygame.time.get_ticks() / 1000
+        return min(polled, polled - (sdlNow - timestamp / 1000))
+
+    #Sleeps until an event arrives or timeout seconds pass, for when there's
+    #nothing else to do until there's input.
+    def wait(self, timeout):
+        event = self.pygame.event.wait(max(1, int(timeout * 1000)))
+        if event.type != self.pygame.NOEVENT:
+            polled = self.now()
+            self.pending.append((self.stamp(event, polled), event))
+
+    #Everything that arrived since the last call.
+    def get(self):
+        self.poll()
+        (events, self.pending) = (self.pending, [])
+        return events
+
+    def clear(self):
+        self.pending = []
@@ -0,0 +1,250 @@
+import numpy
+
+#Beat trackers. Each one takes mono float samples y at sample rate sr and
+#returns (tempo in BPM, beat times in seconds) from analyze(y, sr). Weak beats
+#at the start and end (silence before and after the music) are dropped,
+#unless trimStart or trimEnd say otherwise, as they do for parts cut out of
+#a song (see audio.analyzeSegment()). Which one a song uses is part of its
+#analysis params (see audio.getAnalysisParams()), so every tracker's beats
+#are cached separately. Run
+#
+#   python benchmark.py trackers
+#
+#to see how fast each one is and how well it agrees with librosa.
+
+#Newer librosa returns the tempo as a 1-element array.
+def toTempo(tempo):
+    return float(numpy.ravel(tempo)[0])
+
+#untrimmed, with the weak beats at the start and/or end dropped. trimmed is
+#the same beats with the weak ones at both ends dropped.
+def trimEnds(untrimmed, trimmed, trimStart, trimEnd):
+    if len(trimmed) == 0:
+        return untrimmed[:0] if (trimStart and trimEnd) else untrimmed
+    (low, high) = (0, len(untrimmed))
+    if trimStart:
+        low = int(numpy.searchsorted(untrimmed, trimmed[0]))
+    if trimEnd:
+        high = int(numpy.searchsorted(untrimmed, trimmed[-1], "right"))
+    return untrimmed[low:high]
+
+#librosa's own beat_track(). The most accurate, but importing it pulls in
+#numba and scipy, and its first run in a process compiles its kernels.
+class LibrosaTracker(object):
+    #Bump when a change to analyze() changes the beats it finds, so cached
+    #analyses from before get redone.
+    VERSION = 1
+
+    def __init__(self, hop=512):
+        self.hop = hop
+
+    def analyze(self, y, sr, trimStart=True, trimEnd=True):
+        import librosa
+        if trimStart and trimEnd:
+            tempo, beats = librosa.beat.beat_track(y=y, sr=sr,
+                                                    hop_length=self.hop)
+        else:
+            #The onsets exactly as beat_track() gets them, once for both.
+            onsets = librosa.onset.onset_strength(y=y, sr=sr,
+                                hop_length=self.hop, aggregate=numpy.median)
+            (tempo, trimmed) = librosa.beat.beat_track(onset_envelope=onsets,
+                                                sr=sr, hop_length=self.hop)
+            (tempo, beats) = librosa.beat.beat_track(onset_envelope=onsets,
+                                    sr=sr, hop_length=self.hop, trim=False)
+            beats = trimEnds(beats, trimmed, trimStart, trimEnd)
+        times = librosa.frames_to_time(beats, sr=sr, hop_length=self.hop)
+        return (toTempo(tempo), [float(time) for time in times])
+
+#The same approach as librosa (Ellis, "Beat Tracking by Dynamic
+#Programming", 2007) in plain NumPy, for machines where librosa is too heavy.
+#The onset envelope is spectral flux over mel bands, the tempo is the
+#strongest peak of its autocorrelation (leaning towards 120 BPM like librosa
+#does), and dynamic programming picks the beats that best line up with onsets
+#while keeping close to that tempo.
+class FluxTracker(object):
+    VERSION = 1
+    #Mel bands, and how far below the loudest one quieter ones are floored
+    #(in dB), as librosa's onset envelope has them.
+    BANDS = 128
+    TOP_DB = 80.0
+    #Tempo search range and prior, in BPM. The prior is log-normal, with a
+    #spread of PRIOR_OCTAVES around PRIOR_BPM.
+    MIN_BPM = 30.0
+    MAX_BPM = 320.0
+    PRIOR_BPM = 120.0
+    PRIOR_OCTAVES = 1.0
+    #The tempo comes from the autocorrelation of windows this many onset
+    #frames long, one every TEMPO_STRIDE frames.
+    TEMPO_WINDOW = 384
+    TEMPO_STRIDE = 8
+    #How much a gap between beats that isn't the tempo costs, librosa's
+    #default.
+    TIGHTNESS = 100.0
+    #Frames put through the FFT at a time, bounds memory on long songs.
+    BLOCK = 1024
+
+    def __init__(self, hop=512, frameLength=2048):
+        self.hop = hop
+        self.frameLength = frameLength
+
+    def analyze(self, y, sr, trimStart=True, trimEnd=True):
+        onsets = self.onsetStrength(y, sr)
+        period = self.estimatePeriod(onsets, sr / self.hop)
+        beats = self.trackBeats(onsets, period, trimStart, trimEnd)
+        tempo = 60.0 * sr / (self.hop * period)
+        return (tempo, [float(frame * self.hop / sr) for frame in beats])
+
+    #Spectral flux, one value per hop: how much louder each mel band got
+    #since the last frame, in dB, averaged over the bands.
+    def onsetStrength(self, y, sr):
+        n = self.frameLength
+        #Frames are centered on their hop, so frame i is at i * hop samples.
+        y = numpy.pad(numpy.asarray(y, dtype=numpy.float32), n // 2)
+        if len(y) < n:
+            return numpy.zeros(1)
+        frames = numpy.lib.stride_tricks.sliding_window_view(y, n)[::self.hop]
+        window = numpy.hanning(n + 1)[:-1].astype(numpy.float32)
+        bank = self.getMelBank(sr)
+
+        S = numpy.empty((len(frames), bank.shape[1]), dtype=numpy.float32)
+        for start in range(0, len(frames), FluxTracker.BLOCK):
+            block = frames[start:start + FluxTracker.BLOCK] * window
+            power = numpy.abs(numpy.fft.rfft(block, axis=1)) ** 2
+            S[start:start + len(block)] = 10 * numpy.log10(
+                                    numpy.maximum(power @ bank, 1e-10))
+        S = numpy.maximum(S, S.max() - FluxTracker.TOP_DB)
+        flux = numpy.maximum(0.0, numpy.diff(S, axis=0, prepend=S[:1]))
+        flux = flux.mean(axis=1, dtype=numpy.float64)
+
+        #librosa's envelope comes out half a frame length later than this,
+        #and the game's timing was tuned on librosa's beats, so line up.
+        lag = n // (2 * self.hop)
+        return numpy.concatenate((numpy.zeros(lag), flux[:len(flux) - lag]))
+
+    #(FFT bins, BANDS) matrix of triangular mel filters, each one scaled to
+    #the same area.
+    def getMelBank(self, sr):
+        toMel = lambda hz: 2595 * numpy.log10(1 + hz / 700)
+        toHz = lambda mel: 700 * (10 ** (mel / 2595) - 1)
+        edges = toHz(numpy.linspace(0, toMel(sr / 2), FluxTracker.BANDS + 2))
+        (low, center, high) = (edges[:-2, None], edges[1:-1, None],
+                                edges[2:, None])
+        hz = numpy.fft.rfftfreq(self.frameLength, 1 / sr)
+        rising = (hz - low) / (center - low)
+        falling = (high - hz) / (high - center)
+        bank = numpy.maximum(0, numpy.minimum(rising, falling))
+        return (bank * (2 / (high - low))).T.astype(numpy.float32)
+
+    #Frames per beat, from the autocorrelation of windows of the onset
+    #envelope (each normalized, so loud passages don't drown out the rest).
+    #frameRate is onset frames per second.
+    def estimatePeriod(self, onsets, frameRate):
+        length = FluxTracker.TEMPO_WINDOW
+        padded = numpy.pad(onsets, length // 2, mode="linear_ramp")
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, length)
+        windows = windows[:len(onsets):FluxTracker.TEMPO_STRIDE]
+        taper = numpy.hanning(length + 1)[:-1]
+        size = 1 << (2 * length - 1).bit_length()
+
+        ac = numpy.zeros(length)
+        for start in range(0, len(windows), FluxTracker.BLOCK):
+            spectrum = numpy.fft.rfft(windows[start:start + FluxTracker.BLOCK]
+                                        * taper, size, axis=1)
+            block = numpy.fft.irfft(numpy.abs(spectrum) ** 2, size,
+                                    axis=1)[:, :length]
+            ac += (block / numpy.maximum(block[:, :1], 1e-10)).sum(axis=0)
+
+        lags = numpy.arange(1, length - 1)
+        bpm = 60 * frameRate / lags
+        prior = numpy.exp(-0.5 * (numpy.log2(bpm / FluxTracker.PRIOR_BPM) /
+                                    FluxTracker.PRIOR_OCTAVES) ** 2)
+        prior[(bpm < FluxTracker.MIN_BPM) | (bpm > FluxTracker.MAX_BPM)] = 0
+        scores = ac[lags] * prior
+        if not (scores.max() > 0):
+            #Silence, or nothing periodic at all.
+            return 60 * frameRate / FluxTracker.PRIOR_BPM
+        best = int(lags[numpy.argmax(scores)])
+
+        #Parabolic interpolation between the neighbouring lags.
+        (a, b, c) = ac[best - 1:best + 2]
+        curve = a - 2 * b + c
+        shift = 0.5 * (a - c) / curve if (curve < 0) else 0.0
+        return best + float(numpy.clip(shift, -0.5, 0.5))
+
+    #Best path of beats through the onset envelope, as frame indices.
+    def trackBeats(self, onsets, period, trimStart=True, trimEnd=True):
+        std = onsets.std(ddof=1) if (len(onsets) > 1) else 0.0
+        if std <= 0:
+            return numpy.zeros(0, dtype=numpy.intp)
+        fpb = max(1.0, float(numpy.round(period)))
+        #The onsets smoothed over a fraction of a beat.
+        offsets = numpy.arange(-fpb, fpb + 1)
+        window = numpy.exp(-0.5 * (offsets * 32.0 / fpb) ** 2)
+        localscore = numpy.convolve(onsets / std, window, "same")
+
+        #A beat comes between half and two periods after the one before it,
+        #and costs more the further from one period it is.
+        gaps = numpy.arange(int(numpy.round(fpb / 2)),
+                            int(numpy.round(2 * fpb)) + 1)
+        gaps = gaps[gaps > 0]
+        penalty = -FluxTracker.TIGHTNESS * numpy.log(gaps / fpb) ** 2
+        (backlink, cumscore) = self.dynamicProgram(localscore, gaps, penalty)
+
+        beats = [self.getLastBeat(cumscore)]
+        while backlink[beats[-1]] >= 0:
+            beats.append(backlink[beats[-1]])
+        beats = numpy.array(beats[::-1], dtype=numpy.intp)
+        return trimEnds(beats, self.trimBeats(localscore, beats), trimStart,
+                        trimEnd)
+
+    #cumscore[i] is the score of the best path of beats ending on frame i,
+    #backlink[i] the beat before i on that path (-1 for the first).
+    def dynamicProgram(self, localscore, gaps, penalty):
+        n = len(localscore)
+        cumscore = numpy.zeros(n)
+        backlink = numpy.full(n, -1, dtype=numpy.intp)
+        #Until the music gets going, every frame starts a path of its own.
+        threshold = 0.01 * localscore.max()
+        started = False
+        for i in range(n):
+            previous = i - gaps
+            valid = previous >= 0
+            if (not started) or (not valid.any()):
+                cumscore[i] = localscore[i]
+                started = started or (localscore[i] >= threshold)
+                continue
+            candidates = cumscore[previous[valid]] + penalty[valid]
+            best = int(numpy.argmax(candidates))
+            cumscore[i] = localscore[i] + candidates[best]
+            backlink[i] = previous[valid][best]
+        return (backlink, cumscore)
+
+    #The last local peak of cumscore that is at least half the median peak,
+    #as librosa does it. The very end of the song tends to be quiet.
+    def getLastBeat(self, cumscore):
+        if len(cumscore) < 3:
+            return len(cumscore) - 1
+        inner = cumscore[1:-1]
+        peaks = numpy.flatnonzero((inner > cumscore[:-2]) &
+                                    (inner >= cumscore[2:])) + 1
+        if len(peaks) == 0:
+            return int(numpy.argmax(cumscore))
+        threshold = 0.5 * numpy.median(cumscore[peaks])
+        return int(peaks[cumscore[peaks] >= threshold][-1])
+
+    #Drops weak beats at either end (silence before and after the music).
+    def trimBeats(self, localscore, beats):
+        if len(beats) == 0:
+            return beats
+        smooth = numpy.convolve(localscore[beats], numpy.hanning(5), "same")
+        threshold = 0.5 * numpy.sqrt(numpy.mean(smooth ** 2))
+        strong = numpy.flatnonzero(smooth >= threshold)
+        if len(strong) == 0:
+            return beats[:0]
+        return beats[strong[0]:strong[-1] + 1]
+
+TRACKERS = {"librosa": LibrosaTracker, "numpy": FluxTracker}
+DEFAULT_TRACKER = "librosa"
+
+def getTracker(name, hop=512):
+    return TRACKERS[name](hop=hop)